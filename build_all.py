@@ -28,19 +28,56 @@ This script will create a folder tree (below) in current folder:
 '''
 import os
 import sys
+import time
 import subprocess
 import argparse
+import shutil
+import tempfile
+import threading
 from glob import glob
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 CONTAINER_FOLDER = 'amber-conda-bld'
 AMBER_BINARY_BUILD_DIR = os.path.abspath(os.path.dirname(__file__))
 CONDA_TOOLS_DIR = os.path.join(AMBER_BINARY_BUILD_DIR, 'conda_tools')
+sys.path.insert(0, CONDA_TOOLS_DIR)
+import build_scheduler  # conda_tools
+import build_cache
+import build_manifest
+import render_cache
+import build_trace
+import job_slots
+import channel_index
+
 DOCKER_BUILD_SCRIPT = os.path.join(
     AMBER_BINARY_BUILD_DIR,
     'conda_tools/run_docker_build.sh'
 )
+DOCKER_SESSION_SCRIPT = os.path.join(
+    AMBER_BINARY_BUILD_DIR,
+    'conda_tools/run_docker_session.sh'
+)
 BZ2_FILES = []
+BUILD_CACHE = None  # build_cache.BuildCache, enabled with --cache-dir
+# untarred package + uncompressed tar + new .tar.bz2 in the temp folder,
+# relative to the size of the conda package
+PACK_TEMP_SPACE_FACTOR = 10
+# memory (MB) of jobs of the --schedule build graph that do not compile:
+# repacking a package (tar and bzip2/xz) and conda install/build of packages
+PACK_MEMORY = 512
+CONDA_MEMORY = 1024
+
+
+def build_memory(cpus):
+    ''' Memory (MB) of a job compiling with `cpus` make jobs. make draws its
+    jobs from the job slots (see job_slots), so at most that many compilers
+    run, each using about job_slots.MEMORY_PER_JOB. '''
+    slots_dir = os.getenv(job_slots.ENV_VAR)
+    n_slots = len(job_slots.slot_files(slots_dir)) if slots_dir else 0
+    return min(cpus, n_slots or cpus) * job_slots.MEMORY_PER_JOB
 
 
 def write_meta_file(amber_ver):
@@ -64,9 +101,8 @@ def assert_amber_src_exists(amberhome):
 
 
 def built_tarfile_dir(build_commands):
-    built_file = subprocess.check_output(build_commands + ['--output'
-                                                           ]).decode().strip()
-    return built_file
+    # cached `conda build --output`
+    return render_cache.output_path(build_commands)
 
 
 def sh(command):
@@ -87,10 +123,149 @@ def copy_tarfile_to_build_folder(build_commands,
         print(copy_comands)
     else:
         subprocess.check_call(copy_comands)
-    BZ2_FILES.append(
-        os.path.join(container_folder, os.path.basename(built_file)))
+    copied_file = os.path.join(container_folder, os.path.basename(built_file))
+    BZ2_FILES.append(copied_file)
+    return copied_file
+
+
+# conda builds running in this process (all threads)
+_running_builds = [0]
+_running_builds_lock = threading.Lock()
+
+
+@contextmanager
+def _running_build():
+    ''' Count a running conda build, yield the number running now '''
+    with _running_builds_lock:
+        _running_builds[0] += 1
+        n_running = _running_builds[0]
+    try:
+        yield n_running
+    finally:
+        with _running_builds_lock:
+            _running_builds[0] -= 1
+
+
+def _run_build(build_command, run, span_name, builds):
+    # each build's make takes its share of the job slots, not all of them
+    # (read by job_slots.acquire)
+    with _running_build() as n_running, build_trace.span(span_name):
+        env = dict(os.environ)
+        env[job_slots.BUILDS_ENV_VAR] = str(max(builds, n_running))
+        return run(build_command, env=env)
+
+
+def conda_build(build_command, dry_run=False, inputs=(), run=None, builds=1):
+    ''' Run `build_command` unless BUILD_CACHE already has its package
+
+    inputs : upstream package files used by this build (part of cache key)
+    run : function to run the command, given the command and `env`; default
+        subprocess.check_call. The package is only stored in BUILD_CACHE if
+        it returns 0 (or None) and the package file exists.
+    builds : number of builds started together with this one. The build
+        gets $AMBER_CONCURRENT_BUILDS, the larger of `builds` and the number
+        of conda builds running in this process.
+    '''
+    run = run or subprocess.check_call
+    if dry_run:
+        print(build_command)
+        return
+    span_name = 'conda build ' + ' '.join(
+        build_cache.strip_build_command(build_command))
+    if BUILD_CACHE is None:
+        _run_build(build_command, run, span_name, builds)
+        return
+    output = built_tarfile_dir(build_command)
+    with build_trace.span('cache key'):
+        key = BUILD_CACHE.key(build_command, os.environ['AMBER_SRC'], inputs)
+    if BUILD_CACHE.restore(key, output):
+        print('Build cache hit: skip {} (key {})'.format(
+            ' '.join(build_command), key))
+        return
+    print('Build cache miss: {} (key {})'.format(' '.join(build_command), key))
+    returncode = _run_build(build_command, run, span_name, builds)
+    if returncode:
+        print('Build failed (exit status {}): not cached'.format(returncode))
+        return
+    if not os.path.exists(output):
+        print('{} not found: not cached'.format(output))
+        return
+    BUILD_CACHE.store(key, output)
+
+
+def python_component_build_command(recipe_dir, pyver, opt, croot=None):
+    build_command = ['conda', 'build', recipe_dir, '--py', pyver]
+    if croot is not None:
+        build_command.extend(['--croot', croot])
+    if opt.skip_test:
+        build_command.append("--no-test")
+    return build_command
+
+
+def _build_in_own_croot(args):
+    build_command, log_file, inputs, n_builds = args
+
+    def run(build_command, env=None):
+        print('Building: {} (log: {})'.format(' '.join(build_command),
+                                              log_file))
+        with open(log_file, 'w') as fh:
+            returncode = subprocess.call(
+                build_command, stdout=fh, stderr=subprocess.STDOUT, env=env)
+        if returncode != 0:
+            with open(log_file) as fh:
+                print(''.join(fh.readlines()[-50:]))
+            raise subprocess.CalledProcessError(returncode, build_command)
 
+    conda_build(build_command, inputs=inputs, run=run, builds=n_builds)
+    return built_tarfile_dir(build_command)
 
+
+def build_python_components_concurrently(recipe_dir,
+                                         py_versions,
+                                         opt,
+                                         croot_dir,
+                                         at_temp_folder,
+                                         inputs=()):
+    """ Build ambertools_tempfile packages for all `py_versions` side by side.
+
+    Each build gets its own conda-build root (croot_dir/py{ver}) so the
+    builds do not share (and lock) a work dir. The built tarfiles are copied
+    to `at_temp_folder`, where conda-ambertools-combine-pythons looks for them.
+
+    inputs : upstream package files (the py2.7 package), for BUILD_CACHE
+    """
+    commands = []
+    for pyver in py_versions:
+        croot = os.path.join(croot_dir, 'py' + pyver)
+        if not opt.dry_run and not os.path.exists(croot):
+            os.makedirs(croot)
+        build_command = python_component_build_command(
+            recipe_dir, pyver, opt, croot=croot)
+        commands.append((build_command, os.path.join(croot, 'build.log')))
+
+    if opt.dry_run:
+        for build_command, _ in commands:
+            print(build_command)
+        return
+
+    n_builds = min(opt.jobs, len(commands))
+    pool = ThreadPool(n_builds)
+    try:
+        tarfiles = pool.map(_build_in_own_croot,
+                            [(build_command, log_file, inputs, n_builds)
+                             for build_command, log_file in commands])
+    finally:
+        pool.close()
+        pool.join()
+
+    if not os.path.exists(at_temp_folder):
+        os.makedirs(at_temp_folder)
+    for tarfile in tarfiles:
+        print('copying {} to {}'.format(tarfile, at_temp_folder))
+        shutil.copy(tarfile, at_temp_folder)
+
+
+@build_trace.traced()
 def build_all_python_verions_in_one_package(container_folder, opt,
         extend_versionss=('3.4', '3.5', '3.6', '3.7')):
     # build full AmberTools for python 2.7 first
@@ -102,23 +277,32 @@ def build_all_python_verions_in_one_package(container_folder, opt,
     py2_build_command = ['conda', 'build', recipe_dir, '--py', '2.7']
     if opt.skip_test:
         py2_build_command.append('--no-test')
-    if opt.dry_run:
-        print(py2_build_command)
-    else:
-        subprocess.check_call(py2_build_command)
+    conda_build(py2_build_command, dry_run=opt.dry_run)
+    py2_inputs = [] if opt.dry_run else [built_tarfile_dir(py2_build_command)]
 
     # build only python packages in AmberTools
-    for pyver in extend_versionss:
-        print('pyver', pyver)
-        build_command = ['conda', 'build', tmp_recipe_dir, '--py', pyver]
-        if opt.skip_test:
-            build_command.append("--no-test")
-        if opt.dry_run:
-            print(build_command)
-        else:
-            subprocess.check_call(build_command)
-        tarfile = built_tarfile_dir(build_command)
-        os.environ['AT_TEMP_FILE_FOLDER'] = os.path.dirname(tarfile)
+    jobs = getattr(opt, 'jobs', 1)
+    if jobs > 1 and len(extend_versionss) > 1:
+        # all builds use the same py2.7 tarfile and do not depend on each other.
+        at_temp_folder = os.path.dirname(built_tarfile_dir(py2_build_command))
+        croot_dir = os.path.join(os.path.dirname(container_folder),
+                                 'conda-croot')
+        build_python_components_concurrently(
+            tmp_recipe_dir,
+            extend_versionss,
+            opt,
+            croot_dir=croot_dir,
+            at_temp_folder=at_temp_folder,
+            inputs=py2_inputs)
+        os.environ['AT_TEMP_FILE_FOLDER'] = at_temp_folder
+    else:
+        for pyver in extend_versionss:
+            print('pyver', pyver)
+            build_command = python_component_build_command(
+                tmp_recipe_dir, pyver, opt)
+            conda_build(build_command, dry_run=opt.dry_run, inputs=py2_inputs)
+            tarfile = built_tarfile_dir(build_command)
+            os.environ['AT_TEMP_FILE_FOLDER'] = os.path.dirname(tarfile)
 
     # build all
     # copy all python packages for different python versions to
@@ -130,12 +314,17 @@ def build_all_python_verions_in_one_package(container_folder, opt,
     if opt.dry_run:
         print(combine_command)
     else:
-        subprocess.check_call(combine_command)
+        # the combine recipe picks up every ambertools_tempfile* package here
+        at_temp_folder = os.path.dirname(built_tarfile_dir(py2_build_command))
+        combine_inputs = py2_inputs + glob(
+            os.path.join(at_temp_folder, 'ambertools_tempfile*.tar.bz2'))
+        conda_build(combine_command, inputs=combine_inputs)
         # sh('cp {} .'.format(built_tarfile_dir(combine_command)))
-    copy_tarfile_to_build_folder(
+    return copy_tarfile_to_build_folder(
         combine_command, container_folder, dry_run=opt.dry_run)
 
 
+@build_trace.traced()
 def perform_build_with_docker(opt, container_folder, py_versions=[
         '2.7',
 ]):
@@ -164,41 +353,87 @@ def perform_build_with_docker(opt, container_folder, py_versions=[
         print('docker_command_build')
         print(" ".join(docker_command_build))
 
-        # dry run to immediately getting output.
-
-        output = subprocess.check_output(docker_command_build + [
-            'True',
-        ]).decode()
-        # find package name from output generated from docker build.
-        line_having_AT = [
-            line for line in output.split('\n')
-            if "['cp', '/root/miniconda3/conda-bld/linux-64/" in line
-        ][0]
-        tarfile = os.path.basename(
-            line_having_AT.split(',')[1].replace("'", ''))
-        all_tarfiles.append(tarfile)
-
-        if not opt.dry_run:
-            subprocess.check_call(docker_command_build + [
-                'False',
-            ])
-        else:
-            print(docker_command_build + ['True'])
-            print(output)
+        # run_docker_build.sh writes the manifest of built packages
+        # to $amberhome/linux-64/ (also in dry run mode)
+        manifest = os.path.join(opt.amberhome, 'linux-64',
+                                'manifest-py{}.json'.format(ver))
+        subprocess.check_call(docker_command_build + [
+            str(bool(opt.dry_run)),
+        ])
+        all_tarfiles.extend(build_manifest.artifact_filenames(manifest))
 
+    moved_files = []
     for tarfile in all_tarfiles:
         abspath_tarfile = os.path.join(opt.amberhome, 'linux-64', tarfile)
 
         move_command = ['mv', abspath_tarfile, container_folder]
         if opt.sudo:
             move_command.insert(0, 'sudo')
-        BZ2_FILES.append(os.path.join(container_folder, tarfile))
+        moved_files.append(os.path.join(container_folder, tarfile))
         if opt.dry_run:
             print(move_command)
         else:
             subprocess.check_call(move_command)
+    BZ2_FILES.extend(moved_files)
+    return moved_files
+
 
+@build_trace.traced()
+def perform_build_with_docker_session(opt, container_folder, py_versions):
+    ''' Like perform_build_with_docker but run all builds in one container
 
+    Jobs are sent to run_docker_session.sh over stdin. Built packages are moved
+    to `container_folder` as soon as each job reports AMBER_JOB_DONE.
+    '''
+    if opt.build_task in ['ambertools_pack_all_pythons', 'ambermini']:
+        py_versions = ['2.7']
+    session_command = [
+        'bash', DOCKER_SESSION_SCRIPT, opt.amberhome, AMBER_BINARY_BUILD_DIR
+    ]
+    if opt.docker_cache_dir:
+        session_command.append(os.path.abspath(opt.docker_cache_dir))
+    jobs = ''.join('{} {} {} {}\n'.format(opt.build_task, ver,
+                                          opt.ambertools_version,
+                                          bool(opt.dry_run))
+                   for ver in py_versions)
+    print(' '.join(session_command))
+    print(jobs)
+
+    moved_files = []
+    # jobs go to a temp file rather than a pipe so that reading stdout
+    # can not dead lock with writing stdin.
+    with tempfile.TemporaryFile() as jobs_fh:
+        jobs_fh.write(jobs.encode())
+        jobs_fh.seek(0)
+        proc = subprocess.Popen(
+            session_command, stdin=jobs_fh, stdout=subprocess.PIPE)
+        for line in iter(proc.stdout.readline, b''):
+            line = line.decode()
+            sys.stdout.write(line)
+            if not line.startswith('AMBER_JOB_DONE'):
+                continue
+            manifest = line.split()[-1].replace('/amberhome', opt.amberhome,
+                                                1)
+            for tarfile in build_manifest.artifact_filenames(manifest):
+                abspath_tarfile = os.path.join(opt.amberhome, 'linux-64',
+                                               tarfile)
+                move_command = ['mv', abspath_tarfile, container_folder]
+                if opt.sudo:
+                    move_command.insert(0, 'sudo')
+                moved_files.append(os.path.join(container_folder, tarfile))
+                if opt.dry_run:
+                    print(move_command)
+                else:
+                    subprocess.check_call(move_command)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode,
+                                                session_command)
+    BZ2_FILES.extend(moved_files)
+    return moved_files
+
+
+@build_trace.traced()
 def perform_build_without_docker(opt,
                                  recipe_dir,
                                  container_folder,
@@ -226,10 +461,8 @@ def perform_build_without_docker(opt,
                 build_commands = ['conda', 'build', recipe_dir, '--py', ver]
                 if opt.skip_test:
                     build_commands.append("--no-test")
-                if opt.dry_run:
-                    print(build_commands)
-                else:
-                    subprocess.call(build_commands)
+                conda_build(
+                    build_commands, dry_run=opt.dry_run, run=subprocess.call)
                 copy_tarfile_to_build_folder(
                     build_commands, container_folder, dry_run=opt.dry_run)
     else:
@@ -239,16 +472,378 @@ def perform_build_without_docker(opt,
         build_commands = ['conda', 'build', amber_mini_recipe_dir]
         if opt.skip_test:
             build_commands.append("--no-test")
-        if opt.dry_run:
-            print(build_commands)
-        else:
-            subprocess.call(build_commands)
+        conda_build(build_commands, dry_run=opt.dry_run, run=subprocess.call)
         copy_tarfile_to_build_folder(
             build_commands, container_folder, dry_run=opt.dry_run)
 
 
+def pack_non_conda(fn, opt, pack_script, output_dir=None, manifest_dir=None):
+    ''' Make non-conda package from `fn`, return its filename
+
+    The filename is read from the manifest written by pack_non_conda.py
+    (default: amber-conda-bld/manifests/non-conda.{basename}.json)
+    '''
+    if manifest_dir is None:
+        manifest_dir = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(fn))),
+            'manifests')
+    manifest = os.path.join(manifest_dir,
+                            'non-conda.' + os.path.basename(fn) + '.json')
+    command_pack = ['python', pack_script, fn, '--manifest', manifest]
+    if opt.date:
+        command_pack.append('--date')
+    if output_dir is not None:
+        command_pack.extend(['--output-dir', output_dir])
+    if getattr(opt, 'streaming_pack', False):
+        command_pack.append('--streaming')
+    if getattr(opt, 'archive_format', 'bz2') != 'bz2':
+        command_pack.extend(['--format', opt.archive_format])
+    if getattr(opt, 'deterministic_pack', False):
+        command_pack.append('--deterministic')
+    if opt.dry_run:
+        command_pack.append('-d')
+
+    print(command_pack)
+    with build_trace.span('pack_non_conda ' + os.path.basename(fn)):
+        subprocess.check_call(command_pack)
+    return build_manifest.read_manifest(manifest)['artifacts'][0]['path']
+
+
+def temp_space_budget():
+    ''' Free space of the temp folder, to be shared by all pack jobs '''
+    return build_scheduler.TempSpaceBudget(
+        build_scheduler.free_disk_space(tempfile.gettempdir()))
+
+
+def pack_non_conda_packages(bz2_files,
+                            opt,
+                            pack_script,
+                            output_dir=None,
+                            budget=None):
+    ''' pack_non_conda for all `bz2_files` concurrently, return new filenames
+
+    At most opt.pack_jobs packages (default: one per cpu) are packed at once,
+    and only as many as fit in the free space of the temp folder: each one
+    needs about PACK_TEMP_SPACE_FACTOR times its size while it is untarred
+    and re-tarred (nothing with --streaming-pack).
+
+    budget : build_scheduler.TempSpaceBudget, shared with other calls running
+        at the same time. Default: temp_space_budget()
+    '''
+    if not bz2_files:
+        return []
+    n_jobs = getattr(opt, 'pack_jobs', None) or min(
+        len(bz2_files), cpu_count())
+    budget = budget or temp_space_budget()
+    # streaming repack does not extract the package
+    space_factor = (0 if getattr(opt, 'streaming_pack', False) else
+                    PACK_TEMP_SPACE_FACTOR)
+    throughput = []
+
+    def pack(fn):
+        size = os.path.getsize(fn) if os.path.exists(fn) else 0
+        with budget.reserve(size * space_factor):
+            start = time.time()
+            output = pack_non_conda(fn, opt, pack_script, output_dir=output_dir)
+            duration = time.time() - start
+        throughput.append((fn, size, duration))
+        print('Packed {}: {}'.format(fn, format_throughput(size, duration)))
+        return output
+
+    start = time.time()
+    pool = ThreadPool(n_jobs)
+    try:
+        outputs = pool.map(pack, bz2_files)
+    finally:
+        pool.close()
+        pool.join()
+
+    print('Non-conda packages ({} jobs)'.format(n_jobs))
+    for fn, size, duration in throughput:
+        print('    {:<60} {}'.format(
+            os.path.basename(fn), format_throughput(size, duration)))
+    print('    {:<60} {}'.format(
+        'total', format_throughput(
+            sum(size for _, size, _ in throughput), time.time() - start)))
+    return outputs
+
+
+def format_throughput(size, duration):
+    mb = size / (1024. * 1024.)
+    return '{:.1f} MB in {:.1f} s ({:.1f} MB/s)'.format(
+        mb, duration, mb / duration if duration else 0.)
+
+
+def write_build_manifest(opt, files):
+    manifest = opt.manifest or os.path.join(CONTAINER_FOLDER, 'manifest.json')
+    print('Writing manifest {}'.format(manifest))
+    build_manifest.write_manifest(
+        manifest, 'build_all',
+        [build_manifest.artifact_entry(fn) for fn in files])
+
+
+def index_container_folder(opt):
+    ''' Write repodata.json so amber-conda-bld can be used as a channel '''
+    if not opt.index or opt.dry_run:
+        return
+    print('Indexing {}'.format(CONTAINER_FOLDER))
+    with build_trace.span('index channel'):
+        channel_index.index_channel(CONTAINER_FOLDER)
+
+
+def native_build_jobs(opt, recipe_dir, container_folder, py_versions, platform):
+    ''' Jobs for building AmberTools on this machine (no docker).
+
+    Each conda build gets its own croot so that builds can run side by side.
+    '''
+    croot_dir = os.path.join(os.path.dirname(container_folder), 'conda-croot',
+                             platform)
+    jobs = []
+    if opt.build_task == 'ambertools_pack_all_pythons':
+        single_recipe_dir = os.path.abspath(
+            os.path.join(AMBER_BINARY_BUILD_DIR, 'conda-ambertools-single-python'))
+        components_recipe_dir = os.path.abspath(
+            os.path.join(AMBER_BINARY_BUILD_DIR,
+                         'conda-ambertools-python-components'))
+        combine_recipe_dir = os.path.abspath(
+            os.path.join(AMBER_BINARY_BUILD_DIR,
+                         'conda-ambertools-combine-pythons'))
+        py2_build_command = ['conda', 'build', single_recipe_dir, '--py', '2.7']
+        if opt.skip_test:
+            py2_build_command.append('--no-test')
+        py2_artifact = platform + ':ambertools-py2.7'
+        at_temp_folder = os.path.dirname(built_tarfile_dir(py2_build_command))
+        py2_inputs = [] if opt.dry_run else [
+            built_tarfile_dir(py2_build_command)
+        ]
+        jobs.append(
+            build_scheduler.Job(
+                platform + ':single-python-2.7',
+                lambda: conda_build(py2_build_command, dry_run=opt.dry_run),
+                outputs=[py2_artifact],
+                cpus=cpu_count(),
+                memory=build_memory(cpu_count())))
+
+        component_artifacts = []
+        for pyver in [ver for ver in py_versions if ver != '2.7']:
+            croot = os.path.join(croot_dir, 'py' + pyver)
+            artifact = platform + ':ambertools_tempfile-py' + pyver
+
+            def build_component(pyver=pyver, croot=croot):
+                build_python_components_concurrently(
+                    components_recipe_dir, (pyver, ),
+                    opt,
+                    croot_dir=os.path.dirname(croot),
+                    at_temp_folder=at_temp_folder,
+                    inputs=py2_inputs)
+
+            jobs.append(
+                build_scheduler.Job(
+                    platform + ':python-components-' + pyver,
+                    build_component,
+                    inputs=[py2_artifact],
+                    outputs=[artifact],
+                    cpus=2,
+                    memory=build_memory(2)))
+            component_artifacts.append(artifact)
+
+        combine_command = ['conda', 'build', combine_recipe_dir]
+        if opt.skip_test:
+            combine_command.append('--no-test')
+
+        def combine():
+            combine_inputs = py2_inputs + glob(
+                os.path.join(at_temp_folder, 'ambertools_tempfile*.tar.bz2'))
+            conda_build(
+                combine_command, dry_run=opt.dry_run, inputs=combine_inputs)
+            return [
+                copy_tarfile_to_build_folder(
+                    combine_command, container_folder, dry_run=opt.dry_run)
+            ]
+
+        jobs.append(
+            build_scheduler.Job(
+                platform + ':combine-pythons',
+                combine,
+                inputs=[py2_artifact] + component_artifacts,
+                outputs=[platform + ':conda'],
+                cpus=1,
+                memory=CONDA_MEMORY))
+    else:
+        build_outputs = []
+        for ver in py_versions:
+            croot = os.path.join(croot_dir, 'py' + ver)
+            build_commands = [
+                'conda', 'build', recipe_dir, '--py', ver, '--croot', croot
+            ]
+            if opt.skip_test:
+                build_commands.append('--no-test')
+            artifact = platform + ':' + opt.build_task + '-py' + ver
+
+            def build(build_commands=build_commands):
+                conda_build(build_commands, dry_run=opt.dry_run)
+                return copy_tarfile_to_build_folder(
+                    build_commands, container_folder, dry_run=opt.dry_run)
+
+            jobs.append(
+                build_scheduler.Job(
+                    platform + ':' + opt.build_task + '-' + ver,
+                    build,
+                    outputs=[artifact],
+                    cpus=cpu_count(),
+                    memory=build_memory(cpu_count())))
+            build_outputs.append(artifact)
+
+        build_jobs = jobs[:]
+
+        def collect():
+            return [job.result for job in build_jobs]
+
+        jobs.append(
+            build_scheduler.Job(
+                platform + ':collect',
+                collect,
+                inputs=build_outputs,
+                outputs=[platform + ':conda']))
+    return jobs
+
+
+def build_graph(opt,
+                recipe_dir,
+                container_folders,
+                py_versions,
+                pack_script,
+                budget=None):
+    ''' Model the whole build as a list of build_scheduler.Job
+
+    container_folders : dict, platform -> folder storing conda packages
+    budget : build_scheduler.TempSpaceBudget shared by all pack jobs
+        (default: temp_space_budget())
+    '''
+    budget = budget or temp_space_budget()
+    jobs = []
+    platforms = []
+    native_platform = 'osx-64' if sys.platform.startswith(
+        'darwin') else 'linux-64'
+    if not opt.exclude_osx:
+        jobs.extend(
+            native_build_jobs(opt, recipe_dir, container_folders['osx-64'],
+                              py_versions, 'osx-64'))
+        platforms.append('osx-64')
+    if not opt.exclude_linux:
+        if opt.no_docker:
+            jobs.extend(
+                native_build_jobs(opt, recipe_dir,
+                                  container_folders['linux-64'], py_versions,
+                                  'linux-64'))
+        else:
+            final_verions = [
+                '2.7',
+            ] if opt.build_task in ['ambermini', 'ambertools_pack_all_pythons'
+                                    ] else py_versions
+            if opt.docker_session:
+                # one container for all versions: its packages are only
+                # known once the session is done
+                jobs.append(
+                    build_scheduler.Job(
+                        'linux-64:docker',
+                        lambda: perform_build_with_docker_session(
+                            opt=opt,
+                            container_folder=container_folders['linux-64'],
+                            py_versions=final_verions),
+                        outputs=['linux-64:conda'],
+                        cpus=cpu_count(),
+                        memory=build_memory(cpu_count())))
+            else:
+                docker_jobs = []
+                for ver in final_verions:
+                    docker_jobs.append(
+                        build_scheduler.Job(
+                            'linux-64:docker-' + ver,
+                            lambda ver=ver: perform_build_with_docker(
+                                opt=opt,
+                                container_folder=container_folders['linux-64'],
+                                py_versions=[ver]),
+                            outputs=['linux-64:docker-py' + ver],
+                            cpus=cpu_count(),
+                            memory=build_memory(cpu_count())))
+                jobs.extend(docker_jobs)
+                jobs.append(
+                    build_scheduler.Job(
+                        'linux-64:collect',
+                        lambda: [
+                            fn for job in docker_jobs for fn in job.result
+                        ],
+                        inputs=[job.outputs[0] for job in docker_jobs],
+                        outputs=['linux-64:conda']))
+        platforms.append('linux-64')
+
+    producers = dict(
+        (artifact, job) for job in jobs for artifact in job.outputs)
+
+    def conda_packages(platform):
+        job = producers.get(platform + ':conda')
+        return (job.result or []) if job is not None else []
+
+    def package_artifacts(platform):
+        ''' Artifacts of the jobs building the packages of `platform`, as
+        early as they are known: a collect job waits for one build job per
+        package (or Python version) '''
+        job = producers[platform + ':conda']
+        if job.name == platform + ':collect':
+            return job.inputs
+        return job.outputs
+
+    def as_list(result):
+        if not result:
+            return []
+        return [result] if isinstance(result, str) else list(result)
+
+    non_conda_folder = os.path.join(
+        os.path.dirname(container_folders['linux-64']), 'non-conda-install')
+    for platform in platforms:
+        if not opt.exclude_non_conda_user:
+            # one job per built package, started as soon as it is built
+            for artifact in package_artifacts(platform):
+
+                def pack(producer=producers[artifact]):
+                    return pack_non_conda_packages(
+                        as_list(producer.result),
+                        opt,
+                        pack_script,
+                        output_dir=non_conda_folder,
+                        budget=budget)
+
+                jobs.append(
+                    build_scheduler.Job(
+                        artifact + ':pack-non-conda',
+                        pack,
+                        inputs=[artifact],
+                        outputs=[artifact + ':non-conda'],
+                        memory=PACK_MEMORY))
+
+        if opt.validate and platform == native_platform:
+            validate_script = os.path.join(CONDA_TOOLS_DIR,
+                                           'validate_ambertools_build.py')
+
+            def validate(platform=platform):
+                for fn in conda_packages(platform):
+                    command = ['python', validate_script, fn]
+                    if opt.dry_run:
+                        print(command)
+                    else:
+                        subprocess.check_call(command)
+
+            jobs.append(
+                build_scheduler.Job(
+                    platform + ':validate',
+                    validate,
+                    inputs=[platform + ':conda'],
+                    memory=CONDA_MEMORY))
+    return jobs
+
+
 def main(args=None):
-    global CONTAINER_FOLDER, DOCKER_BUILD_SCRIPT, BZ2_FILES
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "amberhome", help="Path to amber source code")
@@ -283,6 +878,49 @@ def main(args=None):
         '-d', "--dry-run", action='store_true', dest="dry_run", help="dry run")
     parser.add_argument(
         "--skip-test", action='store_true', dest="skip_test", help="do not run tests")
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help=
+        'Number of concurrent python-components builds (one per Python version). Default: 1'
+    )
+    parser.add_argument(
+        '--job-slots',
+        type=int,
+        default=None,
+        dest='job_slots',
+        help='Total number of make jobs shared by all concurrent builds. '
+        'Default: number of cpus, reduced to fit in available memory '
+        '(1 GB per job)')
+    parser.add_argument(
+        '--pack-jobs',
+        type=int,
+        default=None,
+        dest='pack_jobs',
+        help='Number of packages to post-process for non-conda users at the '
+        'same time (limited by free space in the temp folder). Default: one '
+        'per cpu')
+    parser.add_argument(
+        '--streaming-pack',
+        action='store_true',
+        dest='streaming_pack',
+        help='Make non-conda packages by editing members while copying them '
+        '(pack_non_conda.py --streaming) instead of extracting each package')
+    parser.add_argument(
+        '--archive-format',
+        choices=['bz2', 'xz', 'zstd'],
+        default='bz2',
+        dest='archive_format',
+        help='Compression of non-conda packages (pack_non_conda.py --format). '
+        'Default: bz2')
+    parser.add_argument(
+        '--deterministic-pack',
+        action='store_true',
+        dest='deterministic_pack',
+        help='Make bit-identical non-conda packages for identical content '
+        '(pack_non_conda.py --deterministic)')
     parser.add_argument(
         '--py',
         '--py-version',
@@ -302,18 +940,129 @@ def main(args=None):
         help=
         'Not using docker for building Linux target. This is only for testing, otherwise you must use centos5'
     )
+    parser.add_argument(
+        '--docker-session',
+        action='store_true',
+        dest='docker_session',
+        help='Run all Linux builds in a single docker container (keeps conda '
+        'and compiler caches warm between builds)')
+    parser.add_argument(
+        '--docker-cache-dir',
+        default=None,
+        dest='docker_cache_dir',
+        help='With --docker-session: host folder mounted in the container to '
+        'keep caches between sessions')
     parser.add_argument(
         '--date',
         action='store_true',
         help=
         'If given, add date to non-conda package (mostly for phenix intergration)'
     )
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        dest='cache_dir',
+        help='Cache built conda packages in this folder, keyed on the '
+        'AmberTools source, recipes, conda_tools scripts, Python version and '
+        'toolchain. conda build is skipped on a cache hit. Default: no cache')
+    parser.add_argument(
+        '--ccache-dir',
+        default=None,
+        dest='ccache_dir',
+        help='Compile through ccache with this cache folder '
+        '(kept between builds). Default: no ccache')
+    parser.add_argument(
+        '--staging-dir',
+        default=None,
+        dest='staging_dir',
+        help='Sync the AmberTools source to this folder (kept between '
+        'builds; only changed files are copied) and copy it to the build '
+        'folder from there. With --staging-mode copy the whole tree is '
+        'still copied from the staging folder (fast only on filesystems with '
+        'reflinks); use a link mode to avoid that. Default: copy from the '
+        'source')
+    parser.add_argument(
+        '--staging-mode',
+        default=None,
+        dest='staging_mode',
+        choices=['copy', 'hardlink', 'symlink'],
+        help='Fill the build folder with copies of the AmberTools source (or '
+        'of the staging folder), hardlinks or symlinks to them. Links are '
+        'fast and take no space, the source must then stay in place during '
+        'the build. Default: copy')
+    parser.add_argument(
+        '--schedule',
+        action='store_true',
+        help='Run all build stages as a dependency graph: independent stages '
+        '(e.g. MacOS build and Linux docker build, packing of finished '
+        'packages) run concurrently')
+    parser.add_argument(
+        '--max-cpus',
+        type=int,
+        default=None,
+        dest='max_cpus',
+        help='CPU budget for --schedule. Default: all cpus')
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        default=None,
+        dest='max_memory',
+        help='Memory budget (MB) for --schedule: jobs start only while the '
+        'sum of their estimates (about 1 GB per make job) fits. Default: '
+        'physical memory')
+    parser.add_argument(
+        '--validate',
+        action='store_true',
+        help='With --schedule: validate built packages for this platform')
+    parser.add_argument(
+        '--manifest',
+        default=None,
+        help='json manifest of all built packages. '
+        'Default: amber-conda-bld/manifest.json')
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help='Write repodata.json in amber-conda-bld/{linux-64,osx-64} after '
+        'the build (only new or changed packages are read), so it can be used '
+        'with `conda install -c file://...`')
+    parser.add_argument(
+        '--trace',
+        default=None,
+        help='Record timing spans of all build stages in this folder: '
+        'trace.json (open in chrome://tracing or https://ui.perfetto.dev) and '
+        'summary.txt (slowest spans). Default: no trace')
     parser.add_argument(
         '--sudo',
         action='store_true',
         help='use sudo to move files. Note: for circleci')
     opt = parser.parse_args(args)
     opt.amberhome = os.path.abspath(opt.amberhome)
+    if opt.trace is None:
+        build(opt)
+    else:
+        trace_build(opt)
+
+
+def trace_build(opt):
+    ''' build(opt) with timing spans written to opt.trace '''
+    opt.trace = os.path.abspath(opt.trace)
+    if not os.path.exists(opt.trace):
+        os.makedirs(opt.trace)
+    build_trace.clean(opt.trace)
+    # read by build_trace here and in the conda build scripts
+    os.environ['AMBER_TRACE_DIR'] = opt.trace
+    try:
+        with build_trace.span('build_all', build_task=opt.build_task):
+            build(opt)
+    finally:
+        build_trace.flush()
+        print(build_trace.merge(opt.trace))
+        print('Trace: {}'.format(
+            os.path.join(opt.trace, build_trace.TRACE_FILE)))
+
+
+def build(opt):
+    global CONTAINER_FOLDER, DOCKER_BUILD_SCRIPT, BZ2_FILES, BUILD_CACHE
 
     if opt.build_task in ['ambertools', 'ambertools_pack_all_pythons']:
         py_versions = ([str(opt.py),] if opt.py not in [None, 'None']
@@ -370,6 +1119,58 @@ def main(args=None):
 
     os.environ['AMBER_BUILD_TASK'] = build_task
     os.environ['AMBER_SRC'] = opt.amberhome
+    if opt.ccache_dir is not None:
+        # read by utils.setup_ccache in the conda build scripts
+        os.environ['AMBER_CCACHE_DIR'] = os.path.abspath(opt.ccache_dir)
+    if opt.staging_dir is not None:
+        # read by copy_ambertools.copy_tree in the conda build scripts
+        os.environ['AMBER_STAGING_DIR'] = os.path.abspath(opt.staging_dir)
+    if opt.staging_mode is not None:
+        os.environ['AMBER_STAGING_MODE'] = opt.staging_mode
+    # make jobs of all concurrent builds draw from these slots
+    # (AMBER_JOB_SLOTS_DIR, read by utils.make_install)
+    job_slots.setup(
+        os.getenv(job_slots.ENV_VAR) or os.path.join(CONTAINER_FOLDER,
+                                                     'job-slots'),
+        n_slots=opt.job_slots)
+    if opt.cache_dir is not None:
+        BUILD_CACHE = build_cache.BuildCache(opt.cache_dir)
+        print('Build cache = {}'.format(BUILD_CACHE.cache_dir))
+
+    # one budget for all pack jobs, so concurrent ones do not count the same
+    # free space twice
+    pack_budget = temp_space_budget()
+    if opt.schedule:
+        container_folders = {
+            'osx-64': container_folder_osx,
+            'linux-64': container_folder_linux
+        }
+        jobs = build_graph(
+            opt,
+            recipe_dir,
+            container_folders,
+            py_versions,
+            pack_non_conda_package_script,
+            budget=pack_budget)
+        scheduler = build_scheduler.Scheduler(
+            jobs,
+            cpus=opt.max_cpus,
+            memory=opt.max_memory,
+            dry_run=opt.dry_run)
+        scheduler.run()
+        scheduler.report()
+
+        final_files = []
+        for suffix in [':conda', ':non-conda']:
+            for job in jobs:
+                if any(artifact.endswith(suffix) for artifact in job.outputs):
+                    final_files.extend(job.result or [])
+        index_container_folder(opt)
+        write_build_manifest(opt, final_files)
+        print("FINAL")
+        for fn in final_files:
+            print(fn)
+        return
 
     # OSX build using your MacOS computer
     if not opt.exclude_osx:
@@ -398,13 +1199,22 @@ def main(args=None):
             final_verions = [
                 '2.7',
             ] if build_task == 'ambermini' else py_versions
-            perform_build_with_docker(
-                opt=opt,
-                container_folder=container_folder_linux,
-                py_versions=final_verions)
+            if opt.docker_session:
+                perform_build_with_docker_session(
+                    opt=opt,
+                    container_folder=container_folder_linux,
+                    py_versions=final_verions)
+            else:
+                perform_build_with_docker(
+                    opt=opt,
+                    container_folder=container_folder_linux,
+                    py_versions=final_verions)
 
     # Post-process conda-built packages for non-conda users
-    if not opt.exclude_non_conda_user:
+    if opt.exclude_non_conda_user:
+        index_container_folder(opt)
+        write_build_manifest(opt, BZ2_FILES)
+    else:
         print("Post processing conda packages for non-conda user")
         os.chdir(CONTAINER_FOLDER)
 
@@ -415,26 +1225,11 @@ def main(args=None):
             bz2_files = BZ2_FILES
 
         print('BZ2_FILES', bz2_files)
-        final_files = bz2_files[:]
-        for fn in bz2_files:
-            command_pack = ['python', pack_non_conda_package_script, fn]
-            if opt.date:
-                command_pack.append('--date')
-
-            command_pack_dry_run = command_pack + ['-d']
-
-            out_fn = [
-                line.split()[-1]
-                for line in (subprocess.check_output(command_pack_dry_run)
-                             .decode().split('\n'))
-                if 'ABSOLUTE FILENAME DIR' in line
-            ].pop()
-
-            final_files.append(out_fn)
-            print(command_pack)
-            if not opt.dry_run:
-                subprocess.check_call(command_pack)
+        final_files = bz2_files + pack_non_conda_packages(
+            bz2_files, opt, pack_non_conda_package_script, budget=pack_budget)
 
+        index_container_folder(opt)
+        write_build_manifest(opt, final_files)
         print("FINAL")
         for fn in final_files:
             print(fn)
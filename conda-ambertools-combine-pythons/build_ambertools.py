@@ -14,6 +14,7 @@ sys.path.insert(0, conda_tools_dir)
 import utils # conda_tools
 from copy_built_ambertools import copy_to_prefix
 import update_gfortran_libs_osx
+import dedup_files
 
 
 def main():
@@ -42,6 +43,10 @@ def main():
     
     if sys.platform.startswith("darwin"):
         update_gfortran_libs_osx.main([PREFIX, '--copy-gfortran'])
+
+    # lib/python2.7 ... lib/python3.7 share many identical files: store them
+    # once (as hardlinks in the package)
+    dedup_files.dedup(glob(os.path.join(PREFIX, 'lib', 'python*')))
        
 
 if __name__ == '__main__':
@@ -44,6 +44,7 @@ def main():
 
     utils.sh('cp -rf {}/lib/python{} {}/lib/'.format(AMBERHOME, python_ver, PREFIX))
     shutil.rmtree('./info')
+    utils.report_ccache_stats()
 
 
 if __name__ == '__main__':
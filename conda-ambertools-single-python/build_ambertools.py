@@ -29,7 +29,7 @@ def main():
     utils.run_configure()
     
     if amber_build_task == "ambertools":
-        utils.sh('make install -j{}'.format(cpu_count()))
+        utils.make_install(ncpus=cpu_count())
     else:
         # e.g: make sander
         if amber_build_task in ['pytraj', 'parmed', 'pymdgx', 'pysander']:
@@ -50,6 +50,7 @@ def main():
         fix_rpath_osx.main([amberhome]) # conda-build seems not help.
     
     copy_to_prefix(amberhome, prefix)
+    utils.report_ccache_stats()
 
 
 if __name__ == '__main__':
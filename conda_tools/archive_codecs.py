@@ -0,0 +1,477 @@
+""" Archive formats for conda and non-conda packages.
+
+    bz2    .tar.bz2  multi-threaded (parallel_bz2), the default
+    xz     .tar.xz   lzma module
+    zstd   .tar.zst  multi-threaded; zstandard module if installed, else the
+                     zstd command
+    conda  .conda    conda's v2 format: an uncompressed zip with
+                     metadata.json, info-{name}.tar.zst (info/) and
+                     pkg-{name}.tar.zst (everything else). Conda packages only.
+
+Example:
+
+    with archive_codecs.tar_writer('ambertools-18.0-0.conda', 'conda') as tar:
+        tar.add('info', recursive=True)
+
+    # compare formats on a real package
+    python archive_codecs.py --benchmark ambertools-18.0-py36_0.tar.bz2
+"""
+import os
+import sys
+import bz2
+import json
+import time
+import shutil
+import tarfile
+import zipfile
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import parallel_bz2
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ['bz2', 'xz', 'zstd', 'conda']
+EXTENSIONS = {
+    'bz2': '.tar.bz2',
+    'xz': '.tar.xz',
+    'zstd': '.tar.zst',
+    'conda': '.conda',
+}
+DEFAULT_LEVELS = {
+    'bz2': 9,
+    'xz': 6,
+    'zstd': 19,
+    'conda': 19,
+}
+CONDA_FORMAT_VERSION = 2
+BLOCK_SIZE = 1 << 20
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# fixed thread counts for deterministic output (bz2 streams are cut at fixed
+# offsets whatever the number of threads)
+DETERMINISTIC_THREADS = {
+    'xz': 1,
+    'zstd': 4,
+    'conda': 4,
+}
+
+
+def archive_name(tar_name, archive_format):
+    ''' ambertools-18.0-0.tar -> ambertools-18.0-0.tar.bz2, ...conda '''
+    assert tar_name.endswith('.tar'), tar_name
+    return tar_name[:-len('.tar')] + EXTENSIONS[archive_format]
+
+
+class _CommandWriter(object):
+    ''' Write-only file object piping to a compressor command '''
+
+    def __init__(self, command, fileobj):
+        self.command = command
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise subprocess.CalledProcessError(self._process.returncode,
+                                                self.command)
+
+    def abort(self):
+        self._process.kill()
+        self._process.wait()
+
+
+class _CommandReader(object):
+    ''' Read-only file object reading the output of a decompressor command '''
+
+    def __init__(self, command, fileobj):
+        self.command = command
+        self._process = subprocess.Popen(
+            command, stdin=fileobj, stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        return self._process.stdout.read(size)
+
+    def close(self):
+        self._process.stdout.close()
+        if self._process.wait() != 0:
+            raise subprocess.CalledProcessError(self._process.returncode,
+                                                self.command)
+
+
+def _which(program):
+    for path in os.getenv('PATH', '').split(os.pathsep):
+        fn = os.path.join(path, program)
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            return fn
+    return None
+
+
+def compressor(fileobj, archive_format, level=None, threads=None):
+    ''' Write-only file object compressing to `fileobj` (which is not closed)
+
+    threads : int or None, default: all cpus. For bz2, threads=1 writes a
+        single bz2 stream (for conda on Python 2).
+    '''
+    level = level or DEFAULT_LEVELS[archive_format]
+    if archive_format == 'bz2':
+        return parallel_bz2.ParallelBZ2Writer(
+            fileobj,
+            threads=threads,
+            chunk_size=None if threads == 1 else parallel_bz2.CHUNK_SIZE,
+            level=level)
+    if archive_format == 'xz':
+        if lzma is None:
+            return _CommandWriter(
+                ['xz', '-c', '-{}'.format(level)] +
+                (['-T{}'.format(threads)] if threads else []), fileobj)
+        return lzma.LZMAFile(fileobj, 'w', preset=level)
+    if archive_format in ['zstd', 'conda']:
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(
+                level=level, threads=threads or -1).stream_writer(
+                    fileobj, closefd=False)
+        if _which('zstd') is None:
+            raise RuntimeError(
+                'zstd needs the zstandard module or the zstd command')
+        return _CommandWriter([
+            'zstd', '-q', '-c', '-T{}'.format(threads or 0),
+            '-{}'.format(level)
+        ] + (['--ultra'] if level > 19 else []), fileobj)
+    raise ValueError('Unknown archive format {}'.format(archive_format))
+
+
+def decompressor(fileobj, archive_format):
+    ''' Read-only file object decompressing `fileobj` (.tar.* formats) '''
+    if archive_format == 'bz2':
+        return bz2.BZ2File(fileobj)
+    if archive_format == 'xz':
+        return lzma.LZMAFile(fileobj)
+    if archive_format == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(fileobj)
+        return _CommandReader(['zstd', '-q', '-d', '-c'], fileobj)
+    raise ValueError('Can not stream {}'.format(archive_format))
+
+
+def _zip_info(name, size):
+    # fixed date and mode: the same parts give the same .conda file
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    info.external_attr = 0o644 << 16
+    info.file_size = size
+    return info
+
+
+def _zip_writestr(zf, name, content):
+    zf.writestr(_zip_info(name, len(content)), content)
+
+
+def _zip_write(zf, fn, name):
+    info = _zip_info(name, os.path.getsize(fn))
+    with open(fn, 'rb') as fh:
+        if sys.version_info >= (3, 6):
+            with zf.open(info, 'w') as fh_out:
+                shutil.copyfileobj(fh, fh_out, BLOCK_SIZE)
+        else:
+            zf.writestr(info, fh.read())
+
+
+class CondaPackageWriter(object):
+    ''' Write a .conda (v2) package with the tarfile writing interface
+    (add, addfile, gettarinfo, close) '''
+
+    def __init__(self, output_fn, level=None, threads=None):
+        self.output_fn = output_fn
+        stem = os.path.basename(output_fn)[:-len('.conda')]
+        self._tmp_dir = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(output_fn)))
+        self._parts = {}
+        for part in ['info', 'pkg']:
+            fn = os.path.join(self._tmp_dir, '{}-{}.tar.zst'.format(part, stem))
+            fh = open(fn, 'wb')
+            writer = compressor(fh, 'conda', level=level, threads=threads)
+            tar = tarfile.open(
+                fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT)
+            self._parts[part] = (fn, fh, writer, tar)
+
+    def _tar(self, name):
+        part = 'info' if name == 'info' or name.startswith('info/') else 'pkg'
+        return self._parts[part][3]
+
+    def addfile(self, member, fileobj=None):
+        self._tar(member.name).addfile(member, fileobj)
+
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        return self._tar(arcname or name).gettarinfo(name, arcname, fileobj)
+
+    def add(self, name, arcname=None, recursive=True, filter=None):
+        arcname = arcname or name
+        self._tar(arcname).add(
+            name, arcname=arcname, recursive=recursive, filter=filter)
+
+    def close(self):
+        for fn, fh, writer, tar in self._parts.values():
+            tar.close()
+            writer.close()
+            fh.close()
+        try:
+            with zipfile.ZipFile(self.output_fn, 'w',
+                                 zipfile.ZIP_STORED) as zf:
+                _zip_writestr(
+                    zf, 'metadata.json',
+                    json.dumps({
+                        'conda_pkg_format_version': CONDA_FORMAT_VERSION
+                    }).encode())
+                # info is a separate stream: conda reads it without the payload
+                for part in ['info', 'pkg']:
+                    fn = self._parts[part][0]
+                    _zip_write(zf, fn, os.path.basename(fn))
+        finally:
+            shutil.rmtree(self._tmp_dir)
+
+    def abort(self):
+        for fn, fh, writer, tar in self._parts.values():
+            if hasattr(writer, 'abort'):
+                writer.abort()
+            fh.close()
+        shutil.rmtree(self._tmp_dir)
+
+
+@contextmanager
+def tar_writer(output_fn, archive_format='bz2', level=None, threads=None):
+    ''' Yield an object to add tar members to (add, addfile), written to
+    `output_fn` in `archive_format`. On error, output_fn is removed. '''
+    if archive_format == 'conda':
+        writer = CondaPackageWriter(output_fn, level=level, threads=threads)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        return
+
+    with open(output_fn, 'wb') as fh:
+        writer = compressor(
+            fh, archive_format, level=level, threads=threads)
+        try:
+            with tarfile.open(
+                    fileobj=writer, mode='w|',
+                    format=tarfile.GNU_FORMAT) as tar:
+                yield tar
+            writer.close()
+        except BaseException:
+            if hasattr(writer, 'abort'):
+                writer.abort()
+            fh.close()
+            os.remove(output_fn)
+            raise
+
+
+def compress_tar(tar_fn, output_fn, archive_format='bz2', level=None,
+                 threads=None):
+    ''' Compress the uncompressed tar file `tar_fn` to `output_fn` '''
+    if archive_format == 'conda':
+        convert_package(tar_fn, output_fn, 'conda', level=level,
+                        threads=threads)
+        return output_fn
+    with open(tar_fn, 'rb') as fh, open(output_fn, 'wb') as fh_out:
+        writer = compressor(
+            fh_out, archive_format, level=level, threads=threads)
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            writer.write(block)
+        writer.close()
+    return output_fn
+
+
+def convert_package(pkg_fn, output_fn, archive_format, level=None,
+                    threads=None):
+    ''' Write the members of `pkg_fn` (any tar) to `output_fn` '''
+    with tarfile.open(pkg_fn, 'r|*') as tar_in, \
+            tar_writer(output_fn, archive_format, level=level,
+                       threads=threads) as tar_out:
+        for member in tar_in:
+            fileobj = tar_in.extractfile(member) if member.isfile() else None
+            tar_out.addfile(member, fileobj)
+    return output_fn
+
+
+def deterministic_mtime():
+    ''' mtime of all members of deterministic archives: $SOURCE_DATE_EPOCH
+    or 0 '''
+    return int(os.getenv('SOURCE_DATE_EPOCH', 0))
+
+
+def normalize_member(member):
+    ''' Reset member metadata that depends on the build host or time:
+    mtime, owner, and mode (0755 for folders and executables, else 0644).
+    Usable as tarfile `filter`. '''
+    member.mtime = deterministic_mtime()
+    member.uid = member.gid = 0
+    member.uname = member.gname = ''
+    member.pax_headers = {}
+    if member.issym():
+        member.mode = 0o777
+    elif member.isdir() or member.mode & 0o111:
+        member.mode = 0o755
+    else:
+        member.mode = 0o644
+    return member
+
+
+def add_sorted(tar, path, arcname, filter=None):
+    ''' tar.add(path, arcname), adding folder content in sorted order '''
+    tar.add(path, arcname=arcname, recursive=False, filter=filter)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            add_sorted(
+                tar,
+                os.path.join(path, name),
+                arcname + '/' + name,
+                filter=filter)
+
+
+def format_of(fn):
+    ''' Archive format from the file name, None for other files '''
+    for archive_format, extension in EXTENSIONS.items():
+        if fn.endswith(extension):
+            return archive_format
+    return None
+
+
+@contextmanager
+def tar_reader(fn):
+    ''' Yield a streaming tarfile ('r|') reading `fn`: .tar or any .tar.*
+    format above '''
+    archive_format = format_of(fn)
+    if archive_format == 'conda':
+        raise ValueError('Can not stream {}'.format(fn))
+    with open(fn, 'rb') as fh:
+        if archive_format == 'zstd':
+            reader = decompressor(fh, archive_format)
+            try:
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    yield tar
+            finally:
+                reader.close()
+        else:
+            with tarfile.open(fileobj=fh, mode='r|*') as tar:
+                yield tar
+
+
+def read_archive(fn, archive_format, fh_out=None):
+    ''' Decompress `fn` (all tar data of a .conda); return number of bytes '''
+    n_bytes = 0
+    if archive_format == 'conda':
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with zipfile.ZipFile(fn) as zf:
+                for name in zf.namelist():
+                    if name.endswith('.tar.zst'):
+                        n_bytes += read_archive(
+                            zf.extract(name, tmp_dir), 'zstd', fh_out)
+        finally:
+            shutil.rmtree(tmp_dir)
+        return n_bytes
+    with open(fn, 'rb') as fh:
+        reader = decompressor(fh, archive_format)
+        for block in iter(lambda: reader.read(BLOCK_SIZE), b''):
+            n_bytes += len(block)
+            if fh_out is not None:
+                fh_out.write(block)
+        reader.close()
+    return n_bytes
+
+
+def benchmark(pkg_fn, formats=FORMATS, level=None, threads=None):
+    ''' Re-compress the conda package `pkg_fn` in each format
+
+    Returns a list of (format, compressed size, ratio, compress seconds,
+    decompress seconds); ratio = compressed size / tar size.
+    '''
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tar_fn = os.path.join(tmp_dir, 'package.tar')
+        with tarfile.open(pkg_fn) as tar_in, tarfile.open(tar_fn,
+                                                         'w') as tar_out:
+            for member in tar_in:
+                fileobj = tar_in.extractfile(
+                    member) if member.isfile() else None
+                tar_out.addfile(member, fileobj)
+        tar_size = os.path.getsize(tar_fn)
+        for archive_format in formats:
+            output_fn = os.path.join(tmp_dir,
+                                     archive_name('package.tar',
+                                                  archive_format))
+            start = time.time()
+            compress_tar(tar_fn, output_fn, archive_format, level=level,
+                         threads=threads)
+            compress_time = time.time() - start
+            start = time.time()
+            read_archive(output_fn, archive_format)
+            decompress_time = time.time() - start
+            size = os.path.getsize(output_fn)
+            results.append((archive_format, size, float(size) / tar_size,
+                            compress_time, decompress_time))
+            os.remove(output_fn)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Convert conda packages to another archive format, or '
+        'compare formats')
+    parser.add_argument('packages', nargs='+')
+    parser.add_argument('--format', choices=FORMATS, default='conda')
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('-j', '--threads', type=int, default=None)
+    parser.add_argument(
+        '--output-dir', default='.', dest='output_dir', help='output folder')
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='Print ratio, compress and decompress time of all formats')
+    opt = parser.parse_args(args)
+    for pkg_fn in opt.packages:
+        if opt.benchmark:
+            print(pkg_fn)
+            print('    {:<8} {:>12} {:>8} {:>12} {:>14}'.format(
+                'format', 'size (MB)', 'ratio', 'compress (s)',
+                'decompress (s)'))
+            for row in benchmark(pkg_fn, level=opt.level,
+                                 threads=opt.threads):
+                archive_format, size, ratio, compress_time, decompress_time = row
+                print('    {:<8} {:12.1f} {:8.3f} {:12.1f} {:14.1f}'.format(
+                    archive_format, size / (1024. * 1024.), ratio,
+                    compress_time, decompress_time))
+        else:
+            basename = os.path.basename(pkg_fn)
+            for extension in EXTENSIONS.values():
+                if basename.endswith(extension):
+                    basename = basename[:-len(extension)] + '.tar'
+            output_fn = os.path.join(opt.output_dir,
+                                     archive_name(basename, opt.format))
+            print(convert_package(pkg_fn, output_fn, opt.format,
+                                  level=opt.level, threads=opt.threads))
+
+
+if __name__ == '__main__':
+    main()
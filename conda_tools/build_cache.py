@@ -0,0 +1,210 @@
+""" Content-addressed cache for conda-built AmberTools packages.
+
+A cache key is a sha256 over everything that determines the built package:
+
+    - the AmberTools source tree (AMBER_SRC)
+    - the recipe folder (meta.yaml, build scripts) and the environment
+      variables meta.yaml reads (AMBER_BUILD_TASK)
+    - the build scripts in conda_tools
+    - the Python version and other conda build arguments
+    - the toolchain (gcc, g++, gfortran, conda versions) and platform
+    - upstream packages (e.g. the py2.7 package for python-components)
+
+On a hit, the cached tarfile is put where `conda build --output` expects it
+and `conda build` is skipped.
+
+File hashes are remembered by (path, size, mtime, inode) so that only
+new or changed files of a multi-GB source tree are read again.
+
+Example:
+
+    cache = BuildCache('~/.amber-build-cache')
+    key = cache.key(['conda', 'build', recipe_dir, '--py', '2.7'], amber_src)
+    if not cache.restore(key, output_path):
+        subprocess.check_call(build_command)
+        cache.store(key, output_path)
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+import threading
+
+THIS_DIR = os.path.abspath(os.path.dirname(__file__))
+# linux-64 is where run_docker_build.sh copies packages in AMBER_SRC
+EXCLUDED_NAMES = set(
+    ['.git', '__pycache__', '.pytest_cache', 'linux-64', 'osx-64'])
+TOOLCHAIN_COMMANDS = [
+    ['gcc', '--version'],
+    ['g++', '--version'],
+    ['gfortran', '--version'],
+    ['conda', '--version'],
+]
+# environment variables that change the rendered recipes
+RECIPE_ENV_VARS = ['AMBER_BUILD_TASK']
+# conda build arguments that do not change the built package
+IGNORED_BUILD_ARGS = ['--no-test', '--croot', '--output']
+BLOCK_SIZE = 1 << 20
+
+
+def _file_sha256(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def toolchain_fingerprint():
+    lines = [sys.platform]
+    for command in TOOLCHAIN_COMMANDS:
+        try:
+            output = subprocess.check_output(
+                command, stderr=subprocess.STDOUT).decode()
+            lines.append(output.strip().split('\n')[0])
+        except (OSError, subprocess.CalledProcessError):
+            lines.append('{} missing'.format(command[0]))
+    return '\n'.join(lines)
+
+
+def strip_build_command(build_command):
+    ''' conda build arguments that matter for the built package '''
+    args = []
+    skip_next = False
+    for arg in build_command[2:]:
+        if skip_next:
+            skip_next = False
+        elif arg in IGNORED_BUILD_ARGS:
+            skip_next = arg == '--croot'
+        elif os.path.isdir(arg):
+            # recipe dir is hashed by content, not by path
+            args.append(os.path.basename(os.path.normpath(arg)))
+        else:
+            args.append(arg)
+    return args
+
+
+class BuildCache(object):
+    ''' Map build fingerprints to built .tar.bz2 files in `cache_dir` '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._hash_file = os.path.join(self.cache_dir, 'file_hashes.json')
+        self._lock = threading.Lock()
+        self._toolchain = None
+        try:
+            with open(self._hash_file) as fh:
+                self._hashes = json.load(fh)
+        except (IOError, OSError, ValueError):
+            self._hashes = {}
+
+    def file_hash(self, fn):
+        st = os.stat(fn)
+        stamp = [st.st_size, st.st_mtime, st.st_ino]
+        with self._lock:
+            known = self._hashes.get(fn)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        digest = _file_sha256(fn)
+        with self._lock:
+            self._hashes[fn] = [stamp, digest]
+        return digest
+
+    def tree_hash(self, root):
+        ''' sha256 over relative paths, exec bits and contents in `root` '''
+        h = hashlib.sha256()
+        root = os.path.abspath(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(
+                name for name in dirnames if name not in EXCLUDED_NAMES)
+            for name in sorted(filenames):
+                fn = os.path.join(dirpath, name)
+                relpath = os.path.relpath(fn, root)
+                h.update(relpath.encode('utf-8', 'surrogateescape'))
+                if os.path.islink(fn):
+                    h.update(b'link:' + os.readlink(fn).encode(
+                        'utf-8', 'surrogateescape'))
+                elif os.path.isfile(fn):
+                    executable = os.stat(fn).st_mode & 0o111
+                    h.update(b'x' if executable else b'-')
+                    h.update(self.file_hash(fn).encode())
+        return h.hexdigest()
+
+    def save_hashes(self):
+        with self._lock:
+            tmp = self._hash_file + '.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump(self._hashes, fh)
+            os.rename(tmp, self._hash_file)
+
+    def key(self, build_command, amber_src, inputs=()):
+        ''' Fingerprint of `build_command` (['conda', 'build', recipe, ...])
+
+        Parameters
+        ----------
+        build_command : list of str
+        amber_src : str, AmberTools source tree
+        inputs : sequence of str, upstream package files the build uses
+        '''
+        if self._toolchain is None:
+            self._toolchain = toolchain_fingerprint()
+        recipe_dir = build_command[2]
+        parts = [
+            ('source', self.tree_hash(amber_src)),
+            ('recipe', self.tree_hash(recipe_dir)),
+            ('conda_tools', self.tree_hash(THIS_DIR)),
+            ('args', ' '.join(strip_build_command(build_command))),
+            ('env', ' '.join('{}={}'.format(name, os.getenv(name, ''))
+                             for name in RECIPE_ENV_VARS)),
+            ('toolchain', self._toolchain),
+        ]
+        for fn in sorted(inputs):
+            parts.append(('input', os.path.basename(fn) + self.file_hash(fn)))
+        self.save_hashes()
+
+        h = hashlib.sha256()
+        for name, value in parts:
+            h.update('{}={}\n'.format(name, value).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def lookup(self, key):
+        ''' path of cached package for `key` or None '''
+        try:
+            with open(os.path.join(self._entry_dir(key), 'entry.json')) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+        fn = os.path.join(self._entry_dir(key), entry['filename'])
+        return fn if os.path.exists(fn) else None
+
+    def restore(self, key, output_path):
+        ''' Put cached package at `output_path`. Return True on cache hit '''
+        cached = self.lookup(key)
+        if cached is None:
+            return False
+        if os.path.basename(cached) != os.path.basename(output_path):
+            # recipe renders to another filename (e.g. new build string)
+            return False
+        output_dir = os.path.dirname(output_path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        shutil.copy2(cached, output_path)
+        return True
+
+    def store(self, key, path):
+        entry_dir = self._entry_dir(key)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+        basename = os.path.basename(path)
+        # copy, not link: conda build may later overwrite `path` in place.
+        shutil.copy2(path, os.path.join(entry_dir, basename))
+        with open(os.path.join(entry_dir, 'entry.json'), 'w') as fh:
+            json.dump({'filename': basename}, fh)
+
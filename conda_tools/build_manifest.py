@@ -0,0 +1,133 @@
+""" Machine-readable manifest of the artifacts a build stage produced.
+
+Each stage (conda build inside docker, pack_non_conda.py, build_all.py)
+writes a small json file that downstream stages read instead of scraping
+stdout:
+
+    {
+        "manifest_version": 1,
+        "stage": "pack-non-conda",
+        "artifacts": [
+            {
+                "path": "/.../non-conda-install/linux-64.ambertools-19.0-0.tar.bz2",
+                "filename": "linux-64.ambertools-19.0-0.tar.bz2",
+                "platform": "linux-64",
+                "pyver": null,
+                "size": 123456,
+                "sha256": "..."
+            }
+        ]
+    }
+
+size and sha256 are missing for artifacts that do not exist (dry run).
+
+Example (shell):
+
+    python build_manifest.py manifest.json --stage conda-build \\
+        --platform linux-64 amber-conda-bld/linux-64/*.tar.bz2
+"""
+import os
+import re
+import json
+import hashlib
+import argparse
+
+MANIFEST_VERSION = 1
+BLOCK_SIZE = 1 << 20
+
+
+def sha256sum(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def guess_pyver(fn):
+    ''' ambertools-17.0-py36_0.tar.bz2 -> 3.6 '''
+    match = re.search(r'py(\d)(\d+)', os.path.basename(fn))
+    return '{}.{}'.format(*match.groups()) if match else None
+
+
+def guess_platform(fn):
+    for platform in ['linux-64', 'osx-64']:
+        if platform in fn:
+            return platform
+    return None
+
+
+def artifact_entry(path, platform=None, pyver=None, checksum=True):
+    path = os.path.abspath(path)
+    entry = {
+        'path': path,
+        'filename': os.path.basename(path),
+        'platform': platform or guess_platform(path),
+        'pyver': pyver or guess_pyver(path),
+    }
+    if os.path.exists(path):
+        entry['size'] = os.path.getsize(path)
+        if checksum:
+            entry['sha256'] = sha256sum(path)
+    return entry
+
+
+def write_manifest(manifest_path, stage, artifacts):
+    ''' Write `artifacts` (list of dict from artifact_entry) to manifest_path '''
+    dirname = os.path.dirname(os.path.abspath(manifest_path))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    manifest = {
+        'manifest_version': MANIFEST_VERSION,
+        'stage': stage,
+        'artifacts': artifacts,
+    }
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(manifest, fh, indent=4, sort_keys=True)
+    os.rename(tmp, manifest_path)
+    return manifest
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path) as fh:
+        manifest = json.load(fh)
+    if manifest.get('manifest_version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version in {}'.format(
+            manifest_path))
+    return manifest
+
+
+def artifact_filenames(manifest_path):
+    return [
+        artifact['filename']
+        for artifact in read_manifest(manifest_path)['artifacts']
+    ]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Write a manifest for files produced by a build stage')
+    parser.add_argument('manifest')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--stage', required=True)
+    parser.add_argument('--platform', default=None)
+    parser.add_argument('--pyver', default=None)
+    parser.add_argument(
+        '--no-checksum',
+        action='store_true',
+        dest='no_checksum',
+        help='do not compute sha256')
+    opt = parser.parse_args(args)
+    artifacts = [
+        artifact_entry(
+            fn,
+            platform=opt.platform,
+            pyver=opt.pyver,
+            checksum=not opt.no_checksum) for fn in opt.files
+    ]
+    write_manifest(opt.manifest, opt.stage, artifacts)
+
+
+if __name__ == '__main__':
+    main()
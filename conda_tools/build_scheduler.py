@@ -0,0 +1,283 @@
+""" Run build jobs as a dependency graph.
+
+Each Job declares the artifacts it consumes (inputs) and produces (outputs).
+A job becomes ready once all jobs producing its inputs are done. The
+Scheduler starts every ready job that fits in the cpu/memory budget, so
+independent work (e.g. MacOS and Linux builds, packing of an already built
+tarfile) overlaps instead of running one step after another.
+
+Example:
+
+    jobs = [
+        Job('py27', ['conda', 'build', recipe, '--py', '2.7'], outputs=['at-py27']),
+        Job('pack', pack_function, inputs=['at-py27']),
+    ]
+    scheduler = Scheduler(jobs, cpus=32, memory=64000)
+    scheduler.run()
+    scheduler.report()
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+
+import build_trace
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def total_memory():
+    ''' Physical memory in MB (0 if unknown) '''
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') //
+                (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def free_disk_space(path):
+    ''' Bytes available to unprivileged users on the file system of `path` '''
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class TempSpaceBudget(object):
+    ''' Disk space (bytes) shared by concurrent workers
+
+    Example:
+
+        budget = TempSpaceBudget(free_disk_space(tempfile.gettempdir()))
+        with budget.reserve(10 * os.path.getsize(fn)):
+            untar_edit_and_retar(fn)
+    '''
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        ''' Wait until `nbytes` are free and hold them in the with block
+
+        A request larger than the whole budget waits until nothing else is
+        reserved and then runs alone.
+        '''
+        nbytes = min(nbytes, self.total)
+        with self._condition:
+            while self.used + nbytes > self.total:
+                self._condition.wait()
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= nbytes
+                self._condition.notify_all()
+
+
+class Job(object):
+    ''' A unit of work in the build graph
+
+    Parameters
+    ----------
+    name : str, unique job name
+    action : list of str (command) or callable
+        The return value of a callable is stored in `Job.result` so that
+        downstream jobs can use it (e.g. the path of a built tarfile).
+    inputs : sequence of str, artifacts this job needs
+    outputs : sequence of str, artifacts this job produces
+    cpus : int, number of cpus this job uses
+    memory : int, memory (MB) this job uses
+    '''
+
+    def __init__(self,
+                 name,
+                 action,
+                 inputs=(),
+                 outputs=(),
+                 cpus=1,
+                 memory=0):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cpus = cpus
+        self.memory = memory
+        self.result = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.
+        return self.end - self.start
+
+    def run(self, dry_run=False):
+        if callable(self.action):
+            return self.action()
+        if dry_run:
+            print(self.action)
+        else:
+            subprocess.check_call(self.action)
+
+    def __repr__(self):
+        return 'Job({})'.format(self.name)
+
+
+class Scheduler(object):
+    ''' Run `jobs` concurrently while respecting their dependencies
+
+    Parameters
+    ----------
+    jobs : list of Job
+    cpus : int, default cpu_count()
+    memory : int, MB, default: physical memory (no limit if unknown)
+    dry_run : bool, only print command jobs (callables are still called and
+        are expected to handle dry run themselves)
+    '''
+
+    def __init__(self, jobs, cpus=None, memory=None, dry_run=False):
+        self.jobs = list(jobs)
+        self.cpus = cpus or cpu_count()
+        self.memory = memory if memory is not None else total_memory()
+        self.dry_run = dry_run
+        self._by_name = {}
+        self._producers = {}
+        for job in self.jobs:
+            if job.name in self._by_name:
+                raise ValueError('Duplicate job name {}'.format(job.name))
+            self._by_name[job.name] = job
+            for artifact in job.outputs:
+                if artifact in self._producers:
+                    raise ValueError('{} is produced by both {} and {}'.format(
+                        artifact, self._producers[artifact].name, job.name))
+                self._producers[artifact] = job
+        for job in self.jobs:
+            for artifact in job.inputs:
+                if artifact not in self._producers:
+                    raise ValueError('{} requires {} but no job produces it'.
+                                     format(job.name, artifact))
+        # raise early if there is a cycle
+        self.order()
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def dependencies(self, job):
+        ''' names of jobs that must finish before `job` '''
+        return set(self._producers[artifact].name for artifact in job.inputs)
+
+    def order(self):
+        ''' jobs in topological order '''
+        ordered = []
+        done = set()
+        remaining = list(self.jobs)
+        while remaining:
+            ready = [
+                job for job in remaining if self.dependencies(job) <= done
+            ]
+            if not ready:
+                raise ValueError('Dependency cycle between {}'.format(
+                    [job.name for job in remaining]))
+            for job in ready:
+                ordered.append(job)
+                done.add(job.name)
+                remaining.remove(job)
+        return ordered
+
+    def _fits(self, job, used_cpus, used_memory, n_running):
+        if n_running == 0:
+            # a job bigger than the whole budget still runs, but alone.
+            return True
+        if used_cpus + job.cpus > self.cpus:
+            return False
+        if self.memory and used_memory + job.memory > self.memory:
+            return False
+        return True
+
+    def _run_job(self, job, results):
+        job.start = time.time()
+        try:
+            with build_trace.span(job.name, cpus=job.cpus):
+                job.result = job.run(dry_run=self.dry_run)
+            error = None
+        except BaseException as e:
+            error = e
+        job.end = time.time()
+        results.put((job, error))
+
+    def run(self):
+        pending = self.order()
+        done = set()
+        failed = []
+        running = set()
+        used_cpus = 0
+        used_memory = 0
+        results = queue.Queue()
+
+        while pending or running:
+            if not failed:
+                for job in list(pending):
+                    if (self.dependencies(job) <= done and self._fits(
+                            job, used_cpus, used_memory, len(running))):
+                        print('Starting job {}'.format(job.name))
+                        pending.remove(job)
+                        running.add(job.name)
+                        used_cpus += job.cpus
+                        used_memory += job.memory
+                        thread = threading.Thread(
+                            target=self._run_job, args=(job, results))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            job, error = results.get()
+            running.remove(job.name)
+            used_cpus -= job.cpus
+            used_memory -= job.memory
+            if error is None:
+                print('Finished job {} ({:.1f} s)'.format(
+                    job.name, job.duration))
+                done.add(job.name)
+            else:
+                print('FAILED job {}: {}'.format(job.name, error))
+                failed.append((job, error))
+
+        if failed:
+            raise RuntimeError('Failed jobs: {}'.format(', '.join(
+                job.name for job, _ in failed)))
+
+    def critical_path(self):
+        ''' The chain of jobs with the longest total duration '''
+        finish = {}
+        previous = {}
+        for job in self.order():
+            deps = self.dependencies(job)
+            before = max(deps, key=lambda name: finish[name]) if deps else None
+            finish[job.name] = job.duration + (finish[before] if before else 0.)
+            previous[job.name] = before
+        if not finish:
+            return []
+        name = max(finish, key=lambda name: finish[name])
+        path = []
+        while name is not None:
+            path.append(self._by_name[name])
+            name = previous[name]
+        return path[::-1]
+
+    def report(self, fh=sys.stdout):
+        fh.write('Job durations\n')
+        for job in self.jobs:
+            fh.write('    {:<50} {:10.1f} s\n'.format(job.name, job.duration))
+        path = self.critical_path()
+        fh.write('Critical path ({:.1f} s): {}\n'.format(
+            sum(job.duration for job in path),
+            ' -> '.join(job.name for job in path)))
@@ -0,0 +1,186 @@
+""" Hierarchical timing spans for the build pipeline.
+
+Spans are only recorded if $AMBER_TRACE_DIR is set:
+
+    with build_trace.span('configure'):
+        utils.run_configure()
+
+    @build_trace.traced()
+    def make_install(ncpus=4):
+        ...
+
+Every process (build_all.py, the conda build scripts, pack_non_conda.py, ...)
+writes its spans to a new $AMBER_TRACE_DIR/trace-{pid}-*.json when it exits
+(pids get reused, so files of other runs are never appended to). `merge`
+combines them into a Chrome trace (chrome://tracing, https://ui.perfetto.dev)
+and a text summary of the slowest spans:
+
+    python build_trace.py $AMBER_TRACE_DIR
+"""
+import os
+import sys
+import json
+import time
+import glob
+import atexit
+import tempfile
+import argparse
+import threading
+import functools
+from contextlib import contextmanager
+
+TRACE_FILE = 'trace.json'
+SUMMARY_FILE = 'summary.txt'
+
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+_state = {'registered': False}
+
+
+def trace_dir():
+    return os.getenv('AMBER_TRACE_DIR')
+
+
+def _now():
+    # microseconds, as Chrome trace expects
+    return int(time.time() * 1e6)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def span(name, **args):
+    ''' Record the duration of the `with` block as `name` '''
+    if not trace_dir():
+        yield
+        return
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    start = _now()
+    try:
+        yield
+    finally:
+        end = _now()
+        stack.pop()
+        args.update(parent=parent, depth=len(stack))
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': start,
+            'dur': end - start,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with _lock:
+            _events.append(event)
+            if not _state['registered']:
+                atexit.register(flush)
+                _state['registered'] = True
+
+
+def traced(name=None):
+    ''' Decorator: record each call of the function as a span '''
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def flush():
+    ''' Write spans of this process to a new $AMBER_TRACE_DIR/trace-{pid}-*.json
+    file '''
+    directory = trace_dir()
+    with _lock:
+        events = _events[:]
+        del _events[:]
+    if not directory or not events:
+        return
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    events.append({
+        'name': 'process_name',
+        'ph': 'M',
+        'pid': os.getpid(),
+        'args': {
+            'name': ' '.join(os.path.basename(arg) for arg in sys.argv)[:100]
+        },
+    })
+    # a process can flush more than once: one file per flush
+    fd, _ = tempfile.mkstemp(
+        prefix='trace-{}-'.format(os.getpid()), suffix='.json', dir=directory)
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(events, fh)
+
+
+def clean(directory):
+    ''' Remove per-process trace files from a previous run '''
+    for fn in glob.glob(os.path.join(directory, 'trace-*.json')):
+        os.remove(fn)
+
+
+def summary(events, top=20):
+    spans = [event for event in events if event.get('ph') == 'X']
+    process_names = dict((event['pid'], event['args']['name'])
+                         for event in events if event.get('ph') == 'M')
+    lines = ['Slowest spans']
+    for event in sorted(spans, key=lambda event: -event['dur'])[:top]:
+        lines.append('    {:10.1f} s  {}{}  [{}]'.format(
+            event['dur'] / 1e6, '  ' * event['args'].get('depth', 0),
+            event['name'], process_names.get(event['pid'], event['pid'])))
+
+    totals = {}
+    for event in spans:
+        count, total = totals.get(event['name'], (0, 0))
+        totals[event['name']] = (count + 1, total + event['dur'])
+    lines.append('Total time per span name')
+    for name, (count, total) in sorted(
+            totals.items(), key=lambda item: -item[1][1])[:top]:
+        lines.append('    {:10.1f} s  {} (x{})'.format(total / 1e6, name,
+                                                        count))
+    return '\n'.join(lines) + '\n'
+
+
+def merge(directory, top=20):
+    ''' Merge trace-*.json in `directory` into trace.json and summary.txt
+
+    Returns the summary text.
+    '''
+    events = []
+    for fn in sorted(glob.glob(os.path.join(directory, 'trace-*.json'))):
+        with open(fn) as fh:
+            events.extend(json.load(fh))
+    with open(os.path.join(directory, TRACE_FILE), 'w') as fh:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+    text = summary(events, top=top)
+    with open(os.path.join(directory, SUMMARY_FILE), 'w') as fh:
+        fh.write(text)
+    return text
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Merge build traces into {} and {}'.format(
+            TRACE_FILE, SUMMARY_FILE))
+    parser.add_argument('trace_dir')
+    parser.add_argument('--top', type=int, default=20)
+    opt = parser.parse_args(args)
+    print(merge(opt.trace_dir, top=opt.top))
+
+
+if __name__ == '__main__':
+    main()
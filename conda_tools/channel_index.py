@@ -0,0 +1,155 @@
+""" Incremental repodata.json for local channels (e.g. amber-conda-bld).
+
+For each subdir (linux-64, osx-64, ...) the index.json, size, md5 and sha256
+of every package are kept in {subdir}/.index_cache.json, keyed on the package
+size and mtime. Only new or changed packages are opened on the next run.
+
+Writes {subdir}/repodata.json and repodata.json.bz2, and an empty
+noarch/repodata.json if there is none, so the folder can be used as a
+channel:
+
+    python channel_index.py amber-conda-bld
+    conda install -c file://$PWD/amber-conda-bld ambertools
+"""
+import os
+import bz2
+import json
+import hashlib
+import tarfile
+import argparse
+
+import package_info
+
+CACHE_FILE = '.index_cache.json'
+REPODATA = 'repodata.json'
+SUBDIRS = ['linux-64', 'osx-64', 'noarch']
+BLOCK_SIZE = 1 << 20
+
+
+def checksums(fn):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(fn, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            md5.update(block)
+            sha256.update(block)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def package_record(fn):
+    ''' repodata entry: index.json + size, md5, sha256 '''
+    record = package_info.scan_index_json(fn)
+    record['size'] = os.path.getsize(fn)
+    record['md5'], record['sha256'] = checksums(fn)
+    return record
+
+
+def _load_cache(fn):
+    try:
+        with open(fn) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write(fn, content):
+    tmp = fn + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(content)
+    os.rename(tmp, fn)
+
+
+def index_subdir(subdir_dir, verbose=False):
+    ''' Write repodata.json for the packages in `subdir_dir`
+
+    Returns
+    -------
+    (repodata, number of packages read)
+    '''
+    subdir = os.path.basename(os.path.normpath(subdir_dir))
+    cache_fn = os.path.join(subdir_dir, CACHE_FILE)
+    cache = _load_cache(cache_fn)
+    new_cache = {}
+    repodata = {
+        'info': {
+            'subdir': subdir
+        },
+        'packages': {},
+        'packages.conda': {},
+        'removed': [],
+        'repodata_version': 1,
+    }
+    n_read = 0
+    for name in sorted(os.listdir(subdir_dir)):
+        if name.endswith('.tar.bz2'):
+            key = 'packages'
+        elif name.endswith('.conda'):
+            key = 'packages.conda'
+        else:
+            continue
+        fn = os.path.join(subdir_dir, name)
+        st = os.stat(fn)
+        stamp = [st.st_size, st.st_mtime]
+        cached = cache.get(name)
+        if cached is not None and cached['stamp'] == stamp:
+            record = cached['record']
+        else:
+            try:
+                record = package_record(fn)
+            except (KeyError, ValueError, tarfile.TarError) as e:
+                print('WARNING: skip {}: {}'.format(fn, e))
+                continue
+            n_read += 1
+            if verbose:
+                print('Indexed {}'.format(fn))
+        new_cache[name] = {'stamp': stamp, 'record': record}
+        repodata[key][name] = record
+
+    content = json.dumps(repodata, indent=2, sort_keys=True).encode()
+    _write(os.path.join(subdir_dir, REPODATA), content)
+    _write(os.path.join(subdir_dir, REPODATA + '.bz2'), bz2.compress(content))
+    _write(cache_fn, json.dumps(new_cache).encode())
+    return repodata, n_read
+
+
+def index_channel(channel_dir, subdirs=None, verbose=False):
+    ''' Index `subdirs` (default: existing linux-64, osx-64, noarch) '''
+    if subdirs is None:
+        subdirs = [
+            subdir for subdir in SUBDIRS
+            if os.path.isdir(os.path.join(channel_dir, subdir))
+        ]
+    noarch = os.path.join(channel_dir, 'noarch')
+    if not os.path.exists(os.path.join(noarch, REPODATA)):
+        # conda needs noarch in every channel
+        if not os.path.exists(noarch):
+            os.makedirs(noarch)
+        if 'noarch' not in subdirs:
+            subdirs = list(subdirs) + ['noarch']
+    results = {}
+    for subdir in subdirs:
+        repodata, n_read = index_subdir(
+            os.path.join(channel_dir, subdir), verbose=verbose)
+        n_packages = len(repodata['packages']) + len(
+            repodata['packages.conda'])
+        print('{}: {} packages, {} read'.format(subdir, n_packages, n_read))
+        results[subdir] = repodata
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Write repodata.json for a local channel')
+    parser.add_argument('channel_dir')
+    parser.add_argument(
+        '--subdir',
+        action='append',
+        default=None,
+        help='subdir to index (repeatable). Default: linux-64, osx-64, noarch')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    opt = parser.parse_args(args)
+    index_channel(opt.channel_dir, subdirs=opt.subdir, verbose=opt.verbose)
+
+
+if __name__ == '__main__':
+    main()
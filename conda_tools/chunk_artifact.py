@@ -0,0 +1,184 @@
+""" Split a file in chunks (like `split -b`) and write a checksummed manifest.
+
+    python chunk_artifact.py split amber18.tar.gz --prefix tmp_linux-64_AT \\
+        --platform linux-64
+
+writes tmp_linux-64_ATaa, tmp_linux-64_ATab, ... (the names of `split`) and
+tmp_linux-64_AT.manifest.json, a build_manifest file with one artifact:
+
+    {
+        "filename": "amber18.tar.gz",
+        "platform": "linux-64",
+        "size": ..., "sha256": ...,
+        "chunk_size": 40000000,
+        "chunks": [
+            {"filename": "tmp_linux-64_ATaa", "size": ..., "sha256": ...},
+            ...
+        ]
+    }
+
+The file is read once; chunk and file hashes are computed while writing.
+Downloaders (download_binary_at_dev.py) fetch the manifest first, then the
+chunks it lists, and check each of them.
+
+    python chunk_artifact.py join tmp_linux-64_AT.manifest.json -o amber18.tar.gz
+"""
+import os
+import string
+import hashlib
+import argparse
+import itertools
+
+import build_manifest
+
+CHUNK_SIZE = 40000000
+SUFFIX_LENGTH = 2
+MANIFEST_SUFFIX = '.manifest.json'
+STAGE = 'chunk'
+BLOCK_SIZE = 1 << 20
+
+
+def manifest_name(prefix):
+    return prefix + MANIFEST_SUFFIX
+
+
+def chunk_names(prefix, suffix_length=SUFFIX_LENGTH):
+    ''' prefix + aa, ab, ... (as `split`) '''
+    for letters in itertools.product(
+            string.ascii_lowercase, repeat=suffix_length):
+        yield prefix + ''.join(letters)
+
+
+def split_file(fn,
+               prefix,
+               chunk_size=CHUNK_SIZE,
+               platform=None,
+               manifest=None):
+    ''' Write `fn` in chunks of `chunk_size` bytes named {prefix}aa, ... and
+    the manifest (default: {prefix}.manifest.json). Return the artifact
+    entry of the manifest. '''
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+    manifest = manifest or manifest_name(prefix)
+    names = chunk_names(prefix)
+    file_hash = hashlib.sha256()
+    chunks = []
+    size = 0
+    with open(fn, 'rb') as fh:
+        while True:
+            chunk_fn = None
+            chunk_hash = hashlib.sha256()
+            chunk_written = 0
+            fh_out = None
+            try:
+                while chunk_written < chunk_size:
+                    block = fh.read(min(BLOCK_SIZE, chunk_size - chunk_written))
+                    if not block:
+                        break
+                    if fh_out is None:
+                        try:
+                            chunk_fn = next(names)
+                        except StopIteration:
+                            raise ValueError(
+                                'Too many chunks, use a larger chunk size')
+                        fh_out = open(chunk_fn, 'wb')
+                    fh_out.write(block)
+                    chunk_hash.update(block)
+                    file_hash.update(block)
+                    chunk_written += len(block)
+            finally:
+                if fh_out is not None:
+                    fh_out.close()
+            if fh_out is None:
+                break
+            size += chunk_written
+            chunks.append({
+                'filename': os.path.basename(chunk_fn),
+                'size': chunk_written,
+                'sha256': chunk_hash.hexdigest()
+            })
+
+    entry = build_manifest.artifact_entry(fn, platform=platform, checksum=False)
+    # the manifest is published with the chunks: no build machine path
+    del entry['path']
+    entry.update(
+        size=size,
+        sha256=file_hash.hexdigest(),
+        chunk_size=chunk_size,
+        chunks=chunks)
+    build_manifest.write_manifest(manifest, STAGE, [entry])
+    return entry
+
+
+def read_chunk_manifest(manifest):
+    return build_manifest.read_manifest(manifest)['artifacts'][0]
+
+
+def verify_chunk(fn, chunk):
+    ''' True if the file `fn` matches the manifest entry `chunk` '''
+    return (os.path.isfile(fn) and os.path.getsize(fn) == chunk['size']
+            and build_manifest.sha256sum(fn) == chunk['sha256'])
+
+
+def join_chunks(manifest, output_fn, chunk_dir=None):
+    ''' Check and concatenate the chunks listed in `manifest` '''
+    entry = read_chunk_manifest(manifest)
+    chunk_dir = chunk_dir or os.path.dirname(os.path.abspath(manifest))
+    file_hash = hashlib.sha256()
+    with open(output_fn, 'wb') as fh_out:
+        for chunk in entry['chunks']:
+            fn = os.path.join(chunk_dir, chunk['filename'])
+            if not verify_chunk(fn, chunk):
+                raise ValueError('{} does not match {}'.format(fn, manifest))
+            with open(fn, 'rb') as fh:
+                for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+                    file_hash.update(block)
+                    fh_out.write(block)
+    if file_hash.hexdigest() != entry['sha256']:
+        raise ValueError('{} does not match {}'.format(output_fn, manifest))
+    return output_fn
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Split a file in checksummed chunks, or join them')
+    subparsers = parser.add_subparsers(dest='command')
+    split_parser = subparsers.add_parser('split')
+    split_parser.add_argument('file')
+    split_parser.add_argument(
+        '--prefix', required=True, help='chunk names: {prefix}aa, ...')
+    split_parser.add_argument(
+        '-b',
+        '--chunk-size',
+        type=int,
+        default=CHUNK_SIZE,
+        dest='chunk_size',
+        help='bytes per chunk. Default: {}'.format(CHUNK_SIZE))
+    split_parser.add_argument(
+        '--platform', default=None, help='linux-64 or osx-64')
+    split_parser.add_argument(
+        '--manifest',
+        default=None,
+        help='Default: {prefix}' + MANIFEST_SUFFIX)
+    join_parser = subparsers.add_parser('join')
+    join_parser.add_argument('manifest')
+    join_parser.add_argument('-o', '--output', required=True)
+    opt = parser.parse_args(args)
+
+    if opt.command == 'split':
+        entry = split_file(
+            opt.file,
+            opt.prefix,
+            chunk_size=opt.chunk_size,
+            platform=opt.platform,
+            manifest=opt.manifest)
+        for chunk in entry['chunks']:
+            print(chunk['filename'])
+    elif opt.command == 'join':
+        print(join_chunks(opt.manifest, opt.output))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
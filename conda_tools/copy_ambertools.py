@@ -1,13 +1,22 @@
 #!/usr/bin/env python
 import os
-import subprocess
+import re
 from glob import glob
 
+import build_trace
+import copy_engine
+
 extra_folders_or_files = ['AmberTools/test/dacdif']
+# rules (see compile_rules), relative to AMBER_SRC
 excluded_folders = [
     '../../../test', 'AmberTools/test', 'AmberTools/examples',
     'AmberTools/benchmark'
 ]
+# persistent folder: only changed files are copied there from AMBER_SRC
+STAGING_ENV = 'AMBER_STAGING_DIR'
+# how the work dir is filled from the source (or the staging dir)
+STAGING_MODE_ENV = 'AMBER_STAGING_MODE'
+STAGING_MODES = ['copy', 'hardlink', 'symlink']
 
 this_path = os.path.abspath(os.path.dirname(__file__))
 
@@ -22,18 +31,143 @@ def mkdir_ambertree():
             pass
 
 
-def _having_one_of_them(name, word_set):
-    for word in word_set:
-        if word in name:
-            return True
-    return False
-
-
-def _copy_folder(source_dir, target_dir):
-    subprocess.call(['cp', '-r', source_dir, target_dir])
+def _glob_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        else:
+            regex += {
+                '*': '[^/]*',
+                '?': '[^/]'
+            }.get(pattern[i], re.escape(pattern[i]))
+            i += 1
+    return regex
+
+
+def compile_rules(rules):
+    ''' Return a function telling if a path (relative to AMBER_SRC) is
+    excluded by `rules`, as in .gitignore:
+
+        AmberTools/benchmark   anchored (has a '/'): this folder and its content
+        *.o                    unanchored: at any level
+        **/test                ** matches any folders; * and ? do not match '/'
+        !AmberTools/test/x     negation: included again
+
+    The last matching rule wins; nothing is excluded by default.
+    '''
+    compiled = []
+    for rule in rules:
+        negate = rule.startswith('!')
+        pattern = rule[1:] if negate else rule
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            regex = _glob_to_regex(pattern.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + _glob_to_regex(pattern)
+        compiled.append((re.compile(regex + '(?:/.*)?$'), negate))
+    compiled.reverse()
+
+    def excluded(path):
+        path = path.replace(os.sep, '/')
+        if path.startswith('./'):
+            path = path[2:]
+        for regex, negate in compiled:
+            if regex.match(path):
+                return not negate
+        return False
+
+    return excluded
+
+
+def release_rules():
+    ''' excluded_folders, with extra_folders_or_files included again '''
+    return excluded_folders + ['!' + folder for folder in extra_folders_or_files]
+
+
+def parse_mkrelease_at(mkrelease_at_file, amberhome, excluded=None):
+    ''' (source pattern, target folder) for each folder listed in a $TAR line
+    of mkrelease_at, without those for which excluded(path relative to
+    amberhome) is True (default: release_rules) '''
+    if excluded is None:
+        excluded = compile_rules(release_rules())
+    sources = []
+    with open(mkrelease_at_file) as fh:
+        for line in fh.readlines():
+            line = line.strip()
+            if line.startswith('$TAR'):
+                folder_or_folders = line.split('/')[-1]
+                if '{' in folder_or_folders:
+                    # list of folders
+                    # {x,y,z}
+                    folders = folder_or_folders.replace('{', '').replace(
+                        '}', '').split(',')
+                else:
+                    # single folder
+                    folders = [
+                        folder_or_folders,
+                    ]
+                root_dir = '/'.join(line.split('/')[1:-1])
+
+                for folder in folders:
+                    if not root_dir:
+                        source_dir = os.path.join(amberhome, folder)
+                        target_dir = '.'
+                    else:
+                        source_dir = os.path.join(amberhome, root_dir, folder)
+                        target_dir = root_dir
+                    if not excluded(os.path.join(root_dir, folder)):
+                        sources.append((source_dir, target_dir))
+    return sources
 
 
-def copy_tree(dry_run=False):
+def staging_sources(amberhome, excluded=None):
+    ''' (source pattern, target folder) pairs to copy to the work dir, in
+    order: from mkrelease_at (development version) or all of amberhome '''
+    mkrelease_at_file = os.path.join(amberhome, 'mkrelease_at')
+    if os.path.exists(mkrelease_at_file):
+        return [(os.path.join(amberhome, folder),
+                 os.path.join('AmberTools', 'src'))
+                for folder in extra_folders_or_files] + parse_mkrelease_at(
+                    mkrelease_at_file, amberhome, excluded)
+    return [(fn, '.') for fn in glob(amberhome + '/*')]
+
+
+def _files(sources):
+    return [(fn, target_dir) for source_dir, target_dir in sources
+            for fn in glob(source_dir)]
+
+
+def stage(sources, staging_dir, ignore=None):
+    ''' Sync the files of `sources` to `staging_dir` (copy_engine.sync) '''
+    with build_trace.span('stage', staging_dir=staging_dir):
+        stats = copy_engine.sync(_files(sources), staging_dir, ignore=ignore)
+    print('Staging {}: {copied} copied, {unchanged} unchanged, '
+          '{removed} removed'.format(staging_dir, **stats))
+    return stats
+
+
+@build_trace.traced()
+def copy_tree(dry_run=False, staging_dir=None, mode=None):
+    ''' Copy the AmberTools source ($AMBER_SRC) to the current folder
+
+    With `staging_dir` (default: $AMBER_STAGING_DIR), the source is first
+    synced to that folder (only changed files are copied), then copied from
+    there. Builds sharing the staging dir wait for each other while it is
+    synced. Note: in 'copy' mode the whole tree is still copied from the
+    staging dir (cheap only where reflinks work, e.g. btrfs, xfs, APFS); use
+    a link mode to skip that.
+
+    `mode` (default: $AMBER_STAGING_MODE or 'copy'): 'hardlink' or 'symlink'
+    to link the files of the source (or of the staging dir) rather than copy
+    them. The build must then not edit them in place (replacing them is
+    fine).
+    '''
     # use mkrelease_at as a file source
     recipe_dir = os.getenv('RECIPE_DIR',
                            os.path.join(this_path, '../conda-ambertools-single-python'))
@@ -46,70 +180,43 @@ def copy_tree(dry_run=False):
     assert os.path.exists(amberhome)
     assert os.path.exists(os.path.join(amberhome, 'AmberTools'))
 
+    mode = mode or os.getenv(STAGING_MODE_ENV) or 'copy'
+    if mode not in STAGING_MODES:
+        raise ValueError('Unknown staging mode {}, expected one of {}'.format(
+            mode, STAGING_MODES))
+    link = False if mode == 'copy' else mode
+
     mkrelease_at_file = os.path.join(amberhome, 'mkrelease_at')
     if os.path.exists(mkrelease_at_file):
         mkdir_ambertree()
-        # development version
-        extra_dirs = [
-            os.path.join(amberhome, folder)
-            for folder in extra_folders_or_files
-        ]
-
-        for source_dir in extra_dirs:
-            target_dir = os.path.join('AmberTools', 'src')
-            print('copying {} to {}'.format(source_dir, target_dir))
-            if not dry_run:
-                _copy_folder(source_dir, target_dir)
-
-        with open(mkrelease_at_file) as fh:
-            for line in fh.readlines():
-                line = line.strip()
-                if line.startswith('$TAR'):
-                    folder_or_folders = line.split('/')[-1]
-                    if '{' in folder_or_folders:
-                        # list of folders
-                        # {x,y,z}
-                        folders = folder_or_folders.replace('{', '').replace(
-                            '}', '').split(',')
-                    else:
-                        # single folder
-                        folders = [
-                            folder_or_folders,
-                        ]
-                    root_dir = '/'.join(line.split('/')[1:-1])
-
-                    for folder in folders:
-                        if not root_dir:
-                            source_dir = os.path.join(amberhome, folder)
-                            target_dir = '.'
-                        else:
-                            source_dir = os.path.join(amberhome, root_dir,
-                                                      folder)
-                            target_dir = root_dir
-                        if not _having_one_of_them(source_dir,
-                                                   excluded_folders):
-                            files = glob(source_dir)
-                            print('copying {} to {}'.format(
-                                source_dir, target_dir))
-                            if not os.path.exists(source_dir):
-                                print(
-                                    'WARNING NOT FOUND: {}'.format(source_dir))
-                            if not os.path.exists(target_dir):
-                                print('WARNING NOT FOUND target_dir: {}'.
-                                      format(target_dir))
-                            assert os.path.exists(target_dir)
-                            if not dry_run:
-                                for fn in files:
-                                    _copy_folder(fn, target_dir)
+        excluded = compile_rules(release_rules())
+
+        def ignore(path):
+            return excluded(os.path.relpath(path, amberhome))
     else:
         print(
             "not having mkrelease_at in AMBERHOME={}, assume this is a released version".
             format(amberhome))
-        for fn in glob(amberhome + '/*'):
-            cmd = ['cp', '-r', fn, '.']
-            print(' '.join(cmd))
-            if not dry_run:
-                _copy_folder(fn, '.')
+        excluded = ignore = None
+    sources = staging_sources(amberhome, excluded)
+
+    staging_dir = staging_dir or os.getenv(STAGING_ENV)
+    if staging_dir and not dry_run:
+        stage(sources, staging_dir, ignore)
+        # other builds may copy out of it at the same time, not sync it
+        with copy_engine.reading(staging_dir):
+            copy_engine.copy_tree(staging_dir, '.', link=link)
+        return
+    for source_dir, target_dir in sources:
+        print('copying {} to {}'.format(source_dir, target_dir))
+        if not os.path.exists(source_dir):
+            print('WARNING NOT FOUND: {}'.format(source_dir))
+        if not os.path.exists(target_dir):
+            print('WARNING NOT FOUND target_dir: {}'.format(target_dir))
+        assert os.path.exists(target_dir)
+    if not dry_run:
+        # not cp -r: the rules also apply to nested paths, as when staging
+        copy_engine.copy_sources(_files(sources), '.', link=link, ignore=ignore)
 
 
 def main():
@@ -1,9 +1,12 @@
 import os
 import sys
 import shutil
-from glob import iglob
 
 import utils
+import build_trace
+import copy_engine
+
+COPY_MANIFEST = 'copy_to_prefix.json'
 
 
 def force_mkdir(src):
@@ -13,12 +16,20 @@ def force_mkdir(src):
         pass
 
 
+@build_trace.traced()
 def copytree_here(src, dest):
-    pattern = src + '/*'
-    for fn in iglob(pattern):
-        cmd = 'cp -rf {} {}'.format(fn, dest)
-        print('cmd: ', cmd)
-        utils.sh(cmd)
+    ''' Copy the content of `src` into `dest`, return the copied entries
+    (see copy_engine.copy_tree) '''
+    print('copy: {} -> {}'.format(src, dest))
+    return copy_engine.copy_tree(src, dest)
+
+
+def _in_folder(entries, folder):
+    ''' copy_tree entries with paths relative to the prefix '''
+    return [
+        dict(entry, path=os.path.join(folder, entry['path']))
+        for entry in entries
+    ]
 
 
 def write_amber_sh(recipe_dir, prefix, pyver):
@@ -30,6 +41,7 @@ def write_amber_sh(recipe_dir, prefix, pyver):
     utils.sh('chmod +x {}/amber.sh'.format(prefix))
 
 
+@build_trace.traced()
 def copy_to_prefix(amberhome, prefix):
     recipe_dir = os.getenv('RECIPE_DIR')
     prefix_bin = os.path.join(prefix, 'bin/')
@@ -60,8 +72,13 @@ def copy_to_prefix(amberhome, prefix):
     except OSError:
         pass
 
+    copied = []
+
     # bin
-    copytree_here(os.path.join(amberhome, 'bin'), prefix_bin)
+    copied.extend(
+        _in_folder(
+            copytree_here(os.path.join(amberhome, 'bin'), prefix_bin),
+            'bin'))
 
     configure_python = os.path.join(amberhome, 'AmberTools', 'src',
                                     'configure_python')
@@ -76,13 +93,30 @@ def copy_to_prefix(amberhome, prefix):
         prefix_bin)
 
     # Lib
-    copytree_here(os.path.join(amberhome, 'lib'), prefix_lib)
+    copied.extend(
+        _in_folder(
+            copytree_here(os.path.join(amberhome, 'lib'), prefix_lib),
+            'lib'))
 
     # include
-    copytree_here(os.path.join(amberhome, 'include'), prefix_include)
+    copied.extend(
+        _in_folder(
+            copytree_here(os.path.join(amberhome, 'include'), prefix_include),
+            'include'))
 
     # include
-    copytree_here(os.path.join(amberhome, 'dat'), prefix_dat)
+    copied.extend(
+        _in_folder(
+            copytree_here(os.path.join(amberhome, 'dat'), prefix_dat),
+            'dat'))
+
+    for method, (n_files, size) in sorted(
+            copy_engine.summary(copied).items()):
+        print('copied {} files ({:.1f} MB) with {}'.format(
+            n_files, size / (1024. * 1024.), method))
+    # what was copied (paths relative to prefix), next to the build tree
+    # (not in the package)
+    copy_engine.write_manifest(os.path.join(amberhome, COPY_MANIFEST), copied)
 
     pyver = '.'.join(str(x) for x in sys.version_info[:2])
     write_amber_sh(recipe_dir, prefix, pyver)
@@ -0,0 +1,438 @@
+""" Copy folder trees with a thread pool, without forking `cp`.
+
+Each file is copied with the cheapest method that works:
+
+    hardlink         only if asked for (link='hardlink' or True) and on the
+                     same filesystem; later edits of the copy also change the
+                     source
+    symlink          only if asked for (link='symlink'): absolute symlink to
+                     the source (symlink farm); same caveat
+    reflink          copy-on-write clone (btrfs, xfs, APFS)
+    copy_file_range  in-kernel copy (Linux, Python >= 3.8)
+    copy             shutil.copyfile
+
+Modes are kept; symlinks are copied as symlinks (as `cp -r`). Errors are
+raised.
+
+Example:
+
+    entries = copy_engine.copy_tree('amber18/bin', os.environ['PREFIX'] + '/bin')
+    copy_engine.write_manifest('copy.json', entries)
+
+    # only files changed since the last call (size and mtime, then content)
+    copy_engine.sync([('amber/AmberTools', '.'), ('amber/dat', '.')], 'staging')
+    with copy_engine.reading('staging'):
+        copy_engine.copy_tree('staging', 'work')
+
+    # as `cp -r amber/AmberTools amber/dat work`, with a symlink farm
+    copy_engine.copy_sources([('amber/AmberTools', '.'), ('amber/dat', '.')],
+                             'work', link='symlink')
+"""
+import os
+import sys
+import json
+import stat
+import errno
+import shutil
+import fcntl
+import hashlib
+import argparse
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+METHODS = ['hardlink', 'symlink', 'reflink', 'copy_file_range', 'copy']
+# linux/fs.h
+FICLONE = 0x40049409
+
+SYNC_MANIFEST_SUFFIX = '.manifest.json'
+SYNC_LOCK_SUFFIX = '.lock'
+BLOCK_SIZE = 1 << 20
+
+# methods that failed once (e.g. not supported by the filesystem)
+_unsupported = set()
+
+
+def _reflink(src, dst):
+    if sys.platform.startswith('darwin'):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(src.encode(), dst.encode(), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return
+    with open(src, 'rb') as fh, open(dst, 'wb') as fh_out:
+        fcntl.ioctl(fh_out.fileno(), FICLONE, fh.fileno())
+
+
+def _copy_file_range(src, dst):
+    with open(src, 'rb') as fh, open(dst, 'wb') as fh_out:
+        remaining = os.fstat(fh.fileno()).st_size
+        while remaining > 0:
+            n_bytes = os.copy_file_range(fh.fileno(), fh_out.fileno(),
+                                         remaining)
+            if n_bytes == 0:
+                break
+            remaining -= n_bytes
+
+
+def _remove(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+
+
+def copy_file(src, dst, link=False):
+    ''' Copy the regular file `src` to `dst` (replaced if it exists), keep its
+    mode. `link`: 'hardlink' (or True) or 'symlink' to link rather than copy.
+    Return the method used. '''
+    _remove(dst)
+    if link == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+    if link:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            # e.g. other filesystem
+            pass
+    for method, function in [('reflink', _reflink),
+                             ('copy_file_range', _copy_file_range)]:
+        if method in _unsupported or (method == 'copy_file_range'
+                                      and not hasattr(os, 'copy_file_range')):
+            continue
+        try:
+            function(src, dst)
+            break
+        except (OSError, IOError) as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                               errno.EINVAL, errno.ENOSYS,
+                               errno.ENOTSUP):
+                raise
+            _unsupported.add(method)
+            _remove(dst)
+    else:
+        method = 'copy'
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return method
+
+
+def _walk(src, dst, ignore=None):
+    ''' (folders, [(kind, source, destination, relative path)]) under src,
+    without the paths for which ignore(source path) is True '''
+    dirs = [dst]
+    items = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        dst_dir = os.path.normpath(os.path.join(dst, rel_dir))
+        if ignore is not None:
+            dirnames[:] = [
+                name for name in dirnames
+                if not ignore(os.path.join(dirpath, name))
+            ]
+            filenames = [
+                name for name in filenames
+                if not ignore(os.path.join(dirpath, name))
+            ]
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                # as cp -r: copy the link, do not follow it
+                dirnames.remove(name)
+                filenames.append(name)
+            else:
+                dirs.append(os.path.join(dst_dir, name))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            kind = 'symlink' if os.path.islink(path) else 'file'
+            items.append((kind, path, os.path.join(dst_dir, name),
+                          os.path.normpath(os.path.join(rel_dir, name))))
+    return dirs, items
+
+
+def _copy_item(item, link):
+    kind, src, dst, rel = item
+    if kind == 'symlink':
+        _remove(dst)
+        os.symlink(os.readlink(src), dst)
+        return {'path': rel, 'type': kind, 'method': 'symlink'}
+    method = copy_file(src, dst, link=link)
+    return {
+        'path': rel,
+        'type': kind,
+        'size': os.path.getsize(dst),
+        'method': method
+    }
+
+
+def _copy_items(items, link, jobs):
+    if not items:
+        return []
+    pool = ThreadPool(min(jobs or cpu_count(), len(items)))
+    try:
+        return pool.map(lambda item: _copy_item(item, link), items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def copy_tree(src, dst, jobs=None, link=False, ignore=None):
+    ''' Copy the content of folder `src` into `dst` (as `cp -rf src/* dst`).
+    Nothing is done if `src` does not exist. `link`: see copy_file. Paths
+    for which ignore(source path) is True are skipped.
+
+    Returns
+    -------
+    list of dict, one per copied file or symlink: path (relative to dst),
+    type, size, method
+    '''
+    if not os.path.isdir(src):
+        return []
+    dirs, items = _walk(src, dst, ignore)
+    for path in dirs:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    if link in (True, 'hardlink') and os.stat(src).st_dev != os.stat(
+            dst).st_dev:
+        link = False
+    if not items:
+        return []
+    entries = _copy_items(items, link, jobs)
+    # folder modes, once their content is written
+    for path in dirs[1:]:
+        rel = os.path.relpath(path, dst)
+        mode = stat.S_IMODE(os.stat(os.path.join(src, rel)).st_mode)
+        os.chmod(path, mode)
+    return entries
+
+
+def _same_content(fn1, fn2):
+    hashes = []
+    for fn in [fn1, fn2]:
+        sha256 = hashlib.sha256()
+        with open(fn, 'rb') as fh:
+            for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+                sha256.update(block)
+        hashes.append(sha256.hexdigest())
+    return hashes[0] == hashes[1]
+
+
+def _source_entries(sources, ignore=None):
+    ''' {path in dest: (source path, lstat)} for `sources`, a list of
+    (file or folder, folder in dest), as `cp -r source folder` '''
+    entries = {}
+    for src, target in sources:
+        base = os.path.normpath(os.path.join(target, os.path.basename(src)))
+        entries[base] = (src, os.lstat(src))
+        if os.path.isdir(src) and not os.path.islink(src):
+            for dirpath, dirnames, filenames in os.walk(src):
+                rel_dir = os.path.normpath(
+                    os.path.join(base, os.path.relpath(dirpath, src)))
+                if ignore is not None:
+                    dirnames[:] = [
+                        name for name in dirnames
+                        if not ignore(os.path.join(dirpath, name))
+                    ]
+                    filenames = [
+                        name for name in filenames
+                        if not ignore(os.path.join(dirpath, name))
+                    ]
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    entries[os.path.join(rel_dir, name)] = (path,
+                                                            os.lstat(path))
+    return entries
+
+
+def _load_json(fn):
+    try:
+        with open(fn) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def copy_sources(sources, dest, jobs=None, link=False, ignore=None):
+    ''' Copy `sources` (list of (file or folder, folder in dest)) into
+    `dest`, as `cp -r source dest/folder` for each. `link` and `ignore`: see
+    copy_tree.
+
+    Returns
+    -------
+    list of dict, as copy_tree
+    '''
+    items = []
+    for src, target in sources:
+        if not os.path.isdir(os.path.join(dest, target)):
+            os.makedirs(os.path.join(dest, target))
+    entries = _source_entries(sources, ignore)
+    for rel in sorted(entries):
+        src, st = entries[rel]
+        dst = os.path.join(dest, rel)
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(dst):
+                os.makedirs(dst)
+        else:
+            kind = 'symlink' if stat.S_ISLNK(st.st_mode) else 'file'
+            items.append((kind, src, dst, rel))
+    return _copy_items(items, link, jobs)
+
+
+@contextmanager
+def _locked(dest, operation):
+    dest = os.path.abspath(dest)
+    if not os.path.isdir(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+    with open(dest + SYNC_LOCK_SUFFIX, 'a') as fh:
+        fcntl.flock(fh, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def reading(dest):
+    ''' Context manager: keep other processes from syncing `dest` (shared
+    flock on {dest}.lock, as taken by sync), e.g. while copying out of it '''
+    return _locked(dest, fcntl.LOCK_SH)
+
+
+def sync(sources, dest, manifest=None, jobs=None, ignore=None):
+    ''' Make `dest` hold `sources` (list of (file or folder, folder in
+    dest)), copying only what changed since the last sync. Paths for which
+    ignore(source path) is True are left out.
+
+    A file is copied again if its size or mtime differ from the last sync
+    and its content differs from the copy in `dest`. Files that are not in
+    `sources` anymore are removed. The state of the last sync is kept in
+    `manifest` (default: {dest}.manifest.json, next to dest).
+
+    Concurrent syncs of `dest` (e.g. from builds running at the same time)
+    wait for each other, and for `reading(dest)` (exclusive flock on
+    {dest}.lock).
+
+    Returns
+    -------
+    dict: number of copied, unchanged and removed files
+    '''
+    with _locked(dest, fcntl.LOCK_EX):
+        return _sync(sources, dest, manifest, jobs, ignore)
+
+
+def _sync(sources, dest, manifest, jobs, ignore):
+    dest = os.path.abspath(dest)
+    manifest = manifest or dest + SYNC_MANIFEST_SUFFIX
+    previous = _load_json(manifest)
+    entries = _source_entries(sources, ignore)
+    for src, target in sources:
+        if not os.path.isdir(os.path.join(dest, target)):
+            os.makedirs(os.path.join(dest, target))
+    state = {}
+    to_copy = []
+    unchanged = 0
+    for rel in sorted(entries):
+        src, st = entries[rel]
+        dst = os.path.join(dest, rel)
+        old = previous.get(rel, {})
+        if stat.S_ISDIR(st.st_mode):
+            state[rel] = {'type': 'dir'}
+            if os.path.islink(dst) or os.path.isfile(dst):
+                os.remove(dst)
+            if not os.path.isdir(dst):
+                os.makedirs(dst)
+            continue
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            # was a folder
+            shutil.rmtree(dst)
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(src)
+            state[rel] = {'type': 'symlink', 'target': target}
+            if not (os.path.islink(dst) and os.readlink(dst) == target):
+                to_copy.append(('symlink', src, dst, rel))
+            else:
+                unchanged += 1
+        else:
+            state[rel] = {
+                'type': 'file',
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'mode': stat.S_IMODE(st.st_mode)
+            }
+            up_to_date = (os.path.isfile(dst) and not os.path.islink(dst)
+                          and os.path.getsize(dst) == st.st_size)
+            if up_to_date and (old.get('size'), old.get('mtime')) != (
+                    st.st_size, st.st_mtime):
+                # touched, maybe not changed
+                up_to_date = _same_content(src, dst)
+            if up_to_date and old.get('mode') != state[rel]['mode']:
+                os.chmod(dst, state[rel]['mode'])
+            if up_to_date:
+                unchanged += 1
+            else:
+                to_copy.append(('file', src, dst, rel))
+
+    _copy_items(to_copy, False, jobs)
+
+    removed = 0
+    # deepest first, so that folders are empty when removed
+    for rel in sorted(set(previous) - set(state), reverse=True):
+        path = os.path.join(dest, rel)
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+        elif os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+
+    fd, tmp = tempfile.mkstemp(
+        prefix=os.path.basename(manifest) + '.',
+        dir=os.path.dirname(os.path.abspath(manifest)))
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(state, fh)
+    os.rename(tmp, manifest)
+    return {'copied': len(to_copy), 'unchanged': unchanged, 'removed': removed}
+
+
+def summary(entries):
+    ''' {method: (number of files, bytes)} '''
+    methods = {}
+    for entry in entries:
+        n_files, size = methods.get(entry['method'], (0, 0))
+        methods[entry['method']] = (n_files + 1, size + entry.get('size', 0))
+    return methods
+
+
+def write_manifest(fn, entries):
+    with open(fn, 'w') as fh:
+        json.dump(
+            sorted(entries, key=lambda entry: entry['path']),
+            fh,
+            indent=1,
+            sort_keys=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Copy the content of a folder into another one')
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument(
+        '--link',
+        choices=['hardlink', 'symlink'],
+        default=None,
+        help='hardlink files (if src and dst are on the same filesystem) or '
+        'symlink them (absolute links) rather than copy them')
+    parser.add_argument('--manifest', default=None)
+    opt = parser.parse_args(args)
+    entries = copy_tree(opt.src, opt.dst, jobs=opt.jobs, link=opt.link or False)
+    for method, (n_files, size) in sorted(summary(entries).items()):
+        print('{:<16} {:6d} files {:10.1f} MB'.format(method, n_files,
+                                                     size / (1024. * 1024.)))
+    if opt.manifest:
+        write_manifest(opt.manifest, entries)
+
+
+if __name__ == '__main__':
+    main()
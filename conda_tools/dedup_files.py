@@ -0,0 +1,133 @@
+""" Replace identical files by links to one copy.
+
+Files are grouped by size and permission bits, then by sha256 (only files
+sharing a size are hashed). In each group the first path (sorted) is kept
+and the others become hardlinks to it (tar stores them as link members) or
+relative symlinks.
+
+Used in conda-ambertools-combine-pythons, where lib/python2.7 ...
+lib/python3.7 hold many identical data files, modules and libraries.
+
+Example:
+
+    python dedup_files.py $PREFIX/lib/python* --mode hardlink
+"""
+import os
+import stat
+import hashlib
+import argparse
+from collections import defaultdict
+
+import build_trace
+
+MODES = ['hardlink', 'symlink']
+BLOCK_SIZE = 1 << 20
+
+
+def file_hash(fn):
+    sha256 = hashlib.sha256()
+    with open(fn, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _regular_files(paths):
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                fn = os.path.join(dirpath, name)
+                st = os.lstat(fn)
+                if stat.S_ISREG(st.st_mode):
+                    yield fn, st
+
+
+def find_duplicates(paths, min_size=1):
+    ''' Groups of identical files under `paths`
+
+    Returns
+    -------
+    list of lists of paths; the first path of each group is the one to keep.
+    Files that are already hardlinks of each other count once.
+    '''
+    by_size = defaultdict(list)
+    seen_inodes = set()
+    for fn, st in _regular_files(paths):
+        inode = (st.st_dev, st.st_ino)
+        if st.st_size < min_size or inode in seen_inodes:
+            continue
+        seen_inodes.add(inode)
+        by_size[(st.st_size, stat.S_IMODE(st.st_mode))].append(fn)
+
+    groups = []
+    for key in sorted(by_size):
+        candidates = by_size[key]
+        if len(candidates) < 2:
+            continue
+        by_hash = defaultdict(list)
+        for fn in candidates:
+            by_hash[file_hash(fn)].append(fn)
+        groups.extend(
+            sorted(fns) for fns in by_hash.values() if len(fns) > 1)
+    return sorted(groups)
+
+
+def link(src, dest, mode='hardlink'):
+    ''' Replace `dest` by a link to `src` '''
+    tmp = dest + '.dedup.tmp'
+    if mode == 'hardlink':
+        os.link(src, tmp)
+    elif mode == 'symlink':
+        os.symlink(os.path.relpath(src, os.path.dirname(dest)), tmp)
+    else:
+        raise ValueError('mode must be one of {}'.format(MODES))
+    os.rename(tmp, dest)
+
+
+@build_trace.traced()
+def dedup(paths, mode='hardlink', min_size=1, dry_run=False):
+    ''' Link identical files under `paths`
+
+    Returns
+    -------
+    (number of replaced files, bytes saved)
+    '''
+    if mode not in MODES:
+        raise ValueError('mode must be one of {}'.format(MODES))
+    n_files = 0
+    saved = 0
+    for group in find_duplicates(paths, min_size=min_size):
+        keep = group[0]
+        size = os.path.getsize(keep)
+        for fn in group[1:]:
+            if dry_run:
+                print('{} -> {}'.format(fn, keep))
+            else:
+                link(keep, fn, mode=mode)
+            n_files += 1
+            saved += size
+    print('Deduplicated {} files, saved {:.1f} MB'.format(
+        n_files, saved / (1024. * 1024.)))
+    return n_files, saved
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Replace identical files by links to one copy')
+    parser.add_argument('paths', nargs='+', help='folders')
+    parser.add_argument('--mode', choices=MODES, default='hardlink')
+    parser.add_argument(
+        '--min-size',
+        type=int,
+        default=1,
+        dest='min_size',
+        help='Skip files smaller than this (bytes). Default: 1')
+    parser.add_argument('-d', '--dry-run', action='store_true', dest='dry_run')
+    opt = parser.parse_args(args)
+    dedup(
+        opt.paths, mode=opt.mode, min_size=opt.min_size, dry_run=opt.dry_run)
+
+
+if __name__ == '__main__':
+    main()
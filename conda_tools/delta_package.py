@@ -0,0 +1,410 @@
+""" Delta between two package tarballs, e.g. two AmberTools bugfix releases.
+
+    # on the build machine
+    python delta_package.py make \\
+        linux-64.ambertools-17.3-py27_0.tar.bz2 \\
+        linux-64.ambertools-17.4-py27_0.tar.bz2 \\
+        -o amber17-17.3-17.4.delta.tar.bz2
+
+    # on the cluster, upgrade $AMBERHOME (amber17) in place
+    python delta_package.py apply amber17-17.3-17.4.delta.tar.bz2 $AMBERHOME
+
+The delta is a tarball (format from its extension, see archive_codecs) with
+
+    delta.json   files to remove, new files, links, and the sha256 of all
+                 regular files of the new package
+    full/{name}  content of added files and of changed files without patch
+    patch/{name} bsdiff4 patch for changed files (if the bsdiff4 module is
+                 installed and the patch is smaller than the file)
+
+The common top folder of the members (amber17/ in non-conda packages) is not
+part of the names. apply checks the changed files against the old package
+before writing anything and checks all files against the new package after.
+"""
+import io
+import os
+import json
+import stat
+import shutil
+import hashlib
+import tarfile
+import argparse
+import tempfile
+
+import archive_codecs
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+DELTA_FORMAT = 1
+DELTA_JSON = 'delta.json'
+BLOCK_SIZE = 1 << 20
+
+
+def _sha256(fileobj):
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: fileobj.read(BLOCK_SIZE), b''):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+def file_sha256(fn):
+    with open(fn, 'rb') as fh:
+        return _sha256(fh)
+
+
+def _top_folder(names):
+    tops = set(name.split('/', 1)[0] for name in names)
+    if len(tops) == 1 and any('/' in name for name in names):
+        return tops.pop()
+    return None
+
+
+def _strip(name, top):
+    if top is None:
+        return name
+    return name[len(top) + 1:]
+
+
+def scan_package(pkg_fn, extract_dir=None, wanted=None):
+    ''' Entries of the package `pkg_fn`, keyed on member name (top folder
+    stripped):
+
+        {'type': 'file', 'sha256': ..., 'mode': ...}
+        {'type': 'dir', 'mode': ...}
+        {'type': 'symlink' or 'hardlink', 'target': ...}
+
+    Regular files named in `wanted` (full member names) are written to
+    `extract_dir`/{stripped name}.
+    '''
+    members = {}
+    with archive_codecs.tar_reader(pkg_fn) as tar:
+        for member in tar:
+            name = member.name.rstrip('/')
+            if member.isfile():
+                fileobj = tar.extractfile(member)
+                if wanted is not None and name in wanted:
+                    fn = os.path.join(extract_dir, name)
+                    if not os.path.exists(os.path.dirname(fn)):
+                        os.makedirs(os.path.dirname(fn))
+                    with open(fn, 'wb') as fh:
+                        shutil.copyfileobj(fileobj, fh)
+                    entry = {'sha256': file_sha256(fn)}
+                else:
+                    entry = {'sha256': _sha256(fileobj)}
+                entry.update(type='file', mode=stat.S_IMODE(member.mode))
+            elif member.isdir():
+                entry = {'type': 'dir', 'mode': stat.S_IMODE(member.mode)}
+            elif member.issym():
+                entry = {'type': 'symlink', 'target': member.linkname}
+            elif member.islnk():
+                entry = {'type': 'hardlink', 'target': member.linkname}
+            else:
+                continue
+            members[name] = entry
+
+    top = _top_folder(list(members))
+    entries = {}
+    for name, entry in members.items():
+        if entry['type'] == 'hardlink':
+            entry['target'] = _strip(entry['target'], top)
+        if name != top:
+            entries[_strip(name, top)] = entry
+    if wanted is not None and top is not None and os.path.isdir(
+            os.path.join(extract_dir, top)):
+        # keep the stripped layout in extract_dir
+        for name in os.listdir(os.path.join(extract_dir, top)):
+            os.rename(
+                os.path.join(extract_dir, top, name),
+                os.path.join(extract_dir, name))
+        os.rmdir(os.path.join(extract_dir, top))
+    return entries, top
+
+
+def _diff(old_entries, new_entries):
+    removed = [name for name in old_entries if name not in new_entries]
+    added = []
+    changed = []
+    for name, entry in new_entries.items():
+        old = old_entries.get(name)
+        if old is None:
+            added.append(name)
+        elif old['type'] != entry['type']:
+            # e.g. a file that became a folder: removed, then added
+            removed.append(name)
+            added.append(name)
+        elif old != entry:
+            changed.append(name)
+    return sorted(removed), sorted(added), sorted(changed)
+
+
+def make_delta(old_pkg, new_pkg, output_fn, use_bsdiff=True):
+    ''' Write the delta from `old_pkg` to `new_pkg` to `output_fn`
+
+    Returns
+    -------
+    delta : dict, content of delta.json
+    '''
+    tmp_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(output_fn)))
+    try:
+        old_entries, old_top = scan_package(old_pkg)
+        new_entries, new_top = scan_package(new_pkg)
+        removed, added, changed = _diff(old_entries, new_entries)
+        content_names = [
+            name for name in added + changed
+            if new_entries[name]['type'] == 'file'
+        ]
+        patched = [
+            name for name in changed if new_entries[name]['type'] == 'file'
+            and old_entries[name]['sha256'] != new_entries[name]['sha256']
+        ]
+
+        # second pass: only the new and changed files are written to disk
+        new_dir = os.path.join(tmp_dir, 'new')
+        old_dir = os.path.join(tmp_dir, 'old')
+        join = (lambda top, name: name if top is None else top + '/' + name)
+        scan_package(
+            new_pkg,
+            extract_dir=new_dir,
+            wanted=set(
+                join(new_top, name) for name in content_names
+                if name in added or name in patched))
+        if patched and use_bsdiff and bsdiff4 is not None:
+            scan_package(
+                old_pkg,
+                extract_dir=old_dir,
+                wanted=set(join(old_top, name) for name in patched))
+
+        updated = set(added + changed)
+        files = {}
+        for name in content_names:
+            entry = dict(new_entries[name], source='full')
+            old = old_entries.get(name)
+            if name in changed:
+                entry['old_sha256'] = old['sha256']
+                if old['sha256'] == entry['sha256']:
+                    # permissions only
+                    entry['source'] = 'old'
+            files[name] = entry
+
+        patches = {}
+        for name in patched:
+            old_fn = os.path.join(old_dir, name)
+            if not os.path.exists(old_fn):
+                continue
+            with open(old_fn, 'rb') as fh:
+                old_content = fh.read()
+            with open(os.path.join(new_dir, name), 'rb') as fh:
+                new_content = fh.read()
+            patch = bsdiff4.diff(old_content, new_content)
+            if len(patch) < len(new_content):
+                patches[name] = patch
+                files[name]['source'] = 'patch'
+
+        delta = {
+            'format': DELTA_FORMAT,
+            'old': os.path.basename(old_pkg),
+            'new': os.path.basename(new_pkg),
+            'remove': removed,
+            'files': files,
+            'dirs': {
+                name: entry['mode']
+                for name, entry in new_entries.items()
+                if name in updated and entry['type'] == 'dir'
+            },
+            # all hardlinks: their target may be rewritten
+            'links': {
+                name: entry
+                for name, entry in new_entries.items()
+                if entry['type'] == 'hardlink' or (
+                    entry['type'] == 'symlink' and name in updated)
+            },
+            'sha256': {
+                name: entry['sha256']
+                for name, entry in new_entries.items()
+                if entry['type'] == 'file'
+            },
+        }
+
+        archive_format = archive_codecs.format_of(output_fn) or 'bz2'
+        with archive_codecs.tar_writer(output_fn, archive_format) as tar:
+            # first member: apply reads it before the content
+            _add_bytes(tar, DELTA_JSON,
+                       json.dumps(delta, indent=2, sort_keys=True).encode())
+            for name in sorted(files):
+                source = files[name]['source']
+                if source == 'full':
+                    tar.add(
+                        os.path.join(new_dir, name),
+                        arcname='full/' + name,
+                        recursive=False)
+                elif source == 'patch':
+                    _add_bytes(tar, 'patch/' + name, patches[name])
+    finally:
+        shutil.rmtree(tmp_dir)
+    return delta
+
+
+def _add_bytes(tar, name, content):
+    member = tarfile.TarInfo(name)
+    member.size = len(content)
+    member.mode = 0o644
+    tar.addfile(member, io.BytesIO(content))
+
+
+def _check_old_files(delta, amberhome):
+    errors = []
+    for name, entry in sorted(delta['files'].items()):
+        if 'old_sha256' not in entry:
+            continue
+        fn = os.path.join(amberhome, name)
+        if not os.path.isfile(fn) or file_sha256(fn) != entry['old_sha256']:
+            errors.append(name)
+    if errors:
+        raise ValueError(
+            '{} does not match {}: {}'.format(amberhome, delta['old'],
+                                             ', '.join(errors)))
+
+
+def verify(amberhome, sha256):
+    ''' Names of files under `amberhome` not matching `sha256` {name: hash} '''
+    return sorted(
+        name for name, expected in sha256.items()
+        if not os.path.isfile(os.path.join(amberhome, name))
+        or file_sha256(os.path.join(amberhome, name)) != expected)
+
+
+def _replace(fn, content, mode):
+    tmp = fn + '.delta.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(content)
+    os.chmod(tmp, mode)
+    os.rename(tmp, fn)
+
+
+def _remove(fn, tree=False):
+    ''' Remove a file, link or empty folder (any folder if `tree`) '''
+    if os.path.islink(fn) or os.path.isfile(fn):
+        os.remove(fn)
+    elif os.path.isdir(fn) and (tree or not os.listdir(fn)):
+        shutil.rmtree(fn)
+
+
+def apply_delta(delta_fn, amberhome, check=True):
+    ''' Upgrade the install `amberhome` with the delta `delta_fn` '''
+    with archive_codecs.tar_reader(delta_fn) as tar:
+        member = tar.next()
+        if member is None or member.name != DELTA_JSON:
+            raise ValueError('{} is not a delta package'.format(delta_fn))
+        delta = json.loads(tar.extractfile(member).read().decode())
+        if delta['format'] != DELTA_FORMAT:
+            raise ValueError('Unsupported delta format in {}'.format(delta_fn))
+        files = delta['files']
+        if check:
+            _check_old_files(delta, amberhome)
+        if bsdiff4 is None and any(
+                entry['source'] == 'patch' for entry in files.values()):
+            raise RuntimeError('{} needs the bsdiff4 module'.format(delta_fn))
+
+        # paths of another type in the new package (e.g. a folder that
+        # became a symlink): removed with their content
+        replaced = set(delta['dirs']) | set(files) | set(delta['links'])
+        # deepest first, so that folders are empty when removed
+        for name in sorted(delta['remove'], reverse=True):
+            _remove(os.path.join(amberhome, name), tree=name in replaced)
+        for name, mode in sorted(delta['dirs'].items()):
+            fn = os.path.join(amberhome, name)
+            if os.path.lexists(fn) and not os.path.isdir(fn):
+                os.remove(fn)
+            if not os.path.isdir(fn):
+                os.makedirs(fn)
+            os.chmod(fn, mode)
+
+        for member in tar:
+            if member.name == DELTA_JSON:
+                # iterating starts again from the first member
+                continue
+            source, name = member.name.split('/', 1)
+            entry = files[name]
+            fn = os.path.join(amberhome, name)
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            if os.path.isdir(fn) and not os.path.islink(fn):
+                # was a folder (not listed in the old package)
+                shutil.rmtree(fn)
+            content = tar.extractfile(member).read()
+            if source == 'patch':
+                with open(fn, 'rb') as fh:
+                    content = bsdiff4.patch(fh.read(), content)
+            _replace(fn, content, entry['mode'])
+        for name, entry in files.items():
+            if entry['source'] == 'old':
+                os.chmod(os.path.join(amberhome, name), entry['mode'])
+
+    for name, entry in sorted(delta['links'].items()):
+        fn = os.path.join(amberhome, name)
+        _remove(fn, tree=True)
+        if entry['type'] == 'symlink':
+            os.symlink(entry['target'], fn)
+        else:
+            os.link(os.path.join(amberhome, entry['target']), fn)
+
+    errors = verify(amberhome, delta['sha256'])
+    if errors:
+        raise ValueError('Checksum mismatch after applying {}: {}'.format(
+            delta_fn, ', '.join(errors)))
+    return delta
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Make or apply a delta between two package tarballs')
+    subparsers = parser.add_subparsers(dest='command')
+    make_parser = subparsers.add_parser('make', help='write a delta')
+    make_parser.add_argument('old_package')
+    make_parser.add_argument('new_package')
+    make_parser.add_argument(
+        '-o',
+        '--output',
+        required=True,
+        help='delta file, .tar.bz2, .tar.xz or .tar.zst')
+    make_parser.add_argument(
+        '--no-bsdiff',
+        action='store_true',
+        dest='no_bsdiff',
+        help='store changed files in full')
+    apply_parser = subparsers.add_parser(
+        'apply', help='upgrade an install in place')
+    apply_parser.add_argument('delta')
+    apply_parser.add_argument('amberhome', help='e.g. amber17 folder')
+    apply_parser.add_argument(
+        '--no-check',
+        action='store_true',
+        dest='no_check',
+        help='do not check changed files against the old package first')
+    opt = parser.parse_args(args)
+
+    if opt.command == 'make':
+        delta = make_delta(
+            opt.old_package,
+            opt.new_package,
+            opt.output,
+            use_bsdiff=not opt.no_bsdiff)
+        n_patches = sum(entry['source'] == 'patch'
+                        for entry in delta['files'].values())
+        print('{}: {} removed, {} written ({} patches), {:.1f} MB'.format(
+            opt.output, len(delta['remove']), len(delta['files']), n_patches,
+            os.path.getsize(opt.output) / (1024. * 1024.)))
+    elif opt.command == 'apply':
+        delta = apply_delta(opt.delta, opt.amberhome, check=not opt.no_check)
+        print('Upgraded {} from {} to {}'.format(opt.amberhome, delta['old'],
+                                                 delta['new']))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -36,7 +36,9 @@ fi
 cd $AT_GH_REPO_BINARY_DEV
 rm -rf .git
 git init .
-split -b 40000000 $HOME/$tarfile.gz $prefix
+# chunks + ${prefix}.manifest.json (names, sizes, sha256) for download_binary_at_dev.py
+python $HOME/ambertools-binary-build/conda_tools/chunk_artifact.py split \
+    $HOME/$tarfile.gz --prefix $prefix --platform $platform --chunk-size 40000000
 git add tmp*AT*
 ls ${prefix}*
 
@@ -1,37 +1,164 @@
+import os
+import time
+import hashlib
 import requests
 import argparse
+from multiprocessing.pool import ThreadPool
 
+import chunk_artifact
+import build_manifest
 
-def download(fn, platform):
-    url = 'https://github.com/hainm/ambertools-dev-binary/blob/master/{chunk}?raw=true'
-
-    exts = 'abc' if platform == 'osx' else 'abcd'
-    prefix = 'tmp_{}-64_ATa'.format(platform)
-    with open(fn, 'wb') as fh:
-        for ext in exts:
-            final_url = url.format(chunk=prefix + ext)
-            print("Processing %s " % final_url)
-            x = requests.get(final_url)
-            if x.ok:
-                fh.write(x.content)
-            else:
-                print("Can not download %s" % final_url)
-                return
+URL = 'https://github.com/hainm/ambertools-dev-binary/blob/master/{chunk}?raw=true'
+BLOCK_SIZE = 1 << 20
+JOBS = 4
+RETRIES = 3
+BACKOFF = 2.
+TIMEOUT = 60
+
+
+def _get(url, retries, backoff, **kwargs):
+    ''' requests.get with `retries` more tries, waiting backoff, 2*backoff, ...
+    Return None if all fail. '''
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2**(attempt - 1))
+        try:
+            x = requests.get(url, timeout=TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            print("Can not download %s: %s" % (url, e))
+            continue
+        if x.ok:
+            return x
+        print("Can not download %s (%s)" % (url, x.status_code))
+    return None
+
+
+def _chunk_on_disk(fn, offset, chunk):
+    ''' True if `fn` already has `chunk` at `offset` (resume) '''
+    if not os.path.exists(fn) or os.path.getsize(fn) < offset + chunk['size']:
+        return False
+    sha256 = hashlib.sha256()
+    with open(fn, 'rb') as fh:
+        fh.seek(offset)
+        remaining = chunk['size']
+        while remaining:
+            block = fh.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                return False
+            sha256.update(block)
+            remaining -= len(block)
+    return sha256.hexdigest() == chunk['sha256']
+
+
+def _fetch_chunk(url, fn, offset, chunk, retries, backoff):
+    ''' Stream `chunk` to `fn` at `offset`, return True if its sha256 matches '''
+    final_url = url.format(chunk=chunk['filename'])
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2**(attempt - 1))
+        print("Processing %s " % final_url)
+        x = _get(final_url, 0, backoff, stream=True)
+        if x is None:
+            continue
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(fn, 'r+b') as fh:
+                fh.seek(offset)
+                for block in x.iter_content(BLOCK_SIZE):
+                    size += len(block)
+                    if size > chunk['size']:
+                        break
+                    sha256.update(block)
+                    fh.write(block)
+        except requests.RequestException as e:
+            print("Can not download %s: %s" % (final_url, e))
+            continue
+        finally:
+            x.close()
+        if size == chunk['size'] and sha256.hexdigest() == chunk['sha256']:
+            return True
+        print("Checksum mismatch for %s" % final_url)
+    return False
+
+
+def download(fn,
+             platform,
+             url=URL,
+             jobs=JOBS,
+             retries=RETRIES,
+             backoff=BACKOFF):
+    ''' Download the chunks listed in the manifest written by deploy.sh
+    (chunk_artifact.py) to `fn`, `jobs` at a time
+
+    Chunks already in `fn` (from an interrupted download) are not fetched
+    again. Return fn, or None if a chunk could not be downloaded.
+    '''
+    prefix = 'tmp_{}-64_AT'.format(platform)
+    manifest_url = url.format(chunk=chunk_artifact.manifest_name(prefix))
+    print("Processing %s " % manifest_url)
+    x = _get(manifest_url, retries, backoff)
+    if x is None:
+        return None
+    entry = x.json()['artifacts'][0]
+
+    offsets = []
+    offset = 0
+    for chunk in entry['chunks']:
+        offsets.append(offset)
+        offset += chunk['size']
+    todo = [(offset, chunk) for offset, chunk in zip(offsets, entry['chunks'])
+            if not _chunk_on_disk(fn, offset, chunk)]
+    print("%d of %d chunks to download" % (len(todo), len(entry['chunks'])))
+
+    # every chunk writes its own part of the file
+    with open(fn, 'ab'):
+        pass
+    with open(fn, 'r+b') as fh:
+        fh.truncate(entry['size'])
+    pool = ThreadPool(max(1, min(jobs, len(todo))))
+    try:
+        results = pool.map(
+            lambda args: _fetch_chunk(url, fn, args[0], args[1], retries,
+                                      backoff), todo)
+    finally:
+        pool.close()
+        pool.join()
+    if not all(results):
+        print("Can not download %s. Run again to resume" % fn)
+        return None
+    if build_manifest.sha256sum(fn) != entry['sha256']:
+        print("Checksum mismatch for %s" % fn)
+        return None
     print("Done. Please check %s" % fn)
+    return fn
 
 
 def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--linux", action="store_true")
     parser.add_argument("--osx", action="store_true")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=JOBS,
+        help="Number of chunks to download at the same time. Default: %d" %
+        JOBS)
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help="Tries per chunk after the first one. Default: %d" % RETRIES)
     opt = parser.parse_args(args)
     template = '{}-64.ambertools-18.dev.py27.tar'
     dev_dict = {'osx': template.format('osx'),
                 'linux': template.format('linux')}
     if opt.linux:
-        download(dev_dict['linux'], 'linux')
+        download(
+            dev_dict['linux'], 'linux', jobs=opt.jobs, retries=opt.retries)
     if opt.osx:
-        download(dev_dict['osx'], 'osx')
+        download(dev_dict['osx'], 'osx', jobs=opt.jobs, retries=opt.retries)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,21 @@
+import io
 import os
 import sys
 from glob import glob
+from fnmatch import fnmatch
 import tarfile
 import subprocess
 from contextlib import contextmanager
 import tempfile
 import shutil
-import json
 from shutil import rmtree
 
+import build_trace
+import archive_codecs
+import package_info
 
-def get_package_info(tar_fn):
+
+def get_package_info(tar_fn, sidecar=None):
     # ambertools-17.0-0.tar.bz2
     info_dict = {}
     if not os.path.exists(tar_fn):
@@ -27,11 +32,8 @@ def get_package_info(tar_fn):
         info_dict['version'] = version
         info_dict['subdir'] = subdir
     else:
-        with tarfile.open(tar_fn) as fh:
-            m = fh.getmember('info/index.json')
-            f = fh.extractfile(m)
-            content = f.read().decode()
-            info_dict = json.loads(content)
+        # cached; see package_info.py
+        info_dict = package_info.read_index_json(tar_fn, sidecar=sidecar)
     return info_dict
 
 
@@ -40,13 +42,70 @@ def get_date_label():
         'date +%d%h%y.H%H%M', shell=True).decode().strip()
 
 
+def _new_package_name(pkg_name,
+                      output_dir,
+                      prefix,
+                      add_date,
+                      conda,
+                      archive_format='bz2'):
+    ''' Return (absolute path of the new package, name of the uncompressed
+    tar file, amber{version} folder) '''
+    basename = os.path.basename(pkg_name)
+    package_info = get_package_info(pkg_name)
+    # ambertools-17.0-0.tar.bz2
+    amber_version = package_info.get('version').split('.')[0]
+    amber_folder = 'amber{}'.format(amber_version)
+    platform = package_info['subdir']
+
+    if add_date:
+        date_str = get_date_label() + '.'
+    else:
+        date_str = ''
+    if prefix is not None:
+        new_fn = prefix + '.' + basename.replace('tar.bz2',
+                                                 '') + date_str + 'tar'
+    else:
+        new_fn = platform + '.' + basename.replace('tar.bz2',
+                                                   '') + date_str + 'tar'
+    if conda:
+        new_fn = os.path.basename(pkg_name.replace('.bz2', ''))
+
+    print('date_str', date_str)
+    output_fn = os.path.join(output_dir,
+                             archive_codecs.archive_name(new_fn, archive_format))
+    print('new filename', os.path.basename(output_fn))
+    print('ABSOLUTE FILENAME DIR {}'.format(output_fn))
+    print('package_info', package_info)
+    print('amber_version', amber_version)
+    return output_fn, new_fn, amber_folder
+
+
+def _check_archive_format(archive_format, conda):
+    if archive_format not in archive_codecs.FORMATS:
+        raise ValueError('Unknown archive format {}'.format(archive_format))
+    if archive_format == 'conda' and not conda:
+        raise ValueError('.conda format is only for conda packages')
+
+
+def _compress_threads(archive_format, conda, deterministic=False):
+    # single bz2 stream for conda packages: conda on Python 2 can not read
+    # multi-stream files
+    if conda and archive_format == 'bz2':
+        return 1
+    if deterministic:
+        return archive_codecs.DETERMINISTIC_THREADS.get(archive_format)
+    return None
+
+
 @contextmanager
 def editing_conda_package(pkg_name,
                           output_dir='./tmp',
                           prefix=None,
                           add_date=True,
                           dry_run=False,
-                          conda=False):
+                          conda=False,
+                          archive_format='bz2',
+                          deterministic=False):
     ''' do something with `pkg_name` and write a new conda package to `output_dir`
 
     Parameters
@@ -61,6 +120,16 @@ def editing_conda_package(pkg_name,
         if True, output tarfile will be a conda package, else non-conda package.
         The difference is that non-conda package has $PREFIX/amber{version}/{info, ...}
         while conda package has $PREFIX{info, ...}
+    archive_format : str, default 'bz2'
+        one of archive_codecs.FORMATS ('conda' only for conda packages)
+    deterministic : bool, default False
+        if True, members are written in sorted order with normalized mtime,
+        owner and mode (archive_codecs.normalize_member) and a fixed
+        compressor setup, so the same content gives a bit-identical file
+
+    Yields
+    ------
+    str, absolute path of the new tar file
     '''
     pkg_name_path = os.path.abspath(pkg_name)
     basename = os.path.basename(pkg_name)
@@ -72,64 +141,271 @@ def editing_conda_package(pkg_name,
     cwd = os.getcwd()
     os.chdir(output_dir)
 
-    package_info = get_package_info(pkg_name_path)
-    # ambertools-17.0-0.tar.bz2
-    amber_version = package_info.get('version').split('.')[0]
-    amber_folder = 'amber{}'.format(amber_version)
-    platform = package_info['subdir']
-
-    if add_date:
-        date_str = get_date_label() + '.'
-    else:
-        date_str = ''
-    if prefix is not None:
-        new_fn = prefix + '.' + basename.replace('tar.bz2',
-                                                 '') + date_str + 'tar'
-    else:
-        new_fn = platform + '.' + basename.replace('tar.bz2',
-                                                   '') + date_str + 'tar'
-    if conda:
-        new_fn = os.path.basename(pkg_name.replace('.bz2', ''))
-
-    print('date_str', date_str)
-    print('new filename', new_fn + '.bz2')
-    # if you change "Absolute filename dir", make sure to update
-    # it in build_all.py too
-    # TODO: more reliable checking?
-    print('ABSOLUTE FILENAME DIR {}'.format(
-        os.path.join(output_dir, new_fn + '.bz2')))
-    print('package_info', package_info)
-    print('amber_version', amber_version)
+    _check_archive_format(archive_format, conda)
+    output_fn, new_fn, amber_folder = _new_package_name(
+        pkg_name_path,
+        output_dir,
+        prefix=prefix,
+        add_date=add_date,
+        conda=conda,
+        archive_format=archive_format)
 
     with tempfolder():
         if not dry_run:
-            with tarfile.open(pkg_name_path) as fh:
-                fh.extractall(path='.')
+            with build_trace.span('extract', package=basename):
+                with tarfile.open(pkg_name_path) as fh:
+                    fh.extractall(path='.')
 
-            yield  # do something here
+            with build_trace.span('edit', package=basename):
+                yield output_fn  # do something here
 
             others = [os.path.basename(fn) for fn in glob('*')]
             tmp_dir = os.getcwd()
 
-            # create symlink so all folder in $AMBERHOME will go to amber{version}/ folder
-            subprocess.check_call(['ln', '-s', tmp_dir, amber_folder])
+            with build_trace.span('tar', package=basename):
+                if deterministic:
+                    _write_sorted_tar(new_fn, others, amber_folder, conda)
+                else:
+                    # create symlink so all folder in $AMBERHOME will go to amber{version}/ folder
+                    subprocess.check_call(['ln', '-s', tmp_dir, amber_folder])
 
-            all_files_in_amber = [
-                os.path.join(amber_folder, fn) for fn in others
-            ] if not conda else others
+                    all_files_in_amber = [
+                        os.path.join(amber_folder, fn) for fn in others
+                    ] if not conda else others
 
-            commands = ['tar', '-cf', new_fn] + all_files_in_amber
-            subprocess.check_call(commands)
+                    commands = ['tar', '-cf', new_fn] + all_files_in_amber
+                    subprocess.check_call(commands)
 
-            subprocess.check_call(['bzip2', '-z', new_fn])
-            shutil.copy(new_fn + '.bz2', output_dir)
+            compressed_fn = os.path.basename(output_fn)
+            with build_trace.span('compress', package=basename):
+                archive_codecs.compress_tar(
+                    new_fn,
+                    compressed_fn,
+                    archive_format,
+                    threads=_compress_threads(archive_format, conda,
+                                              deterministic))
+            with build_trace.span('copy', package=basename):
+                shutil.copy(compressed_fn, output_dir)
         else:
-            yield
+            yield output_fn
             print("Dry run: Not doing actually untar")
 
     os.chdir(cwd)
 
 
+def _write_sorted_tar(tar_fn, names, amber_folder, conda):
+    with tarfile.open(tar_fn, 'w', format=tarfile.GNU_FORMAT) as tar:
+        for name in sorted(names):
+            archive_codecs.add_sorted(
+                tar,
+                name,
+                name if conda else amber_folder + '/' + name,
+                filter=archive_codecs.normalize_member)
+
+
+@contextmanager
+def streaming_conda_package(pkg_name,
+                            output_dir='./tmp',
+                            prefix=None,
+                            add_date=True,
+                            dry_run=False,
+                            conda=False,
+                            transforms=(),
+                            materialize=None,
+                            archive_format='bz2',
+                            deterministic=False):
+    ''' Like editing_conda_package, but copy members from `pkg_name` straight
+    into the new tar file (edited on the way) instead of extracting the whole
+    package to disk and tarring it again.
+
+    Parameters
+    ----------
+    pkg_name, output_dir, prefix, add_date, dry_run, conda, archive_format,
+    deterministic :
+        see editing_conda_package. Members keep the order of `pkg_name`;
+        with `deterministic`, they are written sorted as by
+        editing_conda_package once the with block is done (file data waits
+        in a temporary file meanwhile).
+    transforms : sequence of (pattern, function)
+        function(member, content) is called for each regular file whose name
+        in the package (e.g. bin/tleap) matches the fnmatch `pattern`;
+        content is bytes. It returns (member, content) to write, or None to
+        drop the file.
+    materialize : None or function(member) -> bool
+        Members for which this is True are extracted to the temp folder. The
+        with block runs in that folder and can edit them; they are added to
+        the new tar file after the with block.
+
+    Yields
+    ------
+    str, absolute path of the new tar file
+    '''
+    pkg_name_path = os.path.abspath(pkg_name)
+    basename = os.path.basename(pkg_name)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output_dir = os.path.abspath(output_dir)
+
+    _check_archive_format(archive_format, conda)
+    output_fn, _, amber_folder = _new_package_name(
+        pkg_name_path,
+        output_dir,
+        prefix=prefix,
+        add_date=add_date,
+        conda=conda,
+        archive_format=archive_format)
+
+    if dry_run:
+        yield output_fn
+        print("Dry run: Not doing actually repack")
+        return
+
+    def archive_name(name):
+        return name if conda else amber_folder + '/' + name
+
+    # compressed on other threads while we write the tar stream
+    threads = _compress_threads(archive_format, conda, deterministic)
+    normalize = archive_codecs.normalize_member if deterministic else None
+    with tempfolder(), \
+            tarfile.open(pkg_name_path, 'r|*') as tar_in, \
+            archive_codecs.tar_writer(output_fn, archive_format,
+                                      threads=threads) as tar_file:
+        tar_out = _SortedTar(tar_file) if deterministic else tar_file
+        with build_trace.span('repack', package=basename):
+            materialized, deferred = _copy_members(
+                tar_in, tar_out, archive_name, transforms, materialize,
+                normalize)
+
+        with build_trace.span('edit', package=basename):
+            yield output_fn  # edit materialized files here
+
+        for name in materialized:
+            if os.path.lexists(name):
+                tar_out.add(
+                    name,
+                    arcname=archive_name(name),
+                    recursive=False,
+                    filter=normalize)
+        for member in deferred:
+            tar_out.addfile(member)
+        if deterministic:
+            with build_trace.span('sort', package=basename):
+                tar_out.close()
+
+
+def _sort_key(member):
+    # folder, then its content: the order of archive_codecs.add_sorted
+    return member.name.split('/')
+
+
+class _SortedTar(object):
+    ''' Stand-in for the output tarfile of streaming_conda_package: keep the
+    members (file data in a temporary file) and write them to `tar` sorted
+    by name on close(). Hard links are written right after their target. '''
+
+    def __init__(self, tar):
+        self.tar = tar
+        self.spool = tempfile.TemporaryFile()
+        # (member, offset of its data in spool, or path of its file)
+        self.members = []
+
+    def addfile(self, member, fileobj=None):
+        offset = None
+        if fileobj is not None:
+            offset = self.spool.tell()
+            shutil.copyfileobj(fileobj, self.spool)
+        self.members.append((member, offset, None))
+
+    def add(self, name, arcname, recursive=False, filter=None):
+        member = self.tar.gettarinfo(name, arcname)
+        if filter is not None:
+            member = filter(member)
+        self.members.append((member, None, name if member.isreg() else None))
+
+    def _write(self, member, offset, path):
+        if path is not None:
+            with open(path, 'rb') as fh:
+                self.tar.addfile(member, fh)
+        elif offset is not None:
+            self.spool.seek(offset)
+            self.tar.addfile(member, self.spool)
+        else:
+            self.tar.addfile(member)
+
+    def close(self):
+        written = set()
+        links = {}
+        for member, offset, path in sorted(
+                self.members, key=lambda item: _sort_key(item[0])):
+            if member.islnk() and member.linkname not in written:
+                links.setdefault(member.linkname, []).append(member)
+                continue
+            self._write(member, offset, path)
+            written.add(member.name)
+            for link in links.pop(member.name, []):
+                self._write(link, None, None)
+        # targets not in the package
+        for link in sorted(
+            (link for waiting in links.values() for link in waiting),
+                key=_sort_key):
+            self._write(link, None, None)
+        self.spool.close()
+
+
+def _copy_members(tar_in,
+                  tar_out,
+                  archive_name,
+                  transforms,
+                  materialize,
+                  normalize=None):
+    ''' Copy members of tar_in to tar_out, return (materialized names,
+    hard links to materialized files). `normalize(member)` edits the metadata
+    of each written member. '''
+    materialized = []
+    deferred = []
+    for member in tar_in:
+        name = member.name
+        if materialize is not None and materialize(member):
+            # stream mode: extract now, the data can not be read later
+            tar_in.extract(member, path='.')
+            materialized.append(name)
+            continue
+
+        fileobj = None
+        if member.isfile():
+            fileobj = tar_in.extractfile(member)
+            functions = [
+                function for pattern, function in transforms
+                if fnmatch(name, pattern)
+            ]
+            if functions:
+                content = fileobj.read()
+                for function in functions:
+                    edited = function(member, content)
+                    if edited is None:
+                        break
+                    member, content = edited
+                if edited is None:
+                    # dropped by a transform
+                    continue
+                member.size = len(content)
+                fileobj = io.BytesIO(content)
+
+        member.name = archive_name(member.name)
+        if normalize is not None:
+            member = normalize(member)
+        if member.islnk():
+            if member.linkname in materialized:
+                member.linkname = archive_name(member.linkname)
+                # the target is added after the with block
+                deferred.append(member)
+                continue
+            member.linkname = archive_name(member.linkname)
+        tar_out.addfile(member, fileobj)
+    return materialized, deferred
+
+
 @contextmanager
 def tempfolder():
     my_temp = tempfile.mkdtemp()
@@ -15,6 +15,12 @@ def main(args=None):
         default='conda/osx-64',
         help="output directory")
     parser.add_argument("-d", "--dry_run", action="store_true", help="dry run")
+    parser.add_argument(
+        "--format",
+        choices=['bz2', 'conda'],
+        default='bz2',
+        dest="archive_format",
+        help="output .tar.bz2 or .conda (v2) package")
     opt = parser.parse_args(args)
     repack_conda_package(opt)
 
@@ -25,7 +31,8 @@ def repack_conda_package(opt):
             output_dir=opt.output_dir,
             add_date=False,
             dry_run=opt.dry_run,
-            conda=True):
+            conda=True,
+            archive_format=getattr(opt, 'archive_format', 'bz2')):
         # we do not include libgfortran here
         # will add amber-libgfortran requirement in meta file?
         update_gfortran_libs_osx.main(['.'])
@@ -4,10 +4,11 @@ import subprocess
 import itertools
 import argparse
 
+import macho
+
 
 def is_object_file(fn):
-    return os.path.isfile(fn) and 'is not an object file' not in subprocess.check_output([
-        'otool', '-L', fn]).decode()
+    return os.path.isfile(fn) and macho.is_macho(fn)
 
 
 def add_loader_path(fn, prefix, sub):
@@ -15,8 +16,9 @@ def add_loader_path(fn, prefix, sub):
     """
     relpath = os.path.relpath(prefix, os.path.abspath(os.path.dirname(fn)))
     loader_path = '@loader_path/{}/{}'.format(relpath, sub)
-    if not loader_path in subprocess.check_output(['otool', '-l', fn]).decode():
+    if loader_path not in macho.rpaths(fn):
         subprocess.check_output(['install_name_tool', '-add_rpath', loader_path, fn])
+        macho.forget(fn)
     else:
         print("{} is already in {}".format(loader_path, fn))
 
@@ -28,6 +30,7 @@ def add_id(fn):
     subprocess.check_call(
         ['install_name_tool', '-id',
          '@rpath/%s' % basename, fn])
+    macho.forget(fn)
 
 
 def get_file_object_from_prefix(pkg_name):
@@ -53,14 +56,12 @@ def fix_linking_libs(fn, lib_paths, prefix=None):
             'install_name_tool', '-change', lib_path,
             '@rpath/{}'.format(basename), fn
         ])
+        macho.forget(fn)
 
 
 def get_dylibs(fn):
     basename = os.path.basename(fn)
-    output = subprocess.check_output(['otool', '-L', fn]).decode()
-    lines = [line.split()[0] for line in output.split('\n') if line
-            and basename not in line]
-    return lines
+    return [lib for lib in macho.install_names(fn) if basename not in lib]
 
 
 def handle_gfortran_libs(pkg_name):
@@ -0,0 +1,211 @@
+""" Build-wide make job slots shared by concurrent builds.
+
+A slot folder holds one file per job slot. A make invocation locks as many
+free slot files as it may use (flock, at least one) and runs `make -j{n}`
+with n = number of locked slots. The locks are released when make is done,
+or by the kernel if the build process dies.
+
+The number of slots is scaled to the cpus and available memory of the host,
+so builds started at the same time (e.g. python-components for several Python
+versions, or several build_all.py runs sharing one AMBER_JOB_SLOTS_DIR) do not
+oversubscribe it.
+
+A make takes at most its share of the slots: total / number of builds, where
+the number of builds is the larger of $AMBER_CONCURRENT_BUILDS (passed by
+build_all.py to each conda build it runs side by side) and the number of makes
+currently holding or waiting for slots (each registers a locked client-*
+file). So the first make of a set of concurrent builds does not take every
+slot and leave the others waiting.
+
+Example:
+
+    job_slots.setup('amber-conda-bld/job-slots')  # exports AMBER_JOB_SLOTS_DIR
+    ...
+    # in a conda build script
+    with job_slots.acquire(cpu_count()) as n_jobs:
+        utils.sh('make install -j{}'.format(n_jobs))
+
+Without AMBER_JOB_SLOTS_DIR, acquire(n) gives n jobs.
+
+Note: this is not a GNU make jobserver: conda build does not pass open file
+descriptors to the build scripts, so make's pipe based jobserver can not be
+shared between builds. Slots are taken when make starts and kept until it ends.
+"""
+import os
+import time
+import fcntl
+import tempfile
+from glob import glob
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+
+import build_scheduler
+
+ENV_VAR = 'AMBER_JOB_SLOTS_DIR'
+BUILDS_ENV_VAR = 'AMBER_CONCURRENT_BUILDS'
+# peak memory (MB) of a compiler process building AmberTools (Fortran)
+MEMORY_PER_JOB = 1024
+POLL_INTERVAL = 1.0
+
+
+def available_memory():
+    ''' Available memory in MB (MemAvailable on Linux, else physical memory) '''
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return build_scheduler.total_memory()
+
+
+def default_slots():
+    ''' cpu count, reduced if there is not enough memory for that many jobs '''
+    n_slots = cpu_count()
+    memory = available_memory()
+    if memory:
+        n_slots = min(n_slots, memory // MEMORY_PER_JOB)
+    return max(n_slots, 1)
+
+
+def slot_files(slots_dir):
+    return sorted(glob(os.path.join(slots_dir, 'slot-*')))
+
+
+def setup(slots_dir=None, n_slots=None):
+    ''' Create slot files and export AMBER_JOB_SLOTS_DIR
+
+    Parameters
+    ----------
+    slots_dir : str or None
+        Default: $AMBER_JOB_SLOTS_DIR if set (slots shared with other
+        builds), else a new temp folder.
+    n_slots : int or None
+        Default: keep the slots already in slots_dir, or default_slots() for
+        a new folder.
+
+    Returns
+    -------
+    slots_dir : str
+    '''
+    slots_dir = slots_dir or os.getenv(ENV_VAR) or tempfile.mkdtemp(
+        prefix='amber-job-slots-')
+    slots_dir = os.path.abspath(slots_dir)
+    if not os.path.exists(slots_dir):
+        os.makedirs(slots_dir)
+    if n_slots is not None or not slot_files(slots_dir):
+        n_slots = n_slots or default_slots()
+        wanted = [
+            os.path.join(slots_dir, 'slot-{:04d}'.format(index))
+            for index in range(n_slots)
+        ]
+        for fn in slot_files(slots_dir):
+            if fn not in wanted:
+                os.remove(fn)
+        for fn in wanted:
+            if not os.path.exists(fn):
+                open(fn, 'w').close()
+    os.environ[ENV_VAR] = slots_dir
+    print('Job slots = {} ({})'.format(len(slot_files(slots_dir)), slots_dir))
+    return slots_dir
+
+
+def _active_clients(slots_dir):
+    ''' Number of makes holding or waiting for slots (their client file is
+    locked); files of dead ones are removed '''
+    n_clients = 0
+    for fn in glob(os.path.join(slots_dir, 'client-*')):
+        try:
+            fh = open(fn)
+        except (IOError, OSError):
+            # removed meanwhile
+            continue
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            n_clients += 1
+        else:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        finally:
+            fh.close()
+    return n_clients
+
+
+@contextmanager
+def _client(slots_dir):
+    # locked before it gets its client-* name, so that it is never seen
+    # unlocked (and removed as stale) by _active_clients
+    fd, tmp = tempfile.mkstemp(prefix='.client-', dir=slots_dir)
+    fh = os.fdopen(fd)
+    fn = os.path.join(slots_dir, os.path.basename(tmp)[1:])
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        os.rename(tmp, fn)
+        yield
+    finally:
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+        fh.close()
+
+
+def share(n_slots, slots_dir):
+    ''' Most slots one make may take '''
+    try:
+        n_builds = int(os.getenv(BUILDS_ENV_VAR) or 1)
+    except ValueError:
+        n_builds = 1
+    n_builds = max(n_builds, _active_clients(slots_dir), 1)
+    return max(n_slots // n_builds, 1)
+
+
+def _lock_free_slots(fns, max_jobs):
+    held = []
+    for fn in fns:
+        if len(held) == max_jobs:
+            break
+        fh = open(fn)
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            fh.close()
+        else:
+            held.append(fh)
+    return held
+
+
+@contextmanager
+def acquire(max_jobs, slots_dir=None, poll_interval=POLL_INTERVAL):
+    ''' Wait for at least one free slot, yield the number of slots taken
+    (at most max_jobs and this make's share, see share)
+
+    Parameters
+    ----------
+    max_jobs : int, most slots to take
+    slots_dir : str or None, default: $AMBER_JOB_SLOTS_DIR
+    '''
+    max_jobs = max(int(max_jobs), 1)
+    slots_dir = slots_dir or os.getenv(ENV_VAR)
+    fns = slot_files(slots_dir) if slots_dir else []
+    if not fns:
+        yield max_jobs
+        return
+    held = []
+    with _client(slots_dir):
+        try:
+            while True:
+                held = _lock_free_slots(
+                    fns, min(max_jobs, share(len(fns), slots_dir)))
+                if held:
+                    break
+                time.sleep(poll_interval)
+            yield len(held)
+        finally:
+            for fh in held:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
@@ -0,0 +1,229 @@
+""" Read the load commands of Mach-O files (thin or fat) without otool.
+
+Only what the osx scripts need is read, in one pass over the load commands
+of each architecture:
+
+    LC_ID_DYLIB       install name of a dylib
+    LC_*LOAD*_DYLIB   dylibs it loads (also weak, reexport, lazy, upward)
+    LC_RPATH          rpaths
+
+Results are kept in memory, keyed on the path and stamped with the inode,
+size, mtime and ctime of the file, so that a file is read again once
+install_name_tool changed it. Timestamps can be as coarse as a second (HFS+),
+so scripts editing a file also call forget(fn) right after.
+
+Example:
+
+    python macho.py $PREFIX/lib/libcpptraj.dylib
+"""
+import os
+import struct
+import argparse
+import threading
+from collections import namedtuple
+
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+LOAD_COMMANDS = (LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB,
+                 LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB)
+
+# java class files also start with 0xcafebabe, then a version >= 45
+MAX_FAT_ARCHS = 44
+
+# one architecture
+Slice = namedtuple('Slice', ['cputype', 'filetype', 'id', 'dylibs', 'rpaths'])
+
+_memory_cache = {}
+_lock = threading.Lock()
+
+
+def _read(fh, size):
+    data = fh.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated Mach-O file: {}'.format(fh.name))
+    return data
+
+
+def _c_string(data, offset):
+    end = data.find(b'\0', offset)
+    return data[offset:end if end >= 0 else len(data)].decode('utf-8')
+
+
+def _read_slice(fh, offset=0):
+    ''' Slice at `offset` of `fh`, or None if it is not a Mach-O header '''
+    fh.seek(offset)
+    head = fh.read(4)
+    if len(head) != 4:
+        return None
+    for endian in '<>':
+        magic, = struct.unpack(endian + 'I', head)
+        if magic in (MH_MAGIC, MH_MAGIC_64):
+            break
+    else:
+        return None
+    cputype, _, filetype, ncmds, sizeofcmds, _ = struct.unpack(
+        endian + '6I', _read(fh, 24))
+    if magic == MH_MAGIC_64:
+        # reserved
+        _read(fh, 4)
+    data = _read(fh, sizeofcmds)
+
+    dylib_id = None
+    dylibs = []
+    rpaths = []
+    pos = 0
+    for _ in range(ncmds):
+        if pos + 8 > len(data):
+            raise ValueError('Truncated Mach-O load commands: {}'.format(
+                fh.name))
+        cmd, cmdsize = struct.unpack_from(endian + '2I', data, pos)
+        if cmdsize < 8 or pos + cmdsize > len(data):
+            raise ValueError('Malformed Mach-O load command: {}'.format(
+                fh.name))
+        command = data[pos:pos + cmdsize]
+        if cmd == LC_ID_DYLIB or cmd in LOAD_COMMANDS or cmd == LC_RPATH:
+            # dylib_command and rpath_command: the string offset comes first
+            name = _c_string(command,
+                             struct.unpack_from(endian + 'I', command, 8)[0])
+            if cmd == LC_ID_DYLIB:
+                dylib_id = name
+            elif cmd == LC_RPATH:
+                rpaths.append(name)
+            else:
+                dylibs.append(name)
+        pos += cmdsize
+    return Slice(cputype, filetype, dylib_id, dylibs, rpaths)
+
+
+def read_slices(fn):
+    ''' List of Slice, one per architecture; empty if `fn` is not a Mach-O
+    file (or not a file). Raise ValueError on truncated files. '''
+    if not os.path.isfile(fn):
+        return []
+    with open(fn, 'rb') as fh:
+        head = fh.read(8)
+        if len(head) < 8:
+            return []
+        magic, n_archs = struct.unpack('>2I', head)
+        if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+            mach_slice = _read_slice(fh)
+            return [mach_slice] if mach_slice is not None else []
+        if n_archs > MAX_FAT_ARCHS:
+            return []
+        if magic == FAT_MAGIC:
+            # cputype, cpusubtype, offset, size, align
+            archs = [
+                struct.unpack('>5I', _read(fh, 20)) for _ in range(n_archs)
+            ]
+        else:
+            # same, 64-bit offset and size, reserved
+            archs = [
+                struct.unpack('>2I2Q2I', _read(fh, 32))
+                for _ in range(n_archs)
+            ]
+        slices = []
+        for arch in archs:
+            mach_slice = _read_slice(fh, arch[2])
+            if mach_slice is None:
+                raise ValueError('No Mach-O header at offset {} of {}'.format(
+                    arch[2], fn))
+            slices.append(mach_slice)
+        return slices
+
+
+def load(fn):
+    ''' read_slices, cached while the stat stamp of `fn` does not change '''
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return []
+    key = os.path.abspath(fn)
+    stamp = (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+    with _lock:
+        cached = _memory_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    slices = read_slices(fn)
+    with _lock:
+        _memory_cache[key] = (stamp, slices)
+    return slices
+
+
+def forget(fn):
+    ''' Drop the cached slices of `fn`, e.g. after install_name_tool '''
+    with _lock:
+        _memory_cache.pop(os.path.abspath(fn), None)
+
+
+def clear_cache():
+    with _lock:
+        _memory_cache.clear()
+
+
+def _merged(values):
+    # all architectures, first seen first
+    merged = []
+    for value in values:
+        if value is not None and value not in merged:
+            merged.append(value)
+    return merged
+
+
+def is_macho(fn):
+    return bool(load(fn))
+
+
+def dylib_id(fn):
+    ''' Install name (LC_ID_DYLIB) of `fn`, None if it is not a dylib '''
+    ids = _merged(mach_slice.id for mach_slice in load(fn))
+    return ids[0] if ids else None
+
+
+def dylibs(fn):
+    ''' Dylibs loaded by `fn` '''
+    return _merged(lib for mach_slice in load(fn) for lib in mach_slice.dylibs)
+
+
+def rpaths(fn):
+    return _merged(rpath for mach_slice in load(fn)
+                   for rpath in mach_slice.rpaths)
+
+
+def install_names(fn):
+    ''' Install name of `fn` (if a dylib) then the dylibs it loads, as listed
+    by `otool -L` '''
+    return _merged([dylib_id(fn)] + dylibs(fn))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Print install name, dylibs and rpaths of Mach-O files')
+    parser.add_argument('files', nargs='+')
+    opt = parser.parse_args(args)
+    for fn in opt.files:
+        slices = load(fn)
+        if not slices:
+            print('{}: not a Mach-O file'.format(fn))
+            continue
+        print('{}: {} architecture(s)'.format(fn, len(slices)))
+        if dylib_id(fn):
+            print('  id     {}'.format(dylib_id(fn)))
+        for lib in dylibs(fn):
+            print('  dylib  {}'.format(lib))
+        for rpath in rpaths(fn):
+            print('  rpath  {}'.format(rpath))
+
+
+if __name__ == '__main__':
+    main()
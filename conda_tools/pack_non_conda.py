@@ -18,8 +18,10 @@ from glob import glob
 import argparse
 
 # local file, in the same folder as this script
-from edit_package import editing_conda_package
+from edit_package import editing_conda_package, streaming_conda_package
 import update_shebang
+import build_manifest
+import archive_codecs
 
 
 def main():
@@ -34,19 +36,68 @@ def main():
     parser.add_argument(
         "--date", action="store_true", help="Add date to output tarfile")
     parser.add_argument("-d", "--dry_run", action="store_true", help="dry run")
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="edit members while copying them to the new tarfile instead of "
+        "extracting the whole package (less disk I/O and temp space)")
+    parser.add_argument(
+        "--format",
+        choices=[fmt for fmt in archive_codecs.FORMATS if fmt != 'conda'],
+        default='bz2',
+        dest="archive_format",
+        help="compression of the output tarfile (default: bz2)")
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        help="sorted members with normalized mtime/owner/mode and a fixed "
+        "compressor setup: the same content gives a bit-identical file")
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help="write a json manifest of the created package to this file")
     opt = parser.parse_args()
     pack_non_conda_package(opt)
 
 
+def _update_shebang(member, content):
+    # only files directly in bin/, as update_python_env('./bin/')
+    if os.path.dirname(member.name) != 'bin':
+        return member, content
+    return update_shebang.update_member(member, content)
+
+
 def pack_non_conda_package(opt):
-    with editing_conda_package(
-            opt.tarfile,
-            output_dir=opt.output_dir,
-            add_date=opt.date,
-            dry_run=opt.dry_run):
-        update_shebang.update_python_env('./bin/')
-
-        # No need to copy here since we alread done in conda build step?
+    archive_format = getattr(opt, 'archive_format', 'bz2')
+    deterministic = getattr(opt, 'deterministic', False)
+    if getattr(opt, 'streaming', False):
+        with streaming_conda_package(
+                opt.tarfile,
+                output_dir=opt.output_dir,
+                add_date=opt.date,
+                dry_run=opt.dry_run,
+                transforms=[('bin/*', _update_shebang)],
+                archive_format=archive_format,
+                deterministic=deterministic) as output_fn:
+            pass
+    else:
+        with editing_conda_package(
+                opt.tarfile,
+                output_dir=opt.output_dir,
+                add_date=opt.date,
+                dry_run=opt.dry_run,
+                archive_format=archive_format,
+                deterministic=deterministic) as output_fn:
+            update_shebang.update_python_env('./bin/')
+
+            # No need to copy here since we alread done in conda build step?
+
+    manifest = getattr(opt, 'manifest', None)
+    if manifest is not None:
+        build_manifest.write_manifest(
+            manifest, 'pack-non-conda',
+            [build_manifest.artifact_entry(output_fn)])
+    return output_fn
 
 
 if __name__ == '__main__':
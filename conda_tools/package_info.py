@@ -0,0 +1,176 @@
+""" Fast lookup of info/index.json in conda packages.
+
+Reading info/index.json with tarfile.open(...).getmember decompresses the
+whole .tar.bz2 first. Here:
+
+    1. results are kept in memory, keyed on (path, size, mtime)
+    2. opt-in ($AMBER_PACKAGE_INFO_SIDECAR=1 or --sidecar): a sidecar file
+       {package}.info.json stores the result next to the package, valid
+       while the package size and mtime do not change
+    3. otherwise the package is read as a stream, stopping at
+       info/index.json (also amber{version}/info/index.json of non-conda
+       packages, and the info-*.tar.zst of .conda packages)
+
+Example:
+
+    python package_info.py --sidecar amber-conda-bld/
+"""
+import os
+import json
+import time
+import shutil
+import tarfile
+import zipfile
+import argparse
+import tempfile
+import threading
+
+import archive_codecs
+
+SIDECAR_SUFFIX = '.info.json'
+# set to 1 to read and write sidecar files by default
+SIDECAR_ENV = 'AMBER_PACKAGE_INFO_SIDECAR'
+PACKAGE_SUFFIXES = ('.tar.bz2', '.conda')
+
+_memory_cache = {}
+_lock = threading.Lock()
+
+
+def sidecar_path(pkg_fn):
+    return pkg_fn + SIDECAR_SUFFIX
+
+
+def _stamp(pkg_fn):
+    st = os.stat(pkg_fn)
+    return [st.st_size, st.st_mtime]
+
+
+def _is_index_json(name):
+    # info/index.json or amber18/info/index.json (top folder of a non-conda
+    # package), not lib/info/index.json
+    parts = name.split('/')
+    if parts[-2:] != ['info', 'index.json']:
+        return False
+    top = parts[:-2]
+    return not top or (len(top) == 1 and top[0].startswith('amber'))
+
+
+def _scan_tar(tar):
+    for member in tar:
+        if _is_index_json(member.name):
+            return json.loads(tar.extractfile(member).read().decode())
+    return None
+
+
+def scan_index_json(pkg_fn):
+    ''' Read index.json from `pkg_fn`, stopping as soon as it is found '''
+    if pkg_fn.endswith('.conda'):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with zipfile.ZipFile(pkg_fn) as zf:
+                names = [
+                    name for name in zf.namelist()
+                    if name.startswith('info-') and name.endswith('.tar.zst')
+                ]
+                if names:
+                    info_tar = os.path.join(tmp_dir, 'info.tar')
+                    with open(info_tar, 'wb') as fh:
+                        archive_codecs.read_archive(
+                            zf.extract(names[0], tmp_dir), 'zstd', fh)
+                    with tarfile.open(info_tar) as tar:
+                        index = _scan_tar(tar)
+                        if index is not None:
+                            return index
+        finally:
+            shutil.rmtree(tmp_dir)
+    else:
+        with tarfile.open(pkg_fn, 'r|*') as tar:
+            index = _scan_tar(tar)
+            if index is not None:
+                return index
+    raise KeyError('info/index.json not found in {}'.format(pkg_fn))
+
+
+def _read_sidecar(pkg_fn, stamp):
+    try:
+        with open(sidecar_path(pkg_fn)) as fh:
+            content = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if content.get('stamp') != stamp:
+        return None
+    return content.get('index')
+
+
+def _write_sidecar(pkg_fn, stamp, index):
+    fn = sidecar_path(pkg_fn)
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    try:
+        with open(tmp, 'w') as fh:
+            json.dump({'stamp': stamp, 'index': index}, fh, sort_keys=True)
+        os.rename(tmp, fn)
+    except (IOError, OSError):
+        # e.g. read-only channel folder: keep the memory cache only
+        pass
+
+
+def read_index_json(pkg_fn, sidecar=None):
+    ''' info/index.json of the package `pkg_fn` as a dict
+
+    Parameters
+    ----------
+    pkg_fn : str, .tar.bz2 or .conda package
+    sidecar : bool, default: $AMBER_PACKAGE_INFO_SIDECAR == '1'
+        read and write {pkg_fn}.info.json
+    '''
+    if sidecar is None:
+        sidecar = os.getenv(SIDECAR_ENV) == '1'
+    pkg_fn = os.path.abspath(pkg_fn)
+    stamp = _stamp(pkg_fn)
+    key = (pkg_fn, stamp[0], stamp[1])
+    with _lock:
+        index = _memory_cache.get(key)
+    if index is None and sidecar:
+        index = _read_sidecar(pkg_fn, stamp)
+    if index is None:
+        index = scan_index_json(pkg_fn)
+        if sidecar:
+            _write_sidecar(pkg_fn, stamp, index)
+    with _lock:
+        _memory_cache[key] = index
+    # callers may edit the result
+    return dict(index)
+
+
+def find_packages(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.endswith(PACKAGE_SUFFIXES):
+                        yield os.path.join(dirpath, name)
+        else:
+            yield path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Print name, version, build and subdir of packages')
+    parser.add_argument('paths', nargs='+', help='packages or folders')
+    parser.add_argument(
+        '--sidecar',
+        action='store_true',
+        help='read and write {package}.info.json next to each package')
+    opt = parser.parse_args(args)
+    for pkg_fn in find_packages(opt.paths):
+        start = time.time()
+        index = read_index_json(pkg_fn, sidecar=opt.sidecar or None)
+        print('{}  {} {} {} {}  ({:.1f} ms)'.format(
+            pkg_fn, index.get('name'), index.get('version'),
+            index.get('build'), index.get('subdir'),
+            (time.time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
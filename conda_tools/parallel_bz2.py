@@ -0,0 +1,203 @@
+""" Multi-threaded bzip2 compression.
+
+Data is cut into CHUNK_SIZE pieces that are compressed on a thread pool (the
+bz2 module releases the GIL while compressing) and written in order as
+concatenated bz2 streams. bzip2, `tar -xjf`, conda and Python 3 `bz2` /
+`tarfile` read multi-stream files as one file.
+
+Example:
+
+    # like `bzip2 -z ambertools.tar` but keeps ambertools.tar
+    parallel_bz2.compress_file('ambertools.tar')
+
+    # tar stream -> .tar.bz2
+    with open('out.tar.bz2', 'wb') as fh, ParallelBZ2Writer(fh) as writer:
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            tar.add('amber18')
+
+Benchmark against bzip2:
+
+    python parallel_bz2.py --benchmark ambertools.tar
+"""
+import os
+import bz2
+import time
+import argparse
+import subprocess
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# 8 bzip2 blocks of 900k; the size of each compressed stream
+CHUNK_SIZE = 8 * 900 * 1000
+LEVEL = 9
+
+
+def default_threads():
+    return int(os.getenv('AMBER_BZ2_THREADS', 0)) or cpu_count()
+
+
+class ParallelBZ2Writer(object):
+    ''' Write-only file object that bz2 compresses to `fileobj`
+
+    Parameters
+    ----------
+    fileobj : binary file object to write compressed data to (not closed)
+    threads : int, default: $AMBER_BZ2_THREADS or cpu count
+    chunk_size : int or None
+        bytes compressed as one bz2 stream. None: write a single stream,
+        compressed in the calling thread (for readers without multi-stream
+        support, e.g. Python 2 bz2)
+    level : int, 1-9
+    '''
+
+    def __init__(self,
+                 fileobj,
+                 threads=None,
+                 chunk_size=CHUNK_SIZE,
+                 level=LEVEL):
+        self.fileobj = fileobj
+        self.threads = threads or default_threads()
+        self.chunk_size = chunk_size
+        self.level = level
+        self.closed = False
+        self._compressor = None
+        if chunk_size is None:
+            self._compressor = bz2.BZ2Compressor(level)
+            self._pool = None
+        else:
+            self._pool = ThreadPool(self.threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._n_streams = 0
+
+    def write(self, data):
+        n_bytes = len(data)
+        if self._compressor is not None:
+            self.fileobj.write(self._compressor.compress(data))
+            return n_bytes
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            data = b''.join(self._buffer)
+            end = len(data) - len(data) % self.chunk_size
+            for start in range(0, end, self.chunk_size):
+                self._submit(data[start:start + self.chunk_size])
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+        return n_bytes
+
+    def _submit(self, chunk):
+        self._pending.append(
+            self._pool.apply_async(bz2.compress, (chunk, self.level)))
+        self._n_streams += 1
+        # bound memory: keep at most two chunks per thread in flight
+        while len(self._pending) > 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self._pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        if self._compressor is not None:
+            self.fileobj.write(self._compressor.flush())
+            self.closed = True
+            return
+        try:
+            if self._buffered or not self._n_streams:
+                # an empty input still makes a valid (empty) bz2 file
+                self._submit(b''.join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+            while self._pending:
+                self._write_next()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self.closed = True
+
+    def abort(self):
+        ''' Stop without writing the remaining data '''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        self._pending.clear()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compress_file(src, dst=None, threads=None, chunk_size=CHUNK_SIZE,
+                  level=LEVEL):
+    ''' Compress `src` to `dst` (default: src + '.bz2'), return dst '''
+    dst = dst or src + '.bz2'
+    with open(src, 'rb') as fh, open(dst, 'wb') as fh_out:
+        with ParallelBZ2Writer(
+                fh_out, threads=threads, chunk_size=chunk_size,
+                level=level) as writer:
+            for chunk in iter(lambda: fh.read(chunk_size or CHUNK_SIZE),
+                              b''):
+                writer.write(chunk)
+    return dst
+
+
+def benchmark(fn, threads=None):
+    ''' Compress `fn` with bzip2 and with compress_file, return a list of
+    (method, seconds, compressed size) '''
+    results = []
+    dst = fn + '.benchmark.bz2'
+    try:
+        start = time.time()
+        with open(dst, 'wb') as fh:
+            subprocess.check_call(['bzip2', '-z', '-c', fn], stdout=fh)
+        results.append(('bzip2', time.time() - start, os.path.getsize(dst)))
+
+        start = time.time()
+        compress_file(fn, dst, threads=threads)
+        duration = time.time() - start
+        # stock bzip2 must be able to read it
+        subprocess.check_call(['bzip2', '-t', dst])
+        results.append(('parallel_bz2 ({} threads)'.format(
+            threads or default_threads()), duration, os.path.getsize(dst)))
+    finally:
+        if os.path.exists(dst):
+            os.remove(dst)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='bzip2 compress files with several threads')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument(
+        '-j',
+        '--threads',
+        type=int,
+        default=None,
+        help='Default: $AMBER_BZ2_THREADS or cpu count')
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='Compare with bzip2, do not write compressed files')
+    opt = parser.parse_args(args)
+    for fn in opt.files:
+        if opt.benchmark:
+            mb = os.path.getsize(fn) / (1024. * 1024.)
+            print('{} ({:.1f} MB)'.format(fn, mb))
+            for method, duration, size in benchmark(fn, threads=opt.threads):
+                print('    {:<30} {:8.1f} s {:8.1f} MB/s  ratio {:.3f}'.format(
+                    method, duration, mb / duration if duration else 0.,
+                    size / (1024. * 1024.) / mb if mb else 0.))
+        else:
+            print(compress_file(fn, threads=opt.threads))
+
+
+if __name__ == '__main__':
+    main()
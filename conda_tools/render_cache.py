@@ -0,0 +1,194 @@
+""" Cache for `conda build --output`
+
+`conda build --output` renders the recipe and solves environments only to
+print a filename, which costs seconds to minutes per call. The result only
+depends on the recipe contents, the conda build arguments (python version,
+croot), a few environment variables and the conda configuration, so we keep
+it in memory and in a json file keyed on those.
+
+The cache file is $AMBER_RENDER_CACHE (default
+~/.cache/amber-binary-build/render_cache.json). Set AMBER_RENDER_CACHE to an
+empty string to only cache in memory.
+
+On a cache miss, the recipe is rendered in process with
+conda_build.api.get_output_file_paths if conda_build can be imported (no new
+python and conda startup), else with `conda build --output`.
+
+Example:
+
+    render_cache.output_path(['conda', 'build', recipe_dir, '--py', '3.6'])
+"""
+import os
+import json
+import hashlib
+import subprocess
+import threading
+
+try:
+    from conda_build import api as conda_build_api
+except ImportError:
+    conda_build_api = None
+
+ENV_VARS = ['AMBER_BUILD_TASK', 'CONDA_PY', 'CONDA_BLD_PATH']
+# conda configuration that changes the rendered filename
+CONFIG_FILES = ['~/.condarc', '~/conda_build_config.yaml']
+DEFAULT_CACHE_FILE = os.path.join('~', '.cache', 'amber-binary-build',
+                                  'render_cache.json')
+
+_memory_cache = {}
+_lock = threading.Lock()
+# conda_build.api is not thread safe
+_render_lock = threading.Lock()
+
+
+def cache_file():
+    fn = os.getenv('AMBER_RENDER_CACHE', DEFAULT_CACHE_FILE)
+    return os.path.expanduser(fn) if fn else None
+
+
+def _which(program):
+    for path in os.getenv('PATH', '').split(os.pathsep):
+        fn = os.path.join(path, program)
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            return os.path.realpath(fn)
+    return None
+
+
+def _stamp(fn):
+    try:
+        st = os.stat(fn)
+        return [fn, st.st_size, st.st_mtime]
+    except OSError:
+        return None
+
+
+def recipe_hash(recipe_dir):
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(recipe_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            fn = os.path.join(dirpath, name)
+            h.update(os.path.relpath(fn, recipe_dir).encode('utf-8'))
+            with open(fn, 'rb') as fh:
+                h.update(fh.read())
+    return h.hexdigest()
+
+
+def build_env(build_command):
+    ''' Environment for `conda build --output`
+
+    CONDA_PY is set to the --py version: conda build --output uses CONDA_PY
+    over --py when making the py tag
+    (BUG: https://github.com/conda/conda-build/issues/3400)
+    '''
+    env = dict(os.environ)
+    if '--py' in build_command:
+        py = build_command[build_command.index('--py') + 1]
+        env['CONDA_PY'] = str(py).replace('.', '')
+    return env
+
+
+def cache_key(build_command, env):
+    parts = []
+    for arg in build_command:
+        if arg == '--no-test':
+            continue
+        if os.path.isdir(arg):
+            parts.append([os.path.abspath(arg), recipe_hash(arg)])
+        else:
+            parts.append(arg)
+    parts.append([[name, env.get(name)] for name in ENV_VARS])
+    parts.append(_which('conda'))
+    parts.append([_stamp(os.path.expanduser(fn)) for fn in CONFIG_FILES])
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def _load(fn):
+    try:
+        with open(fn) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save(fn, key, value):
+    dirname = os.path.dirname(fn)
+    try:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # merge: other processes (e.g. concurrent conda builds) may have
+        # written since we read.
+        content = _load(fn)
+        content[key] = value
+        tmp = '{}.{}.tmp'.format(fn, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(content, fh, indent=1)
+        os.rename(tmp, fn)
+    except (IOError, OSError) as e:
+        print('WARNING: can not write render cache {}: {}'.format(fn, e))
+
+
+def _render_in_process(build_command, env):
+    ''' Output of `build_command + ['--output']` from conda_build.api, or None
+    if it can not be done in process (no conda_build, other arguments than
+    --py, --croot and --no-test, or an error) '''
+    if conda_build_api is None or build_command[:2] != ['conda', 'build']:
+        return None
+    args = [arg for arg in build_command[2:] if arg != '--no-test']
+    kwargs = {}
+    recipes = []
+    options = {'--py': 'python', '--croot': 'croot'}
+    while args:
+        arg = args.pop(0)
+        if arg in options and args:
+            kwargs[options[arg]] = args.pop(0)
+        elif arg.startswith('-'):
+            return None
+        else:
+            recipes.append(arg)
+    # conda_build reads the environment of this process: CONDA_PY would win
+    # over --py (see build_env)
+    if len(recipes) != 1 or os.environ.get('CONDA_PY') not in (
+            None, env.get('CONDA_PY')):
+        return None
+    try:
+        with _render_lock:
+            paths = conda_build_api.get_output_file_paths(
+                recipes[0], **kwargs)
+    except Exception as e:
+        print('WARNING: rendering {} in process failed ({}), '
+              'using conda build --output'.format(recipes[0], e))
+        return None
+    return '\n'.join(paths)
+
+
+def output_path(build_command):
+    ''' Cached output of `build_command + ['--output']`
+
+    Parameters
+    ----------
+    build_command : list of str, e.g ['conda', 'build', recipe_dir, '--py', '3.6']
+    '''
+    env = build_env(build_command)
+    key = cache_key(build_command, env)
+    with _lock:
+        if key in _memory_cache:
+            return _memory_cache[key]
+    fn = cache_file()
+    if fn is not None:
+        value = _load(fn).get(key)
+        if value is not None:
+            with _lock:
+                _memory_cache[key] = value
+            return value
+
+    value = _render_in_process(build_command, env)
+    if value is None:
+        command = [arg for arg in build_command if arg != '--no-test']
+        value = subprocess.check_output(
+            command + ['--output'], env=env).decode().strip()
+    with _lock:
+        _memory_cache[key] = value
+    if fn is not None:
+        _save(fn, key, value)
+    return value
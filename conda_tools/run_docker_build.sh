@@ -11,6 +11,7 @@ build_only=$7 # True/False # Always the last
 DOCKER_IMAGE=ambermd/amber-build-box
 BZ2FILE=/root/miniconda3/conda-bld/linux-64/amber*.tar.bz2
 BUILD_ALL_SCRIPT=/ambertools-binary-build/build_all.py
+MANIFEST=/amberhome/linux-64/manifest-py${pyversion}.json
 
 echo "ambertools_binary_build_dir" $ambertools_binary_build_dir
 echo "AMBER_BUILD_TASK = " $AMBER_BUILD_TASK
@@ -40,18 +41,19 @@ cat << EOF | docker run -i \
     mkdir \$HOME/TMP
     cd \$HOME/TMP
 
+    if [ ! -d /amberhome/linux-64/ ]; then
+        mkdir /amberhome/linux-64
+    fi
+
+    # build_all.py on the host reads built package names from this manifest
     if [ "\$dry_run" = "True" ]; then
         echo "python $BUILD_ALL_SCRIPT --exclude-osx --no-docker -t $AMBER_BUILD_TASK --exclude-non-conda-user -d \
-               /amberhome -v $ambertools_version"
+               /amberhome -v $ambertools_version --manifest $MANIFEST"
         python $BUILD_ALL_SCRIPT --exclude-osx --no-docker -t $AMBER_BUILD_TASK --exclude-non-conda-user -d \
-               /amberhome -v $ambertools_version
+               /amberhome -v $ambertools_version --manifest $MANIFEST || exit 1
     else
         python $BUILD_ALL_SCRIPT --exclude-osx --no-docker -t $AMBER_BUILD_TASK --exclude-non-conda-user \
-               /amberhome -v $ambertools_version
-    fi
-
-    if [ ! -d /amberhome/linux-64/ ]; then
-        mkdir /amberhome/linux-64
+               /amberhome -v $ambertools_version --manifest $MANIFEST || exit 1
     fi
     # to avoid ovewriting MacOS build (we run a bunch of builds)
     if [ "\$dry_run" = "True" ]; then
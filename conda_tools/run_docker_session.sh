@@ -0,0 +1,88 @@
+#!/usr/bin/env bash
+
+# Start a single ambermd/amber-build-box container and run several builds in it.
+# Build jobs are read from stdin, one per line:
+#
+#     <AMBER_BUILD_TASK> <python version> <ambertools version> <dry_run: True/False>
+#
+# Example:
+#     printf "ambertools 2.7 19.0 False\nambertools 2.7 18.0 False\n" | \
+#         bash run_docker_session.sh $HOME/amber $HOME/ambertools-binary-build $HOME/amber-build-cache
+#
+# conda setup is done once and the container's conda package cache is kept
+# warm between jobs. If cache_dir is given, it is mounted as /build-cache and
+# used for conda packages, ccache (AMBER_CCACHE_DIR) and the staged source
+# (AMBER_STAGING_DIR), so the caches also
+# survive the container.
+# After each job, the built packages are copied to $amberhome/linux-64 and
+# a line
+#     AMBER_JOB_DONE <task> <pyversion> <ambertools version> <manifest>
+# is printed so the caller can pick them up while the next job is building.
+
+amberhome=$1
+ambertools_binary_build_dir=$2
+cache_dir=$3
+
+DOCKER_IMAGE=ambermd/amber-build-box
+BUILD_ALL_SCRIPT=/ambertools-binary-build/build_all.py
+
+echo "Running docker image $DOCKER_IMAGE (session)" >&2
+echo "Mouting $amberhome as /amberhome" >&2
+echo "Mouting $ambertools_binary_build_dir as /ambertools-binary-build" >&2
+
+cache_options=""
+if [ ! -z "$cache_dir" ]; then
+    mkdir -p $cache_dir/pkgs
+    echo "Mouting $cache_dir as /build-cache" >&2
+    cache_options="-v ${cache_dir}:/build-cache -e CONDA_PKGS_DIRS=/build-cache/pkgs,/root/miniconda3/pkgs"
+    cache_options="$cache_options -e AMBER_CCACHE_DIR=/build-cache/ccache"
+    cache_options="$cache_options -e AMBER_STAGING_DIR=/build-cache/staging"
+fi
+
+read -r -d '' SESSION_SCRIPT << EOF
+    export PATH=/root/miniconda3/bin:\$PATH
+    export AMBER_SRC=/amberhome
+    mkdir -p \$HOME/TMP
+    mkdir -p /amberhome/linux-64
+
+    while read -r task pyversion ambertools_version dry_run; do
+        if [ -z "\$task" ]; then
+            continue
+        fi
+        echo "Building \$task, python \$pyversion, AmberTools \$ambertools_version"
+        export AMBER_BUILD_TASK=\$task
+        manifest=/amberhome/linux-64/manifest-\$task-py\$pyversion-\$ambertools_version.json
+        options=""
+        if [ "\$dry_run" = "True" ]; then
+            options="-d"
+        fi
+        case \$task in
+            ambertools|ambertools_pack_all_pythons)
+                # build_all.py builds all python versions in one package
+                ;;
+            *)
+                options="\$options --py \$pyversion"
+                ;;
+        esac
+        # keep conda-bld and caches, start with an empty output folder
+        rm -rf \$HOME/TMP/amber-conda-bld
+        # < /dev/null: the build must not eat the remaining jobs from stdin
+        (cd \$HOME/TMP && \
+            python $BUILD_ALL_SCRIPT --exclude-osx --no-docker -t \$task \
+                --exclude-non-conda-user \$options /amberhome \
+                -v \$ambertools_version --manifest \$manifest < /dev/null) || exit 1
+        if [ "\$dry_run" != "True" ]; then
+            cp \$HOME/TMP/amber-conda-bld/linux-64/*.tar.bz2 /amberhome/linux-64/ || exit 1
+        fi
+        echo "AMBER_JOB_DONE \$task \$pyversion \$ambertools_version \$manifest"
+    done
+EOF
+
+docker run -i \
+           --rm \
+           -v ${amberhome}:/amberhome \
+           -v ${ambertools_binary_build_dir}:/ambertools-binary-build \
+           $cache_options \
+           -a stdin -a stdout -a stderr \
+           $DOCKER_IMAGE \
+           bash -c "$SESSION_SCRIPT"
@@ -0,0 +1,82 @@
+''' Fixtures shared by the tests: small packages and folder trees '''
+import io
+import os
+import tarfile
+
+import pytest
+
+
+def _sorted_items(files):
+    return sorted(files.items()) if isinstance(files, dict) else files
+
+
+def write_package(fn, files, mode='w:bz2'):
+    ''' Write the tar file `fn`
+
+    files : list of (name, content), written in that order, or dict (written
+        sorted by name). content is
+            bytes                   regular file, mode 0644
+            (bytes, mode)           regular file
+            None                    folder, mode 0755
+            ('symlink', target)
+            ('hardlink', target)
+    '''
+    with tarfile.open(fn, mode) as tar:
+        for name, content in _sorted_items(files):
+            member = tarfile.TarInfo(name)
+            fileobj = None
+            if content is None:
+                member.type = tarfile.DIRTYPE
+                member.mode = 0o755
+            elif isinstance(content, tuple) and content[0] == 'symlink':
+                member.type = tarfile.SYMTYPE
+                member.linkname = content[1]
+            elif isinstance(content, tuple) and content[0] == 'hardlink':
+                member.type = tarfile.LNKTYPE
+                member.linkname = content[1]
+            else:
+                content, member.mode = content if isinstance(
+                    content, tuple) else (content, 0o644)
+                member.size = len(content)
+                fileobj = io.BytesIO(content)
+            tar.addfile(member, fileobj)
+
+
+def write_tree(root, files):
+    ''' Create `files` in the folder `root` (str or py.path)
+
+    files : dict, path -> content, written sorted by path. content is
+            str                     file
+            (str, mode)             file
+            None                    empty folder
+            ('symlink', target)
+    '''
+    root = str(root)
+    for path, content in _sorted_items(files):
+        fn = os.path.join(root, path)
+        folder = fn if content is None else os.path.dirname(fn)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if content is None:
+            continue
+        if isinstance(content, tuple) and content[0] == 'symlink':
+            os.symlink(content[1], fn)
+            continue
+        content, mode = content if isinstance(content, tuple) else (content,
+                                                                    None)
+        with open(fn, 'w') as fh:
+            fh.write(content)
+        if mode is not None:
+            os.chmod(fn, mode)
+
+
+@pytest.fixture
+def make_package():
+    ''' write_package '''
+    return write_package
+
+
+@pytest.fixture
+def make_tree():
+    ''' write_tree '''
+    return write_tree
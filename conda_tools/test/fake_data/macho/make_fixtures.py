@@ -0,0 +1,115 @@
+""" Write the Mach-O fixtures of test_macho.py (headers and load commands
+only, no code).
+
+    python make_fixtures.py
+"""
+import struct
+
+CPU_TYPE_X86_64 = 0x01000007
+CPU_TYPE_I386 = 7
+CPU_TYPE_POWERPC = 18
+MH_EXECUTE = 2
+MH_DYLIB = 6
+
+
+def _pad(data, align=8):
+    return data + b'\0' * (-len(data) % align)
+
+
+def dylib_command(cmd, name, endian):
+    name = _pad(name.encode() + b'\0')
+    return struct.pack(endian + '6I', cmd, 24 + len(name), 24, 2, 0x10000,
+                       0x10000) + name
+
+
+def rpath_command(path, endian):
+    path = _pad(path.encode() + b'\0', 4)
+    return struct.pack(endian + '3I', 0x8000001c, 12 + len(path), 12) + path
+
+
+def segment_command(endian):
+    # LC_SEGMENT_64 __PAGEZERO, skipped by the reader
+    return struct.pack(endian + '2I16s4Q4I', 0x19, 72, b'__PAGEZERO', 0,
+                       0x100000000, 0, 0, 0, 0, 0, 0)
+
+
+def mach_header(cputype, filetype, commands, bits=64, endian='<'):
+    commands = b''.join(commands)
+    n_commands = 0
+    pos = 0
+    while pos < len(commands):
+        pos += struct.unpack_from(endian + 'I', commands, pos + 4)[0]
+        n_commands += 1
+    if bits == 64:
+        header = struct.pack(endian + '8I', 0xfeedfacf, cputype, 3, filetype,
+                             n_commands, len(commands), 0x85, 0)
+    else:
+        header = struct.pack(endian + '7I', 0xfeedface, cputype, 3, filetype,
+                             n_commands, len(commands), 0x85)
+    return header + commands
+
+
+def fat(slices, align=4096):
+    header = struct.pack('>2I', 0xcafebabe, len(slices))
+    offset = align
+    archs = []
+    body = b''
+    for cputype, data in slices:
+        archs.append(
+            struct.pack('>5I', cputype, 3, offset, len(data), 12))
+        body += data + b'\0' * (-len(data) % align)
+        offset += len(data) + (-len(data) % align)
+    header += b''.join(archs)
+    return header + b'\0' * (align - len(header)) + body
+
+
+def main():
+    libcpptraj = mach_header(CPU_TYPE_X86_64, MH_DYLIB, [
+        segment_command('<'),
+        dylib_command(0xd, '@rpath/libcpptraj.dylib', '<'),
+        dylib_command(0xc, '/usr/local/gfortran/lib/libgfortran.3.dylib',
+                      '<'),
+        dylib_command(0xc, '@rpath/libsander.dylib', '<'),
+        dylib_command(0x80000018, '/usr/lib/libz.1.dylib', '<'),
+        dylib_command(0xc, '/usr/lib/libSystem.B.dylib', '<'),
+        rpath_command('@loader_path/../lib', '<'),
+    ])
+    with open('libcpptraj.dylib', 'wb') as fh:
+        fh.write(libcpptraj)
+    with open('truncated.dylib', 'wb') as fh:
+        fh.write(libcpptraj[:120])
+
+    slice_64 = mach_header(CPU_TYPE_X86_64, MH_EXECUTE, [
+        segment_command('<'),
+        dylib_command(0xc, '@rpath/libcpptraj.dylib', '<'),
+        dylib_command(0xc, '/usr/lib/libSystem.B.dylib', '<'),
+        rpath_command('@loader_path/../lib', '<'),
+    ])
+    slice_32 = mach_header(
+        CPU_TYPE_I386,
+        MH_EXECUTE, [
+            dylib_command(0xc, '@rpath/libcpptraj.dylib', '<'),
+            dylib_command(0xc, '/usr/local/gfortran/lib/libgcc_s.1.dylib',
+                          '<'),
+            dylib_command(0xc, '/usr/lib/libSystem.B.dylib', '<'),
+            rpath_command('@loader_path/../lib', '<'),
+            rpath_command('/usr/local/gfortran/lib', '<'),
+        ],
+        bits=32)
+    with open('cpptraj', 'wb') as fh:
+        fh.write(fat([(CPU_TYPE_X86_64, slice_64), (CPU_TYPE_I386,
+                                                    slice_32)]))
+
+    with open('sqm.ppc', 'wb') as fh:
+        fh.write(
+            mach_header(
+                CPU_TYPE_POWERPC,
+                MH_EXECUTE, [
+                    dylib_command(0xc, '/usr/lib/libSystem.B.dylib', '>'),
+                ],
+                bits=32,
+                endian='>'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import zipfile
+import subprocess
+import pytest
+
+sys.path.insert(0, '..')
+import archive_codecs
+import package_info
+from edit_package import streaming_conda_package
+
+has_zstd = (archive_codecs.zstandard is not None
+            or archive_codecs._which('zstd') is not None)
+
+
+PACKAGE = [
+    ('info/index.json', b'{"version": "18.0", "subdir": "linux-64"}'),
+    ('bin/tleap', b'#!/bin/sh\nteLeap $*\n'),
+    ('lib/libsff.so', b'\x7fELF' * 1000),
+]
+
+
+def test_archive_name():
+    assert archive_codecs.archive_name('at-18.0-0.tar',
+                                       'zstd') == 'at-18.0-0.tar.zst'
+    assert archive_codecs.archive_name('at-18.0-0.tar',
+                                       'conda') == 'at-18.0-0.conda'
+
+
+@pytest.mark.parametrize('archive_format', ['bz2', 'xz', 'zstd'])
+def test_tar_formats(tmpdir, archive_format, make_package):
+    if archive_format == 'zstd' and not has_zstd:
+        pytest.skip('no zstd')
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    with streaming_conda_package(
+            pkg_name,
+            output_dir=str(tmpdir.join('out')),
+            add_date=False,
+            archive_format=archive_format) as output_fn:
+        pass
+    assert output_fn.endswith(archive_codecs.EXTENSIONS[archive_format])
+    # stock tar can read it
+    names = subprocess.check_output(
+        ['tar', '-tf', output_fn]).decode().split()
+    assert sorted(names) == [
+        'amber18/bin/tleap', 'amber18/info/index.json', 'amber18/lib/libsff.so'
+    ]
+    assert archive_codecs.read_archive(output_fn, archive_format) > 3000
+
+
+@pytest.mark.skipif(not has_zstd, reason='no zstd')
+def test_conda_format(tmpdir, make_package):
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    output_fn = archive_codecs.convert_package(
+        pkg_name, str(tmpdir.join('ambertools-18.0-0.conda')), 'conda')
+    with zipfile.ZipFile(output_fn) as zf:
+        assert sorted(zf.namelist()) == [
+            'info-ambertools-18.0-0.tar.zst', 'metadata.json',
+            'pkg-ambertools-18.0-0.tar.zst'
+        ]
+        assert json.loads(zf.read('metadata.json').decode()) == {
+            'conda_pkg_format_version': 2
+        }
+        zf.extractall(str(tmpdir.join('conda')))
+    info = subprocess.check_output([
+        'tar', '-tf',
+        str(tmpdir.join('conda', 'info-ambertools-18.0-0.tar.zst'))
+    ]).decode().split()
+    assert info == ['info/index.json']
+    assert package_info.read_index_json(
+        output_fn, sidecar=False)['version'] == '18.0'
+
+    with pytest.raises(ValueError):
+        with streaming_conda_package(
+                pkg_name, output_dir=str(tmpdir), archive_format='conda'):
+            pass
+
+
+@pytest.mark.skipif(not has_zstd, reason='no zstd')
+def test_benchmark(tmpdir, capsys, make_package):
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    archive_codecs.main([pkg_name, '--benchmark'])
+    out = capsys.readouterr().out
+    for archive_format in archive_codecs.FORMATS:
+        assert '    {} '.format(archive_format) in out
+    assert os.listdir(str(tmpdir)) == ['ambertools-18.0-0.tar.bz2']
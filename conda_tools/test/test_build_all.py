@@ -2,6 +2,7 @@ import os
 import sys
 import tempfile
 import subprocess
+import threading
 from mock import patch
 from contextlib import contextmanager
 from shutil import rmtree
@@ -75,3 +76,299 @@ def test_build_all_cmd_with_assertion():
 
 def test_build_single_python_verions():
     build_all.main(['--py', '2.7', '-d'] + extend_cmd)
+
+
+@patch('build_all.built_tarfile_dir')
+@patch('subprocess.call')
+def test_build_python_components_concurrently(mock_call, mock_built_tarfile_dir):
+    class Opt():
+        pass
+
+    opt = Opt()
+    opt.jobs = 2
+    opt.skip_test = True
+    opt.dry_run = False
+    mock_call.return_value = 0
+
+    with tempfolder():
+        tdir = os.getcwd()
+        mock_built_tarfile_dir.side_effect = lambda cmd: os.path.join(
+            cmd[cmd.index('--croot') + 1], 'fake-py{}.tar.bz2'.format(cmd[4]))
+
+        def call_effect(cmd, **kwargs):
+            with open(mock_built_tarfile_dir(cmd), 'w') as fh:
+                fh.write('fake')
+            return 0
+        mock_call.side_effect = call_effect
+
+        build_all.build_python_components_concurrently(
+            'recipe', ('3.6', '3.7'), opt,
+            croot_dir=os.path.join(tdir, 'croot'),
+            at_temp_folder=os.path.join(tdir, 'at_temp'))
+
+        commands = sorted(c[0][0] for c in mock_call.call_args_list)
+        assert commands == [
+            ['conda', 'build', 'recipe', '--py', '3.6', '--croot',
+             os.path.join(tdir, 'croot', 'py3.6'), '--no-test'],
+            ['conda', 'build', 'recipe', '--py', '3.7', '--croot',
+             os.path.join(tdir, 'croot', 'py3.7'), '--no-test'],
+        ]
+        assert sorted(os.listdir('at_temp')) == ['fake-py3.6.tar.bz2',
+                                                 'fake-py3.7.tar.bz2']
+        # each build gets its share through its own environment
+        assert [
+            c[1]['env'][build_all.job_slots.BUILDS_ENV_VAR]
+            for c in mock_call.call_args_list
+        ] == ['2', '2']
+        assert build_all.job_slots.BUILDS_ENV_VAR not in os.environ
+
+
+def test_conda_build_concurrent_builds():
+    # e.g. python-components jobs of --schedule, one build each
+    started = threading.Event()
+    done = threading.Event()
+    n_builds = []
+
+    def run(cmd, env):
+        n_builds.append(env[build_all.job_slots.BUILDS_ENV_VAR])
+        started.set()
+        done.wait()
+
+    thread = threading.Thread(
+        target=build_all.conda_build,
+        args=(['conda', 'build', 'first'], ),
+        kwargs={'run': run})
+    thread.start()
+    started.wait()
+
+    def run_second(cmd, env):
+        n_builds.append(env[build_all.job_slots.BUILDS_ENV_VAR])
+        done.set()
+
+    # while the first build runs
+    build_all.conda_build(['conda', 'build', 'second'], run=run_second)
+    thread.join()
+    build_all.conda_build(['conda', 'build', 'third'],
+                          run=lambda cmd, env: n_builds.append(
+                              env[build_all.job_slots.BUILDS_ENV_VAR]))
+    assert n_builds == ['1', '2', '1']
+    assert build_all._running_builds == [0]
+
+
+@patch('subprocess.check_call')
+@patch('build_all.built_tarfile_dir')
+def test_build_all_schedule(mock_built_tarfile_dir, mock_check_call):
+    mock_built_tarfile_dir.side_effect = lambda cmd: '/fake/osx-64/{}-0.tar.bz2'.format(
+        os.path.basename(cmd[2]))
+
+    def pack(cmd):
+        manifest = cmd[cmd.index('--manifest') + 1]
+        build_all.build_manifest.write_manifest(manifest, 'pack-non-conda', [
+            build_all.build_manifest.artifact_entry(
+                '/fake/non-conda-install/osx-64.x.tar.bz2')
+        ])
+    mock_check_call.side_effect = pack
+
+    with tempfolder(), patch('build_all.CONTAINER_FOLDER', 'amber-conda-bld'):
+        tdir = os.getcwd()
+        build_all.main(['--schedule', '-d', '--exclude-linux'] + extend_cmd)
+        manifest = build_all.build_manifest.read_manifest(
+            os.path.join(tdir, 'amber-conda-bld', 'manifest.json'))
+    pack_commands = [c[0][0] for c in mock_check_call.call_args_list]
+    assert len(pack_commands) == 1
+    assert pack_commands[0][2].endswith(
+        'osx-64/conda-ambertools-combine-pythons-0.tar.bz2')
+    assert '-d' in pack_commands[0]
+    assert [artifact['filename'] for artifact in manifest['artifacts']] == [
+        'conda-ambertools-combine-pythons-0.tar.bz2',
+        'osx-64.x.tar.bz2'
+    ]
+
+
+@patch('build_cache.toolchain_fingerprint')
+@patch('build_all.built_tarfile_dir')
+def test_conda_build_with_cache(mock_built_tarfile_dir, mock_toolchain):
+    mock_toolchain.return_value = 'gcc'
+    with tempfolder():
+        os.makedirs('amber/AmberTools')
+        os.makedirs('recipe')
+        mock_built_tarfile_dir.return_value = os.path.abspath(
+            'conda-bld/ambertools-py27.tar.bz2')
+        calls = []
+
+        def run(cmd, env):
+            calls.append(cmd)
+            os.makedirs('conda-bld')
+            with open('conda-bld/ambertools-py27.tar.bz2', 'w') as fh:
+                fh.write('built')
+
+        command = ['conda', 'build', 'recipe', '--py', '2.7']
+        with patch.dict(os.environ, {'AMBER_SRC': os.path.abspath('amber')}):
+            with patch('build_all.BUILD_CACHE',
+                       build_all.build_cache.BuildCache('cache')):
+                build_all.conda_build(command, run=run)
+                rmtree('conda-bld')
+                build_all.conda_build(command, run=run)
+        assert calls == [command]
+        assert os.path.exists('conda-bld/ambertools-py27.tar.bz2')
+
+
+@patch('build_cache.toolchain_fingerprint')
+@patch('build_all.built_tarfile_dir')
+def test_conda_build_with_cache_failed_build(mock_built_tarfile_dir,
+                                            mock_toolchain):
+    mock_toolchain.return_value = 'gcc'
+    with tempfolder():
+        os.makedirs('amber/AmberTools')
+        os.makedirs('recipe')
+        os.makedirs('conda-bld')
+        mock_built_tarfile_dir.return_value = os.path.abspath(
+            'conda-bld/ambertools-py27.tar.bz2')
+        command = ['conda', 'build', 'recipe', '--py', '2.7']
+        cache = build_all.build_cache.BuildCache('cache')
+        with patch.dict(os.environ, {'AMBER_SRC': os.path.abspath('amber')}):
+            with patch('build_all.BUILD_CACHE', cache):
+                # no package built
+                build_all.conda_build(command, run=lambda cmd, env: 1)
+                # stale package of an earlier run
+                with open('conda-bld/ambertools-py27.tar.bz2', 'w') as fh:
+                    fh.write('stale')
+                build_all.conda_build(command, run=lambda cmd, env: 1)
+            key = cache.key(command, os.path.abspath('amber'), ())
+        assert cache.lookup(key) is None
+
+
+def test_perform_build_with_docker_session():
+    class Opt():
+        pass
+
+    with tempfolder():
+        tdir = os.getcwd()
+        opt = Opt()
+        opt.amberhome = os.path.join(tdir, 'amber')
+        opt.build_task = 'pytraj'
+        opt.ambertools_version = '19.0'
+        opt.dry_run = False
+        opt.sudo = False
+        opt.docker_cache_dir = None
+        os.makedirs(os.path.join(opt.amberhome, 'linux-64'))
+        os.mkdir('container')
+        # fake session: read jobs from stdin, "build" and report each job
+        fake_session = os.path.join(tdir, 'fake_session.sh')
+        with open(fake_session, 'w') as fh:
+            fh.write('''
+amberhome=$1
+while read -r task pyversion atversion dry_run; do
+    fn=$task-$atversion-py$pyversion.tar.bz2
+    touch $amberhome/linux-64/$fn
+    manifest=/amberhome/linux-64/manifest-$task-$pyversion.json
+    python {script} $amberhome/linux-64/manifest-$task-$pyversion.json \
+        $amberhome/linux-64/$fn --stage conda-build
+    echo "AMBER_JOB_DONE $task $pyversion $atversion $manifest"
+done
+'''.format(script=os.path.join(os.path.abspath(this_dir), '..',
+                               'build_manifest.py')))
+        with patch('build_all.DOCKER_SESSION_SCRIPT', fake_session):
+            files = build_all.perform_build_with_docker_session(
+                opt, os.path.join(tdir, 'container'), ['3.6', '3.7'])
+        assert files == [
+            os.path.join(tdir, 'container', 'pytraj-19.0-py3.6.tar.bz2'),
+            os.path.join(tdir, 'container', 'pytraj-19.0-py3.7.tar.bz2'),
+        ]
+        assert sorted(os.listdir('container')) == [
+            'pytraj-19.0-py3.6.tar.bz2', 'pytraj-19.0-py3.7.tar.bz2'
+        ]
+
+
+@patch('build_all.pack_non_conda')
+def test_pack_non_conda_packages(mock_pack_non_conda, capsys):
+    class Opt():
+        pack_jobs = 2
+
+    with tempfolder():
+        for name in ['a.tar.bz2', 'b.tar.bz2', 'c.tar.bz2']:
+            with open(name, 'wb') as fh:
+                fh.write(b'x' * 1024)
+        mock_pack_non_conda.side_effect = (
+            lambda fn, opt, pack_script, output_dir: 'non-conda-' + fn)
+        outputs = build_all.pack_non_conda_packages(
+            ['a.tar.bz2', 'b.tar.bz2', 'c.tar.bz2'], Opt(), 'pack.py')
+    assert outputs == [
+        'non-conda-a.tar.bz2', 'non-conda-b.tar.bz2', 'non-conda-c.tar.bz2'
+    ]
+    out = capsys.readouterr().out
+    assert 'Non-conda packages (2 jobs)' in out
+    assert 'MB/s' in out
+    assert build_all.pack_non_conda_packages([], Opt(), 'pack.py') == []
+
+
+def test_build_graph():
+    class Opt():
+        exclude_osx = True
+        exclude_linux = False
+        exclude_non_conda_user = False
+        no_docker = False
+        docker_session = False
+        build_task = 'ambertools'
+        skip_test = True
+        dry_run = True
+        validate = False
+
+    with patch.dict(os.environ, {build_all.job_slots.ENV_VAR: ''}):
+        jobs = build_all.build_graph(
+            Opt(), 'recipe', {'linux-64': 'amber-conda-bld/linux-64'},
+            ['2.7', '3.6'], 'pack.py')
+        scheduler = build_all.build_scheduler.Scheduler(jobs, cpus=4)
+    # one pack job per package, each waits for its own build only
+    assert scheduler.dependencies(
+        scheduler['linux-64:docker-py3.6:pack-non-conda']) == set(
+            ['linux-64:docker-3.6'])
+    assert sorted(job.name for job in jobs if 'pack-non-conda' in job.name) == [
+        'linux-64:docker-py2.7:pack-non-conda',
+        'linux-64:docker-py3.6:pack-non-conda'
+    ]
+    assert scheduler['linux-64:docker-3.6'].memory == (
+        build_all.cpu_count() * build_all.job_slots.MEMORY_PER_JOB)
+    assert scheduler['linux-64:docker-py2.7:pack-non-conda'].memory == (
+        build_all.PACK_MEMORY)
+    # collect waits for all builds
+    assert scheduler.dependencies(scheduler['linux-64:collect']) == set(
+        ['linux-64:docker-2.7', 'linux-64:docker-3.6'])
+
+
+@patch('build_all.pack_non_conda')
+def test_build_graph_shares_temp_space_budget(mock_pack_non_conda):
+    class Opt():
+        exclude_osx = True
+        exclude_linux = False
+        exclude_non_conda_user = False
+        no_docker = False
+        docker_session = False
+        build_task = 'ambertools'
+        skip_test = True
+        dry_run = True
+        validate = False
+        pack_jobs = 1
+
+    budget = build_all.build_scheduler.TempSpaceBudget(100)
+    budgets = []
+
+    def reserve(nbytes):
+        budgets.append(budget)
+        return original_reserve(nbytes)
+
+    original_reserve = budget.reserve
+    budget.reserve = reserve
+    mock_pack_non_conda.side_effect = (
+        lambda fn, opt, pack_script, output_dir: 'non-conda-' + fn)
+    jobs = build_all.build_graph(
+        Opt(), 'recipe', {'linux-64': 'amber-conda-bld/linux-64'},
+        ['2.7', '3.6'], 'pack.py', budget=budget)
+    for job in jobs:
+        if job.name.startswith('linux-64:docker-'):
+            job.result = [job.name + '.tar.bz2']
+    for job in jobs:
+        if job.name.endswith(':pack-non-conda'):
+            job.result = job.run()
+    # every pack job reserves from the same budget
+    assert len(budgets) == 2
@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+from shutil import rmtree
+from contextlib import contextmanager
+from mock import patch
+
+sys.path.insert(0, '..')
+import build_cache
+
+
+@contextmanager
+def tempfolder():
+    my_temp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(my_temp)
+    yield my_temp
+    os.chdir(cwd)
+    rmtree(my_temp)
+
+
+def write(fn, content):
+    dirname = os.path.dirname(fn)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(fn, 'w') as fh:
+        fh.write(content)
+
+
+def test_strip_build_command():
+    with tempfolder():
+        os.mkdir('recipe')
+        command = ['conda', 'build', os.path.abspath('recipe'), '--py', '3.6',
+                   '--croot', '/tmp/croot/py3.6', '--no-test']
+        assert build_cache.strip_build_command(command) == [
+            'recipe', '--py', '3.6'
+        ]
+
+
+@patch('build_cache.toolchain_fingerprint')
+def test_key_and_restore(mock_toolchain):
+    mock_toolchain.return_value = 'gcc 7'
+    with tempfolder():
+        write('amber/AmberTools/src/sander.F90', 'program sander')
+        write('amber/linux-64/old.tar.bz2', 'ignored')
+        write('recipe/meta.yaml', 'package: ambertools')
+        cache = build_cache.BuildCache('cache')
+        command = ['conda', 'build', 'recipe', '--py', '2.7']
+
+        key = cache.key(command, 'amber')
+        assert key == build_cache.BuildCache('cache').key(command, 'amber')
+        assert key == cache.key(command + ['--no-test'], 'amber')
+        assert key != cache.key(['conda', 'build', 'recipe', '--py', '3.6'],
+                                'amber')
+        with patch.dict(os.environ, {'AMBER_BUILD_TASK': 'ambermini'}):
+            assert cache.key(command, 'amber') != key
+        # built packages copied to AMBER_SRC/linux-64 do not matter
+        write('amber/linux-64/new.tar.bz2', 'ignored')
+        assert key == cache.key(command, 'amber')
+
+        assert not cache.restore(key, 'out/ambertools-py27.tar.bz2')
+        write('built/ambertools-py27.tar.bz2', 'package')
+        cache.store(key, 'built/ambertools-py27.tar.bz2')
+        assert cache.restore(key, 'out/ambertools-py27.tar.bz2')
+        with open('out/ambertools-py27.tar.bz2') as fh:
+            assert fh.read() == 'package'
+        # different rendered filename: miss
+        assert not cache.restore(key, 'out/ambertools-py27_1.tar.bz2')
+
+        write('amber/AmberTools/src/sander.F90', 'program sander2')
+        assert key != cache.key(command, 'amber')
+        write('recipe/meta.yaml', 'package: ambertools2')
+        assert cache.key(command, 'amber') != cache.key(
+            command, 'amber', inputs=['built/ambertools-py27.tar.bz2'])
@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import pytest
+from shutil import rmtree
+from contextlib import contextmanager
+
+sys.path.insert(0, '..')
+import build_manifest
+
+
+@contextmanager
+def tempfolder():
+    my_temp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(my_temp)
+    yield
+    os.chdir(cwd)
+    rmtree(my_temp)
+
+
+def test_artifact_entry():
+    with tempfolder():
+        fn = 'linux-64.ambertools-19.0-py36_0.tar.bz2'
+        with open(fn, 'wb') as fh:
+            fh.write(b'amber')
+        entry = build_manifest.artifact_entry(fn)
+        assert entry['path'] == os.path.abspath(fn)
+        assert entry['filename'] == fn
+        assert entry['platform'] == 'linux-64'
+        assert entry['pyver'] == '3.6'
+        assert entry['size'] == 5
+        assert entry['sha256'] == hashlib.sha256(b'amber').hexdigest()
+
+        # dry run: not existing file
+        entry = build_manifest.artifact_entry('osx-64/ambertools-19.0-0.tar.bz2')
+        assert entry['platform'] == 'osx-64'
+        assert entry['pyver'] is None
+        assert 'size' not in entry and 'sha256' not in entry
+
+
+def test_main_and_read():
+    with tempfolder():
+        with open('a.tar.bz2', 'w') as fh:
+            fh.write('a')
+        build_manifest.main(['out/manifest.json', 'a.tar.bz2', '--stage',
+                             'conda-build', '--platform', 'linux-64',
+                             '--no-checksum'])
+        manifest = build_manifest.read_manifest('out/manifest.json')
+        assert manifest['stage'] == 'conda-build'
+        assert manifest['artifacts'][0]['platform'] == 'linux-64'
+        assert 'sha256' not in manifest['artifacts'][0]
+        assert build_manifest.artifact_filenames('out/manifest.json') == [
+            'a.tar.bz2'
+        ]
+
+        with open('bad.json', 'w') as fh:
+            json.dump({'manifest_version': 0}, fh)
+        with pytest.raises(ValueError):
+            build_manifest.read_manifest('bad.json')
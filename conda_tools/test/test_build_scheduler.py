@@ -0,0 +1,122 @@
+import sys
+import time
+import threading
+import pytest
+
+sys.path.insert(0, '..')
+from build_scheduler import Job, Scheduler, TempSpaceBudget
+
+
+def test_order_and_results():
+    calls = []
+
+    def make(name, value):
+        def action():
+            calls.append(name)
+            return value
+        return action
+
+    jobs = [
+        Job('pack', make('pack', 'packed'), inputs=['conda']),
+        Job('combine', make('combine', 'combined'), inputs=['py27', 'py36'],
+            outputs=['conda']),
+        Job('py36', make('py36', 'at36'), inputs=['py27'], outputs=['py36']),
+        Job('py27', make('py27', 'at27'), outputs=['py27']),
+    ]
+    scheduler = Scheduler(jobs, cpus=4)
+    assert [job.name for job in scheduler.order()] == [
+        'py27', 'py36', 'combine', 'pack'
+    ]
+    assert scheduler.dependencies(scheduler['combine']) == set(['py27', 'py36'])
+    scheduler.run()
+    assert calls == ['py27', 'py36', 'combine', 'pack']
+    assert scheduler['combine'].result == 'combined'
+    assert [job.name for job in scheduler.critical_path()] == [
+        'py27', 'py36', 'combine', 'pack'
+    ]
+
+
+def test_independent_jobs_run_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+
+    def wait():
+        barrier.wait()
+
+    jobs = [Job('job{}'.format(i), wait, outputs=[str(i)]) for i in range(3)]
+    Scheduler(jobs, cpus=3).run()
+
+
+def test_cpu_budget():
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    jobs = [Job('job{}'.format(i), work, cpus=2) for i in range(4)]
+    # a job asking for more than the budget still runs (alone)
+    jobs.append(Job('big', work, cpus=100))
+    Scheduler(jobs, cpus=4).run()
+    assert max(max_running) == 2
+
+
+def test_failure():
+    def fail():
+        raise ValueError('oops')
+
+    jobs = [
+        Job('fail', fail, outputs=['a']),
+        Job('never', lambda: 1, inputs=['a']),
+    ]
+    scheduler = Scheduler(jobs)
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert scheduler['never'].start is None
+
+
+def test_invalid_graph():
+    with pytest.raises(ValueError):
+        Scheduler([Job('a', 'x', inputs=['b'], outputs=['a']),
+                   Job('b', 'x', inputs=['a'], outputs=['b'])])
+    with pytest.raises(ValueError):
+        Scheduler([Job('a', 'x', inputs=['missing'])])
+    with pytest.raises(ValueError):
+        Scheduler([Job('a', 'x', outputs=['c']), Job('b', 'x', outputs=['c'])])
+
+
+def test_command_job_dry_run(capsys):
+    Scheduler([Job('cmd', ['conda', 'build', 'recipe'])], dry_run=True).run()
+    assert "['conda', 'build', 'recipe']" in capsys.readouterr().out
+
+
+def test_temp_space_budget():
+    budget = TempSpaceBudget(100)
+    in_use = []
+    max_in_use = []
+    lock = threading.Lock()
+
+    def work(nbytes):
+        with budget.reserve(nbytes):
+            with lock:
+                in_use.append(nbytes)
+                max_in_use.append(sum(in_use))
+            time.sleep(0.05)
+            with lock:
+                in_use.remove(nbytes)
+
+    # 500 is more than the budget: runs alone
+    threads = [threading.Thread(target=work, args=(nbytes,))
+               for nbytes in [60, 60, 30, 500]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(max_in_use) <= 500
+    assert all(total <= 100 or total == 500 for total in max_in_use)
+    assert budget.used == 0
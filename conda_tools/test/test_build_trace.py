@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import subprocess
+from mock import patch
+
+sys.path.insert(0, '..')
+import build_trace
+
+
+@build_trace.traced()
+def make_install():
+    with build_trace.span('make', target='install'):
+        pass
+
+
+def test_span_without_trace_dir():
+    with patch.dict(os.environ):
+        os.environ.pop('AMBER_TRACE_DIR', None)
+        make_install()
+        assert build_trace._events == []
+
+
+def test_span_and_merge(tmpdir):
+    trace_dir = str(tmpdir.join('trace'))
+    with patch.dict(os.environ, {'AMBER_TRACE_DIR': trace_dir}):
+        with build_trace.span('build_all'):
+            make_install()
+        build_trace.flush()
+        assert build_trace._events == []
+
+        # spans from another process, e.g. a conda build script
+        script = ('import sys; sys.path.insert(0, {!r}); import build_trace\n'
+                  'with build_trace.span("configure"): pass\n').format(
+                      os.path.dirname(os.path.abspath(build_trace.__file__)))
+        subprocess.check_call([sys.executable, '-c', script])
+
+        summary = build_trace.merge(trace_dir)
+
+    assert len(os.listdir(trace_dir)) == 4
+    with open(os.path.join(trace_dir, build_trace.TRACE_FILE)) as fh:
+        events = json.load(fh)['traceEvents']
+    spans = dict((event['name'], event) for event in events
+                 if event['ph'] == 'X')
+    assert sorted(spans) == ['build_all', 'configure', 'make', 'make_install']
+    assert spans['make']['args'] == {
+        'target': 'install',
+        'parent': 'make_install',
+        'depth': 2
+    }
+    assert spans['build_all']['args']['depth'] == 0
+    assert spans['configure']['pid'] != spans['build_all']['pid']
+    build_all = spans['build_all']
+    assert build_all['ts'] <= spans['make']['ts']
+    assert (spans['make']['ts'] + spans['make']['dur'] <=
+            build_all['ts'] + build_all['dur'])
+    assert 'Slowest spans' in summary
+    assert 'make_install (x1)' in summary
+    with open(os.path.join(trace_dir, build_trace.SUMMARY_FILE)) as fh:
+        assert fh.read() == summary
+
+    build_trace.clean(trace_dir)
+    assert sorted(os.listdir(trace_dir)) == [
+        build_trace.SUMMARY_FILE, build_trace.TRACE_FILE
+    ]
+
+
+def test_flush_reused_pid(tmpdir):
+    trace_dir = tmpdir.mkdir('trace')
+    # left by an earlier run whose process had the same pid
+    old = trace_dir.join('trace-{}.json'.format(os.getpid()))
+    old.write('[]')
+    with patch.dict(os.environ, {'AMBER_TRACE_DIR': str(trace_dir)}):
+        with build_trace.span('first'):
+            pass
+        build_trace.flush()
+        with build_trace.span('second'):
+            pass
+        build_trace.flush()
+    assert old.read() == '[]'
+    assert len(trace_dir.listdir()) == 3
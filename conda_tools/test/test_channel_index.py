@@ -0,0 +1,67 @@
+import os
+import bz2
+import sys
+import json
+import hashlib
+from mock import patch
+
+sys.path.insert(0, '..')
+import channel_index
+
+
+def package_files(version):
+    index = {
+        'name': 'ambertools',
+        'version': version,
+        'build': 'py27_0',
+        'build_number': 0,
+        'depends': ['numpy'],
+        'subdir': 'linux-64'
+    }
+    return [('info/index.json', json.dumps(index).encode())]
+
+
+def test_index_channel(tmpdir, make_package):
+    channel = str(tmpdir)
+    linux = tmpdir.mkdir('linux-64')
+    pkg_18 = str(linux.join('ambertools-18.0-py27_0.tar.bz2'))
+    make_package(pkg_18, package_files('18.0'))
+    linux.join('readme.txt').write('not a package')
+
+    results = channel_index.index_channel(channel)
+    assert sorted(results) == ['linux-64', 'noarch']
+    with open(os.path.join(channel, 'noarch', 'repodata.json')) as fh:
+        assert json.load(fh)['packages'] == {}
+
+    with open(str(linux.join('repodata.json'))) as fh:
+        repodata = json.load(fh)
+    assert repodata['info'] == {'subdir': 'linux-64'}
+    assert repodata['repodata_version'] == 1
+    record = repodata['packages']['ambertools-18.0-py27_0.tar.bz2']
+    assert record['version'] == '18.0'
+    assert record['depends'] == ['numpy']
+    assert record['size'] == os.path.getsize(pkg_18)
+    with open(pkg_18, 'rb') as fh:
+        content = fh.read()
+    assert record['md5'] == hashlib.md5(content).hexdigest()
+    assert record['sha256'] == hashlib.sha256(content).hexdigest()
+    with open(str(linux.join('repodata.json.bz2')), 'rb') as fh:
+        assert json.loads(bz2.decompress(fh.read()).decode()) == repodata
+
+    # only the new package is read
+    pkg_19 = str(linux.join('ambertools-19.0-py27_0.tar.bz2'))
+    make_package(pkg_19, package_files('19.0'))
+    with patch('channel_index.package_record',
+               wraps=channel_index.package_record) as package_record:
+        repodata, n_read = channel_index.index_subdir(str(linux))
+    package_record.assert_called_once_with(pkg_19)
+    assert n_read == 1
+    assert sorted(repodata['packages']) == [
+        'ambertools-18.0-py27_0.tar.bz2', 'ambertools-19.0-py27_0.tar.bz2'
+    ]
+
+    # removed package
+    os.remove(pkg_18)
+    repodata, n_read = channel_index.index_subdir(str(linux))
+    assert n_read == 0
+    assert sorted(repodata['packages']) == ['ambertools-19.0-py27_0.tar.bz2']
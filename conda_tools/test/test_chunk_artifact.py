@@ -0,0 +1,61 @@
+import os
+import sys
+import hashlib
+import subprocess
+
+import pytest
+
+sys.path.insert(0, '..')
+import chunk_artifact
+import build_manifest
+
+
+def test_split_and_join(tmpdir):
+    fn = str(tmpdir.join('amber18.tar.gz'))
+    content = os.urandom(2500)
+    with open(fn, 'wb') as fh:
+        fh.write(content)
+
+    prefix = str(tmpdir.join('chunks', 'tmp_linux-64_AT'))
+    os.makedirs(os.path.dirname(prefix))
+    entry = chunk_artifact.split_file(
+        fn, prefix, chunk_size=1000, platform='linux-64')
+    assert entry['platform'] == 'linux-64'
+    assert 'path' not in entry
+    assert entry['size'] == 2500
+    assert entry['sha256'] == hashlib.sha256(content).hexdigest()
+    assert [chunk['filename'] for chunk in entry['chunks']] == [
+        'tmp_linux-64_ATaa', 'tmp_linux-64_ATab', 'tmp_linux-64_ATac'
+    ]
+    assert [chunk['size'] for chunk in entry['chunks']] == [1000, 1000, 500]
+    assert entry['chunks'][2]['sha256'] == hashlib.sha256(
+        content[2000:]).hexdigest()
+    manifest = prefix + '.manifest.json'
+    assert chunk_artifact.read_chunk_manifest(manifest) == entry
+    assert build_manifest.read_manifest(manifest)['stage'] == 'chunk'
+
+    # same chunks as `split -b`
+    split_dir = tmpdir.mkdir('split')
+    subprocess.check_call(
+        ['split', '-b', '1000', fn, 'tmp_linux-64_AT'], cwd=str(split_dir))
+    for chunk in entry['chunks']:
+        with open(str(split_dir.join(chunk['filename'])), 'rb') as fh:
+            assert hashlib.sha256(fh.read()).hexdigest() == chunk['sha256']
+
+    output_fn = str(tmpdir.join('joined.tar.gz'))
+    chunk_artifact.join_chunks(manifest, output_fn)
+    with open(output_fn, 'rb') as fh:
+        assert fh.read() == content
+
+    with open(prefix + 'ab', 'r+b') as fh:
+        fh.write(b'x')
+    assert not chunk_artifact.verify_chunk(prefix + 'ab', entry['chunks'][1])
+    with pytest.raises(ValueError):
+        chunk_artifact.join_chunks(manifest, output_fn)
+
+
+def test_chunk_names():
+    names = list(chunk_artifact.chunk_names('p', suffix_length=2))
+    assert names[:3] == ['paa', 'pab', 'pac']
+    assert names[-1] == 'pzz'
+    assert len(names) == 26 * 26
@@ -8,7 +8,7 @@ import copy_ambertools as cam
 
 this_path = os.path.join(os.path.dirname(__file__))
 
-@patch('copy_ambertools._copy_folder')
+@patch('copy_engine.copy_sources')
 @patch('os.getenv')
 def test_copy_ambertools(mock_getenv, mock_copy):
     fake_amberhome = os.path.join(this_path, 'fake_data', 'fake_amber')
@@ -30,4 +30,76 @@ def test_copy_ambertools(mock_getenv, mock_copy):
     cam.mkdir_ambertree()
     cam.copy_tree()
     os.chdir(cwd)
-    mock_copy.assert_called_with(os.path.join(fake_amberhome, 'linux-64'), '.')
+    sources = mock_copy.call_args[0][0]
+    assert (os.path.join(fake_amberhome, 'AmberTools'), '.') in sources
+    assert mock_copy.call_args[1] == {'link': False, 'ignore': None}
+
+
+def test_compile_rules():
+    excluded = cam.compile_rules(cam.release_rules() + ['*.o', '!cpptraj.o'])
+    assert excluded('AmberTools/test')
+    assert excluded('AmberTools/test/sqm/Run.sqm')
+    assert not excluded('AmberTools/test/dacdif')
+    assert not excluded('AmberTools/test/dacdif/dacdif')
+    assert not excluded('AmberTools/src/test')
+    assert not excluded('AmberTools/testing')
+    assert excluded('./AmberTools/examples')
+    assert excluded('AmberTools/src/sqm/sqm.o')
+    assert not excluded('AmberTools/src/cpptraj/cpptraj.o')
+
+    excluded = cam.compile_rules(['**/test', 'dat/*.lib', '/doc'])
+    assert excluded('AmberTools/src/test/x')
+    assert excluded('test')
+    assert excluded('dat/amino.lib')
+    assert not excluded('dat/leap/amino.lib')
+    assert excluded('doc')
+    assert not excluded('AmberTools/doc')
+
+
+def test_parse_mkrelease_at(tmpdir):
+    mkrelease_at = tmpdir.join('mkrelease_at')
+    mkrelease_at.write('\n'.join([
+        'TAR="tar rvf"',
+        '$TAR amber18/{dat,doc}',
+        '$TAR amber18/AmberTools/{src,test,examples}',
+        '$TAR amber18/AmberTools/src/cpptraj',
+    ]))
+    home = str(tmpdir)
+    assert cam.parse_mkrelease_at(str(mkrelease_at), home) == [
+        (os.path.join(home, 'dat'), '.'),
+        (os.path.join(home, 'doc'), '.'),
+        (os.path.join(home, 'AmberTools', 'src'), 'AmberTools'),
+        (os.path.join(home, 'AmberTools/src', 'cpptraj'), 'AmberTools/src'),
+    ]
+
+
+def test_copy_tree_nested_rules(tmpdir):
+    # same work dir in every mode
+    amberhome = tmpdir.mkdir('amber')
+    amberhome.join('mkrelease_at').write('$TAR amber18/AmberTools\n')
+    src = amberhome.mkdir('AmberTools').mkdir('src')
+    src.mkdir('sqm').join('sqm.F90').write('x')
+    amberhome.mkdir('dat').join('amino.lib').write('x')
+    test_dir = amberhome.join('AmberTools').mkdir('test')
+    test_dir.mkdir('dacdif').join('dacdif').write('x')
+    test_dir.join('Run.sqm').write('x')
+
+    trees = []
+    for mode, staging in [('copy', False), ('symlink', False),
+                          ('copy', True)]:
+        work_dir = tmpdir.mkdir('work-{}-{}'.format(mode, staging))
+        env = {'AMBER_SRC': str(amberhome)}
+        with work_dir.as_cwd(), patch.dict(os.environ, env):
+            cam.copy_tree(
+                staging_dir=str(tmpdir.join('staging')) if staging else None,
+                mode=mode)
+        trees.append(
+            sorted(
+                os.path.relpath(os.path.join(root, fn), str(work_dir))
+                for root, _, files in os.walk(str(work_dir)) for fn in files))
+    # AmberTools/test is excluded, though AmberTools is copied
+    assert trees[0] == [
+        'AmberTools/src/dacdif/dacdif', 'AmberTools/src/sqm/sqm.F90'
+    ]
+    assert trees[1] == trees[0]
+    assert trees[2] == trees[0]
@@ -0,0 +1,29 @@
+import os
+import sys
+import json
+from mock import patch
+
+sys.path.insert(0, '..')
+import copy_built_ambertools
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_copy_to_prefix(tmpdir):
+    amberhome = tmpdir.mkdir('amber')
+    amberhome.mkdir('bin').join('foo').write('bin')
+    amberhome.mkdir('lib').join('foo').write('lib')
+    amberhome.mkdir('dat').mkdir('leap').join('parm10.dat').write('dat')
+    prefix = tmpdir.mkdir('prefix')
+    recipe_dir = os.path.join(this_dir, '..', '..',
+                              'conda-ambertools-single-python')
+
+    with patch.dict(os.environ, {'RECIPE_DIR': recipe_dir}):
+        copy_built_ambertools.copy_to_prefix(str(amberhome), str(prefix))
+    assert prefix.join('lib', 'foo').read() == 'lib'
+    with open(str(amberhome.join(copy_built_ambertools.COPY_MANIFEST))) as fh:
+        entries = json.load(fh)
+    # relative to prefix: same name in bin and lib do not collide
+    assert [entry['path'] for entry in entries] == [
+        'bin/foo', 'dat/leap/parm10.dat', 'lib/foo'
+    ]
@@ -0,0 +1,154 @@
+import os
+import sys
+
+import pytest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, '..')
+import copy_engine
+
+
+TREE = {
+    'bin/cpptraj': ('binary', 0o755),
+    'lib/libcpptraj.so.1': 'library',
+    'lib/libcpptraj.so': ('symlink', 'libcpptraj.so.1'),
+    'lib/python2.7/site-packages/parmed.py': 'import os',
+    'lib/python': ('symlink', 'python2.7'),
+}
+
+
+def test_copy_tree(tmpdir, make_tree):
+    src = tmpdir.mkdir('src')
+    make_tree(src, TREE)
+    dst = tmpdir.mkdir('dst')
+    dst.mkdir('lib').join('libcpptraj.so.1').write('old')
+
+    entries = copy_engine.copy_tree(str(src), str(dst), jobs=2)
+    assert sorted(entry['path'] for entry in entries) == [
+        'bin/cpptraj', 'lib/libcpptraj.so', 'lib/libcpptraj.so.1',
+        'lib/python', 'lib/python2.7/site-packages/parmed.py'
+    ]
+    assert dst.join('lib', 'libcpptraj.so.1').read() == 'library'
+    assert dst.join('lib', 'libcpptraj.so').readlink() == 'libcpptraj.so.1'
+    assert dst.join('lib', 'python').readlink() == 'python2.7'
+    assert os.access(str(dst.join('bin', 'cpptraj')), os.X_OK)
+    assert not os.path.samefile(
+        str(src.join('bin', 'cpptraj')), str(dst.join('bin', 'cpptraj')))
+    methods = copy_engine.summary(entries)
+    assert methods['symlink'] == (2, 0)
+    assert sum(n_files for n_files, size in methods.values()) == 5
+
+    manifest = str(tmpdir.join('copy.json'))
+    copy_engine.write_manifest(manifest, entries)
+    assert os.path.exists(manifest)
+
+    # missing source: nothing to do
+    assert copy_engine.copy_tree(str(src.join('include')), str(dst)) == []
+
+
+def test_copy_tree_link(tmpdir, make_tree):
+    src = tmpdir.mkdir('src')
+    make_tree(src, TREE)
+    dst = tmpdir.join('dst')
+    entries = copy_engine.copy_tree(str(src), str(dst), link=True)
+    assert set(entry['method'] for entry in entries) == set(
+        ['hardlink', 'symlink'])
+    assert os.path.samefile(
+        str(src.join('bin', 'cpptraj')), str(dst.join('bin', 'cpptraj')))
+
+
+def test_copy_tree_raises(tmpdir, make_tree):
+    src = tmpdir.mkdir('src')
+    make_tree(src, TREE)
+    dst = tmpdir.mkdir('dst')
+    # a folder where a file goes
+    dst.mkdir('bin').mkdir('cpptraj')
+    with pytest.raises((OSError, IOError)):
+        copy_engine.copy_tree(str(src), str(dst))
+
+
+def test_sync(tmpdir, make_tree):
+    src = tmpdir.mkdir('src')
+    make_tree(src, TREE)
+    src.join('README').write('readme')
+    dest = tmpdir.join('staging')
+    sources = [(str(src.join('bin')), '.'), (str(src.join('lib')), 'build'),
+               (str(src.join('README')), '.')]
+
+    stats = copy_engine.sync(sources, str(dest))
+    assert stats == {'copied': 6, 'unchanged': 0, 'removed': 0}
+    assert dest.join('build', 'lib', 'libcpptraj.so').readlink() == (
+        'libcpptraj.so.1')
+    assert dest.join('build', 'lib', 'python2.7', 'site-packages',
+                     'parmed.py').read() == 'import os'
+    assert os.access(str(dest.join('bin', 'cpptraj')), os.X_OK)
+    assert os.path.exists(str(dest) + copy_engine.SYNC_MANIFEST_SUFFIX)
+
+    assert copy_engine.sync(sources, str(dest)) == {
+        'copied': 0, 'unchanged': 6, 'removed': 0}
+
+    # touched only: content is compared, not copied
+    src.join('README').setmtime(src.join('README').mtime() + 10)
+    # changed
+    src.join('bin', 'cpptraj').write('binary2')
+    # removed
+    src.join('lib', 'python2.7', 'site-packages', 'parmed.py').remove()
+    assert copy_engine.sync(sources, str(dest)) == {
+        'copied': 1, 'unchanged': 4, 'removed': 1}
+    assert dest.join('bin', 'cpptraj').read() == 'binary2'
+    assert not dest.join('build', 'lib', 'python2.7', 'site-packages',
+                         'parmed.py').exists()
+    assert dest.join('build', 'lib', 'python2.7', 'site-packages').isdir()
+
+
+def test_copy_sources_symlink(tmpdir, make_tree):
+    src = tmpdir.mkdir('src')
+    make_tree(src, TREE)
+    src.mkdir('test').join('run').write('test')
+    work = tmpdir.mkdir('work')
+
+    entries = copy_engine.copy_sources(
+        [(str(src.join('bin')), '.'), (str(src.join('lib')), 'AmberTools'),
+         (str(src.join('test')), '.')],
+        str(work),
+        link='symlink',
+        ignore=lambda path: path.endswith('site-packages'))
+    assert sorted(entry['path'] for entry in entries) == [
+        'AmberTools/lib/libcpptraj.so', 'AmberTools/lib/libcpptraj.so.1',
+        'AmberTools/lib/python', 'bin/cpptraj', 'test/run'
+    ]
+    # folders are created, files are linked to the source
+    assert not work.join('AmberTools', 'lib').islink()
+    assert work.join('bin', 'cpptraj').readlink() == str(
+        src.join('bin', 'cpptraj'))
+    # symlinks are copied
+    assert work.join('AmberTools', 'lib', 'python').readlink() == 'python2.7'
+    assert work.join('AmberTools', 'lib', 'python2.7').isdir()
+    assert not work.join('AmberTools', 'lib', 'python2.7',
+                         'site-packages').exists()
+
+
+def test_sync_concurrent(tmpdir, make_tree):
+    src = tmpdir.mkdir('src')
+    make_tree(src, TREE)
+    for index in range(50):
+        src.join('bin', 'tool{}'.format(index)).write('x' * index)
+    dest = str(tmpdir.join('staging'))
+    sources = [(str(src.join('bin')), '.'), (str(src.join('lib')), '.')]
+
+    pool = ThreadPool(3)
+    try:
+        results = pool.map(lambda _: copy_engine.sync(sources, dest),
+                           range(3))
+    finally:
+        pool.close()
+        pool.join()
+    # one copies, the others wait and find everything up to date
+    assert sorted(stats['copied'] for stats in results) == [0, 0, 55]
+    assert tmpdir.join('staging', 'bin', 'tool49').read() == 'x' * 49
+    assert sorted(fn.basename for fn in tmpdir.listdir()) == sorted(
+        ['src', 'staging', 'staging.lock', 'staging.manifest.json'])
+
+    with copy_engine.reading(dest):
+        copy_engine.copy_tree(dest, str(tmpdir.join('work')))
+    assert tmpdir.join('work', 'lib', 'libcpptraj.so.1').read() == 'library'
@@ -0,0 +1,65 @@
+import os
+import sys
+import tarfile
+
+import pytest
+
+sys.path.insert(0, '..')
+import dedup_files
+
+
+TREE = dict([('python{}/site-packages/{}'.format(pyver, name), content)
+             for pyver in ['2.7', '3.6', '3.7']
+             for name, content in [('parmed.dat', 'same data'),
+                                   ('version.py', 'version = ' + pyver),
+                                   ('empty.txt', '')]])
+TREE['python3.7/site-packages/run.sh'] = ('same data', 0o755)
+
+
+def test_dedup_hardlink(tmpdir, make_tree):
+    make_tree(tmpdir, TREE)
+    paths = [str(tmpdir.join(name)) for name in ['python2.7', 'python3.6',
+                                                 'python3.7']]
+    groups = dedup_files.find_duplicates(paths)
+    # different content, permissions, or empty: not grouped
+    assert [[os.path.relpath(fn, str(tmpdir)) for fn in group]
+            for group in groups] == [[
+                'python2.7/site-packages/parmed.dat',
+                'python3.6/site-packages/parmed.dat',
+                'python3.7/site-packages/parmed.dat'
+            ]]
+
+    assert dedup_files.dedup(paths) == (2, 2 * len('same data'))
+    keep = tmpdir.join('python2.7', 'site-packages', 'parmed.dat')
+    for pyver in ['3.6', '3.7']:
+        fn = tmpdir.join('python' + pyver, 'site-packages', 'parmed.dat')
+        assert os.path.samefile(str(fn), str(keep))
+        assert fn.read() == 'same data'
+    # already linked
+    assert dedup_files.dedup(paths) == (0, 0)
+
+    # stored once in a tar
+    tar_fn = str(tmpdir.join('pkg.tar'))
+    with tarfile.open(tar_fn, 'w') as tar:
+        for path in paths:
+            tar.add(path, arcname=os.path.basename(path))
+    with tarfile.open(tar_fn) as tar:
+        assert tar.getmember(
+            'python3.7/site-packages/parmed.dat').islnk()
+
+
+def test_dedup_symlink(tmpdir, make_tree):
+    make_tree(tmpdir, TREE)
+    paths = [str(tmpdir)]
+    assert dedup_files.dedup(paths, mode='symlink', dry_run=True) == (2, 18)
+    assert not tmpdir.join('python3.6', 'site-packages',
+                           'parmed.dat').islink()
+
+    dedup_files.dedup(paths, mode='symlink')
+    fn = tmpdir.join('python3.6', 'site-packages', 'parmed.dat')
+    assert fn.islink()
+    assert os.readlink(str(fn)) == '../../python2.7/site-packages/parmed.dat'
+    assert fn.read() == 'same data'
+
+    with pytest.raises(ValueError):
+        dedup_files.dedup(paths, mode='copy')
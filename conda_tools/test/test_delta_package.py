@@ -0,0 +1,165 @@
+import os
+import sys
+import tarfile
+
+import pytest
+from mock import patch
+
+sys.path.insert(0, '..')
+import delta_package
+
+
+def in_top_folder(files, dirs=(), top='amber17'):
+    ''' files: {name: content}, see conftest.write_package '''
+    package = dict((top + '/' + name, None) for name in dirs)
+    package[top] = None
+    for name, content in files.items():
+        package[top + '/' + name] = content
+    return package
+
+
+def read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            fn = os.path.join(dirpath, name)
+            rel = os.path.relpath(fn, root)
+            if os.path.islink(fn):
+                tree[rel] = ('symlink', os.readlink(fn))
+            else:
+                with open(fn, 'rb') as fh:
+                    tree[rel] = (fh.read(), os.stat(fn).st_mode & 0o777)
+    return tree
+
+
+def extract(pkg_fn, dest):
+    with tarfile.open(pkg_fn) as tar:
+        tar.extractall(dest)
+
+
+OLD = {
+    'bin/cpptraj': b'\x7fELF' + b'cpptraj 17.3 ' * 1000,
+    'bin/run.sh': b'#!/bin/sh\n',
+    'dat/leap.dat': b'same in both',
+    'lib/old.so': b'removed',
+}
+NEW = {
+    'bin/cpptraj': b'\x7fELF' + b'cpptraj 17.4 ' + b'cpptraj 17.3 ' * 999,
+    'bin/run.sh': (b'#!/bin/sh\n', 0o755),
+    'dat/leap.dat': b'same in both',
+    'lib/libnew.so.1': b'added',
+    'lib/libnew.so': ('symlink', 'libnew.so.1'),
+}
+
+
+@pytest.mark.parametrize('use_bsdiff', [True, False])
+def test_make_and_apply_delta(tmpdir, use_bsdiff, make_package):
+    if use_bsdiff:
+        pytest.importorskip('bsdiff4')
+    old_pkg = str(tmpdir.join('linux-64.ambertools-17.3.tar.bz2'))
+    new_pkg = str(tmpdir.join('linux-64.ambertools-17.4.tar.bz2'))
+    delta_fn = str(tmpdir.join('amber17-17.3-17.4.delta.tar.bz2'))
+    make_package(old_pkg, in_top_folder(OLD))
+    make_package(new_pkg, in_top_folder(NEW))
+
+    delta = delta_package.make_delta(
+        old_pkg, new_pkg, delta_fn, use_bsdiff=use_bsdiff)
+    assert delta['remove'] == ['lib/old.so']
+    assert sorted(delta['files']) == [
+        'bin/cpptraj', 'bin/run.sh', 'lib/libnew.so.1'
+    ]
+    assert delta['files']['bin/cpptraj']['source'] == (
+        'patch' if use_bsdiff else 'full')
+    assert delta['files']['bin/run.sh']['source'] == 'old'
+    assert delta['files']['lib/libnew.so.1']['source'] == 'full'
+    assert 'dat/leap.dat' in delta['sha256']
+    with tarfile.open(delta_fn) as tar:
+        names = tar.getnames()
+    assert names[0] == 'delta.json'
+    assert 'full/dat/leap.dat' not in names
+
+    amberhome = str(tmpdir.join('install'))
+    extract(old_pkg, amberhome)
+    amberhome = os.path.join(amberhome, 'amber17')
+    delta_package.apply_delta(delta_fn, amberhome)
+    new_tree = str(tmpdir.join('new'))
+    extract(new_pkg, new_tree)
+    assert read_tree(amberhome) == read_tree(os.path.join(new_tree, 'amber17'))
+
+
+def test_apply_delta_checks(tmpdir, make_package):
+    old_pkg = str(tmpdir.join('old.tar.bz2'))
+    new_pkg = str(tmpdir.join('new.tar.bz2'))
+    delta_fn = str(tmpdir.join('delta.tar.bz2'))
+    make_package(old_pkg, in_top_folder(OLD))
+    make_package(new_pkg, in_top_folder(NEW))
+    delta_package.make_delta(old_pkg, new_pkg, delta_fn, use_bsdiff=False)
+
+    # install is not the old version: nothing is written
+    amberhome = str(tmpdir.join('install'))
+    extract(old_pkg, amberhome)
+    amberhome = os.path.join(amberhome, 'amber17')
+    with open(os.path.join(amberhome, 'bin', 'cpptraj'), 'wb') as fh:
+        fh.write(b'edited')
+    with pytest.raises(ValueError):
+        delta_package.apply_delta(delta_fn, amberhome)
+    assert os.path.exists(os.path.join(amberhome, 'lib', 'old.so'))
+
+    # checksums after applying
+    with open(os.path.join(amberhome, 'dat', 'leap.dat'), 'wb') as fh:
+        fh.write(b'edited')
+    with pytest.raises(ValueError) as excinfo:
+        delta_package.apply_delta(delta_fn, amberhome, check=False)
+    assert 'dat/leap.dat' in str(excinfo.value)
+
+    # not a delta
+    with pytest.raises(ValueError):
+        delta_package.apply_delta(old_pkg, amberhome)
+
+
+def test_apply_delta_without_bsdiff4(tmpdir, make_package):
+    pytest.importorskip('bsdiff4')
+    old_pkg = str(tmpdir.join('old.tar.bz2'))
+    new_pkg = str(tmpdir.join('new.tar.bz2'))
+    delta_fn = str(tmpdir.join('delta.tar.bz2'))
+    make_package(old_pkg, in_top_folder(OLD))
+    make_package(new_pkg, in_top_folder(NEW))
+    delta_package.make_delta(old_pkg, new_pkg, delta_fn)
+    extract(old_pkg, str(tmpdir))
+    with patch('delta_package.bsdiff4', None):
+        with pytest.raises(RuntimeError):
+            delta_package.apply_delta(delta_fn, str(tmpdir.join('amber17')))
+
+
+def test_apply_delta_type_change(tmpdir, make_package):
+    old_pkg = str(tmpdir.join('old.tar.bz2'))
+    new_pkg = str(tmpdir.join('new.tar.bz2'))
+    delta_fn = str(tmpdir.join('delta.tar.bz2'))
+    old_files = {
+        'lib/python': b'file, then folder',
+        'doc/index.html': b'folder, then file',
+        'share/amber/x.dat': b'folder, then symlink',
+    }
+    new_files = {
+        'lib/python/parmed.py': b'import os',
+        'doc': b'folder, then file',
+        'share': ('symlink', 'lib'),
+    }
+    old_dirs = ['doc', 'share', 'share/amber']
+    make_package(old_pkg, in_top_folder(old_files, dirs=old_dirs))
+    make_package(new_pkg, in_top_folder(new_files, dirs=['lib/python']))
+
+    delta = delta_package.make_delta(
+        old_pkg, new_pkg, delta_fn, use_bsdiff=False)
+    assert delta['remove'] == sorted([
+        'doc', 'doc/index.html', 'lib/python', 'share', 'share/amber',
+        'share/amber/x.dat'
+    ])
+    amberhome = str(tmpdir.join('install'))
+    extract(old_pkg, amberhome)
+    amberhome = os.path.join(amberhome, 'amber17')
+    delta_package.apply_delta(delta_fn, amberhome)
+    new_tree = str(tmpdir.join('new'))
+    extract(new_pkg, new_tree)
+    assert read_tree(amberhome) == read_tree(os.path.join(new_tree, 'amber17'))
+    assert os.path.islink(os.path.join(amberhome, 'share'))
@@ -0,0 +1,96 @@
+import os
+import sys
+import threading
+from functools import partial
+
+import pytest
+from mock import patch
+
+requests = pytest.importorskip('requests')
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    # Python 2
+    pytest.skip('needs http.server', allow_module_level=True)
+
+sys.path.insert(0, '..')
+import chunk_artifact
+import download_binary_at_dev
+
+
+class Handler(SimpleHTTPRequestHandler):
+    # number of requests to fail with 503 for each path
+    failures = {}
+
+    def do_GET(self):
+        if self.failures.get(self.path, 0) > 0:
+            self.failures[self.path] -= 1
+            self.send_error(503)
+            return
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmpdir):
+    ''' local stand-in for the github repository of chunks '''
+    root = tmpdir.mkdir('server')
+    httpd = HTTPServer(('127.0.0.1', 0),
+                       partial(Handler, directory=str(root)))
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield root, 'http://127.0.0.1:{}/{{chunk}}'.format(
+            httpd.server_address[1])
+    finally:
+        Handler.failures.clear()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_download(tmpdir, server):
+    root, url = server
+    fn = str(tmpdir.join('ambertools.tar'))
+    content = os.urandom(10000)
+    with open(str(tmpdir.join('src.tar')), 'wb') as fh:
+        fh.write(content)
+    chunk_artifact.split_file(
+        str(tmpdir.join('src.tar')),
+        str(root.join('tmp_linux-64_AT')),
+        chunk_size=3000)
+
+    # one chunk missing: the others are kept for the next run
+    os.rename(str(root.join('tmp_linux-64_ATab')), str(tmpdir.join('ab')))
+    assert download_binary_at_dev.download(
+        fn, 'linux', url=url, retries=1, backoff=0) is None
+    os.rename(str(tmpdir.join('ab')), str(root.join('tmp_linux-64_ATab')))
+
+    # resume: only the missing chunk; retried after a server error
+    Handler.failures['/tmp_linux-64_ATab'] = 1
+    with patch('requests.get', wraps=requests.get) as get:
+        assert download_binary_at_dev.download(
+            fn, 'linux', url=url, retries=1, backoff=0) == fn
+    assert [call[0][0].rsplit('/', 1)[1] for call in get.call_args_list] == [
+        'tmp_linux-64_AT.manifest.json', 'tmp_linux-64_ATab',
+        'tmp_linux-64_ATab'
+    ]
+    with open(fn, 'rb') as fh:
+        assert fh.read() == content
+
+
+def test_download_checksum_mismatch(tmpdir, server):
+    root, url = server
+    fn = str(tmpdir.join('ambertools.tar'))
+    with open(str(tmpdir.join('src.tar')), 'wb') as fh:
+        fh.write(os.urandom(5000))
+    chunk_artifact.split_file(
+        str(tmpdir.join('src.tar')),
+        str(root.join('tmp_osx-64_AT')),
+        chunk_size=2000)
+    with open(str(root.join('tmp_osx-64_ATab')), 'r+b') as fh:
+        fh.write(b'corrupted')
+    assert download_binary_at_dev.download(
+        fn, 'osx', url=url, jobs=2, retries=0, backoff=0) is None
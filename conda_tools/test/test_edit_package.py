@@ -2,10 +2,14 @@
 
 import os
 import sys
+import tarfile
+import subprocess
+
+import pytest
 from mock import patch
 
 sys.path.insert(0, '..')
-from edit_package import editing_conda_package
+from edit_package import editing_conda_package, streaming_conda_package
 
 this_dir = os.path.dirname(__file__)
 FAKE_TAR = os.path.join(this_dir, 'fake_data', 'fake_osx.tar.bz2')
@@ -40,3 +44,222 @@ def test_output_as_non_conda_package():
     expected_fn = os.path.join(output_dir,
                                'osx-64.' + os.path.basename(pkg_name))
     assert os.path.exists(expected_fn)
+
+
+# small conda package: info/index.json, a python script, a hard link
+PACKAGE = [
+    ('info/index.json', b'{"version": "18.0", "subdir": "linux-64"}'),
+    ('bin/pdb4amber', b'#!/opt/conda/bin/python\nprint("hi")\n'),
+    ('bin/tleap', b'#!/bin/sh\nteLeap $*\n'),
+    ('lib/libcpptraj.so', b'\x7fELF' + b'\x00' * 100),
+    ('lib/libcpptraj.so.1', ('hardlink', 'lib/libcpptraj.so')),
+]
+
+
+def read_package(fn):
+    with tarfile.open(fn) as tar:
+        return dict((member.name, (member,
+                                   tar.extractfile(member).read()
+                                   if member.isfile() else None))
+                    for member in tar)
+
+
+def test_streaming_conda_package(tmpdir, make_package):
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+
+    def shebang(member, content):
+        return member, content.replace(b'/opt/conda/bin/python',
+                                       b'/usr/bin/env python')
+
+    def drop(member, content):
+        return None
+
+    with streaming_conda_package(
+            pkg_name,
+            output_dir=str(tmpdir.join('out')),
+            add_date=False,
+            transforms=[('bin/*', shebang), ('bin/tleap', drop)],
+            materialize=lambda member: member.name.startswith('lib/')
+    ) as output_fn:
+        assert sorted(os.listdir('lib')) == [
+            'libcpptraj.so', 'libcpptraj.so.1'
+        ]
+        with open('lib/libcpptraj.so', 'ab') as fh:
+            fh.write(b'edited')
+
+    assert output_fn == str(tmpdir.join('out',
+                                        'linux-64.ambertools-18.0-0.tar.bz2'))
+    members = read_package(output_fn)
+    assert sorted(members) == [
+        'amber18/bin/pdb4amber', 'amber18/info/index.json',
+        'amber18/lib/libcpptraj.so', 'amber18/lib/libcpptraj.so.1'
+    ]
+    assert members['amber18/bin/pdb4amber'][1] == (
+        b'#!/usr/bin/env python\nprint("hi")\n')
+    assert members['amber18/lib/libcpptraj.so'][1].endswith(b'edited')
+    # tar -xjf must be able to read it
+    subprocess.check_call(
+        ['tar', '-xjf', output_fn, '-C', str(tmpdir.join('out'))])
+    with open(str(tmpdir.join('out', 'amber18', 'lib',
+                              'libcpptraj.so.1')), 'rb') as fh:
+        assert fh.read().endswith(b'edited')
+
+
+def test_streaming_conda_package_as_conda_package(tmpdir, make_package):
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    with streaming_conda_package(
+            pkg_name, output_dir=str(tmpdir.join('out')), add_date=False,
+            conda=True) as output_fn:
+        pass
+    assert os.path.basename(output_fn) == 'ambertools-18.0-0.tar.bz2'
+    assert read_package(output_fn)['lib/libcpptraj.so.1'][0].linkname == (
+        'lib/libcpptraj.so')
+
+
+def _sha256(fn):
+    import hashlib
+    with open(fn, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+@pytest.mark.parametrize('archive_format', ['bz2', 'xz', 'zstd'])
+def test_editing_conda_package_deterministic(tmpdir, archive_format,
+                                            make_package):
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+
+    hashes = []
+    for mtime in [1000, 2000]:
+        output_dir = str(tmpdir.join('out' + str(mtime)))
+        with editing_conda_package(
+                pkg_name,
+                output_dir=output_dir,
+                add_date=False,
+                archive_format=archive_format,
+                deterministic=True) as output_fn:
+            # build host state that must not end up in the package
+            for dirpath, dirnames, filenames in os.walk('.'):
+                for name in dirnames + filenames:
+                    os.utime(os.path.join(dirpath, name), (mtime, mtime))
+            os.chmod('bin/tleap', 0o700)
+        hashes.append(_sha256(output_fn))
+    assert hashes[0] == hashes[1]
+
+    if archive_format == 'zstd':
+        return
+    with tarfile.open(output_fn) as tar:
+        members = tar.getmembers()
+    names = [member.name for member in members]
+    assert names == sorted(names)
+    assert names[0] == 'amber18/bin'
+    for member in members:
+        assert (member.mtime, member.uid, member.gid, member.uname) == (0, 0,
+                                                                        0, '')
+    modes = dict((member.name, member.mode) for member in members)
+    assert modes['amber18/bin'] == 0o755
+    assert modes['amber18/bin/tleap'] == 0o755
+    assert modes['amber18/bin/pdb4amber'] == 0o644
+
+
+def test_streaming_conda_package_deterministic(tmpdir, make_package):
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    hashes = []
+    for mtime in [1000, 2000]:
+        with streaming_conda_package(
+                pkg_name,
+                output_dir=str(tmpdir.join('out' + str(mtime))),
+                add_date=False,
+                conda=True,
+                archive_format='conda',
+                materialize=lambda member: member.name.startswith('lib/'),
+                deterministic=True) as output_fn:
+            os.utime('lib/libcpptraj.so', (mtime, mtime))
+        hashes.append(_sha256(output_fn))
+    assert hashes[0] == hashes[1]
+
+
+def test_streaming_conda_package_deterministic_order(tmpdir, make_package):
+    # same content, members in another order: same file
+    hashes = []
+    for reverse in [False, True]:
+        pkg_name = str(
+            tmpdir.mkdir(str(reverse)).join('ambertools-18.0-0.tar.bz2'))
+        # files in reverse order, the hard link after its target
+        make_package(pkg_name,
+                     PACKAGE[-2::-1] + PACKAGE[-1:] if reverse else PACKAGE)
+        with streaming_conda_package(
+                pkg_name,
+                output_dir=str(tmpdir.join('out' + str(reverse))),
+                add_date=False,
+                materialize=lambda member: member.name == 'bin/tleap',
+                deterministic=True) as output_fn:
+            pass
+        hashes.append(_sha256(output_fn))
+        with tarfile.open(output_fn) as tar:
+            names = tar.getnames()
+    assert hashes[0] == hashes[1]
+    assert names == [
+        'amber18/bin/pdb4amber', 'amber18/bin/tleap',
+        'amber18/info/index.json', 'amber18/lib/libcpptraj.so',
+        'amber18/lib/libcpptraj.so.1'
+    ]
+    assert read_package(output_fn)['amber18/bin/tleap'][1] == (
+        b'#!/bin/sh\nteLeap $*\n')
+
+
+def test_get_package_info_sidecar_and_cache(tmpdir, make_package):
+    import package_info
+    from edit_package import get_package_info
+
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    # no sidecar unless asked for
+    assert get_package_info(pkg_name)['version'] == '18.0'
+    assert not os.path.exists(pkg_name + '.info.json')
+    package_info._memory_cache.clear()
+
+    assert get_package_info(pkg_name, sidecar=True) == {
+        'version': '18.0',
+        'subdir': 'linux-64'
+    }
+    assert os.path.exists(pkg_name + '.info.json')
+
+    # memory cache, then sidecar: the package is not opened
+    with patch('tarfile.open', side_effect=AssertionError):
+        assert get_package_info(pkg_name, sidecar=True)['version'] == '18.0'
+        package_info._memory_cache.clear()
+        with patch.dict(os.environ, {package_info.SIDECAR_ENV: '1'}):
+            assert get_package_info(pkg_name)['version'] == '18.0'
+
+    # changed package: read again
+    make_package(pkg_name, [('info/index.json',
+                             b'{"version": "19.0", "subdir": "osx-64"}')])
+    os.utime(pkg_name, (1, 1))
+    assert get_package_info(pkg_name, sidecar=True)['version'] == '19.0'
+
+
+def test_get_package_info_non_conda_package(tmpdir, make_package):
+    import package_info
+
+    pkg_name = str(tmpdir.join('ambertools-18.0-0.tar.bz2'))
+    make_package(pkg_name, PACKAGE)
+    with streaming_conda_package(
+            pkg_name, output_dir=str(tmpdir.join('out')),
+            add_date=False) as output_fn:
+        pass
+    index = package_info.read_index_json(output_fn, sidecar=False)
+    assert index['subdir'] == 'linux-64'
+    assert not os.path.exists(output_fn + '.info.json')
+
+
+def test_is_index_json():
+    import package_info
+
+    assert package_info._is_index_json('info/index.json')
+    assert package_info._is_index_json('amber18/info/index.json')
+    assert not package_info._is_index_json('lib/info/index.json')
+    assert not package_info._is_index_json('amber18/lib/info/index.json')
+    assert not package_info._is_index_json('info/files')
@@ -112,3 +112,21 @@ def test_main_with_call(
     mock_get_files.return_value = [os.path.join(amber_src, 'lib', 'libcpptraj.dylib')]
     origin_prefix = '/Users/travis/amber16'
     fix_rpath_osx.main([amber_src, '--prefix', origin_prefix])
+
+
+def test_get_dylibs_fixture():
+    fn = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'fake_data', 'macho',
+        'libcpptraj.dylib')
+    assert fix_rpath_osx.is_object_file(fn)
+    assert not fix_rpath_osx.is_object_file(__file__)
+    assert fix_rpath_osx.get_dylibs(fn) == [
+        '/usr/local/gfortran/lib/libgfortran.3.dylib',
+        '@rpath/libsander.dylib',
+        '/usr/lib/libz.1.dylib',
+        '/usr/lib/libSystem.B.dylib',
+    ]
+    with patch('subprocess.check_output') as mock_call:
+        fix_rpath_osx.add_loader_path(fn, os.path.dirname(fn), 'lib')
+        mock_call.assert_called_with(
+            ['install_name_tool', '-add_rpath', '@loader_path/./lib', fn])
@@ -0,0 +1,87 @@
+import os
+import sys
+import threading
+import subprocess
+from glob import glob
+from multiprocessing.pool import ThreadPool
+from mock import patch
+
+sys.path.insert(0, '..')
+import job_slots
+
+
+def test_setup(tmpdir):
+    slots_dir = str(tmpdir.join('slots'))
+    with patch.dict(os.environ):
+        assert job_slots.setup(slots_dir, n_slots=3) == slots_dir
+        assert os.environ[job_slots.ENV_VAR] == slots_dir
+        assert len(job_slots.slot_files(slots_dir)) == 3
+        # keep existing slots
+        job_slots.setup(slots_dir)
+        assert len(job_slots.slot_files(slots_dir)) == 3
+        job_slots.setup(slots_dir, n_slots=2)
+        assert len(job_slots.slot_files(slots_dir)) == 2
+
+
+def test_default_slots():
+    with patch('job_slots.cpu_count', return_value=16):
+        with patch('job_slots.available_memory', return_value=4096):
+            assert job_slots.default_slots() == 4
+        with patch('job_slots.available_memory', return_value=100):
+            assert job_slots.default_slots() == 1
+        with patch('job_slots.available_memory', return_value=0):
+            assert job_slots.default_slots() == 16
+
+
+def test_acquire(tmpdir):
+    slots_dir = str(tmpdir)
+    with patch.dict(os.environ):
+        os.environ.pop(job_slots.ENV_VAR, None)
+        with job_slots.acquire(8) as n_jobs:
+            assert n_jobs == 8
+
+        job_slots.setup(slots_dir, n_slots=4)
+        with job_slots.acquire(3) as n_jobs:
+            assert n_jobs == 3
+            with job_slots.acquire(3) as n_jobs:
+                assert n_jobs == 1
+
+            # other process (e.g. concurrent conda build): waits for a slot
+            script = ('import sys; sys.path.insert(0, {!r}); import job_slots\n'
+                      'with job_slots.acquire(4, poll_interval=0.01) as n:\n'
+                      '    print(n)\n').format(
+                          os.path.dirname(os.path.abspath(job_slots.__file__)))
+            output = subprocess.check_output([sys.executable, '-c', script])
+            assert output.decode().strip() == '1'
+        with job_slots.acquire(8) as n_jobs:
+            assert n_jobs == 4
+
+
+def test_acquire_concurrent(tmpdir):
+    slots_dir = str(tmpdir)
+    job_slots.setup(slots_dir, n_slots=4)
+    with patch.dict(os.environ):
+        os.environ.pop(job_slots.BUILDS_ENV_VAR, None)
+        # a make already running: the next one gets half of the slots
+        with job_slots.acquire(1, slots_dir) as n_jobs:
+            assert n_jobs == 1
+            with job_slots.acquire(8, slots_dir) as n_jobs:
+                assert n_jobs == 2
+        assert not glob(os.path.join(slots_dir, 'client-*'))
+
+        # two builds started together, each gets its share
+        os.environ[job_slots.BUILDS_ENV_VAR] = '2'
+        barrier = threading.Barrier(2)
+
+        def make(_):
+            with job_slots.acquire(8, slots_dir, poll_interval=0.01) as n:
+                # both hold their slots at the same time
+                barrier.wait(timeout=10)
+                return n
+
+        pool = ThreadPool(2)
+        try:
+            assert pool.map(make, range(2)) == [2, 2]
+        finally:
+            pool.close()
+            pool.join()
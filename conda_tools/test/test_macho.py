@@ -0,0 +1,105 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, '..')
+import macho
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+# written by fake_data/macho/make_fixtures.py
+fixture_dir = os.path.join(this_dir, 'fake_data', 'macho')
+
+
+def fixture(name):
+    return os.path.join(fixture_dir, name)
+
+
+def test_thin_dylib():
+    fn = fixture('libcpptraj.dylib')
+    slices = macho.read_slices(fn)
+    assert len(slices) == 1
+    assert slices[0].filetype == 6
+    assert macho.is_macho(fn)
+    assert macho.dylib_id(fn) == '@rpath/libcpptraj.dylib'
+    assert macho.dylibs(fn) == [
+        '/usr/local/gfortran/lib/libgfortran.3.dylib',
+        '@rpath/libsander.dylib',
+        '/usr/lib/libz.1.dylib',
+        '/usr/lib/libSystem.B.dylib',
+    ]
+    assert macho.rpaths(fn) == ['@loader_path/../lib']
+    assert macho.install_names(fn)[:2] == [
+        '@rpath/libcpptraj.dylib',
+        '/usr/local/gfortran/lib/libgfortran.3.dylib'
+    ]
+
+
+def test_fat_executable():
+    fn = fixture('cpptraj')
+    slices = macho.read_slices(fn)
+    assert [mach_slice.cputype for mach_slice in slices] == [0x01000007, 7]
+    assert macho.dylib_id(fn) is None
+    # all architectures, no duplicates
+    assert macho.dylibs(fn) == [
+        '@rpath/libcpptraj.dylib',
+        '/usr/lib/libSystem.B.dylib',
+        '/usr/local/gfortran/lib/libgcc_s.1.dylib',
+    ]
+    assert macho.rpaths(fn) == [
+        '@loader_path/../lib', '/usr/local/gfortran/lib'
+    ]
+
+
+def test_big_endian():
+    assert macho.install_names(fixture('sqm.ppc')) == [
+        '/usr/lib/libSystem.B.dylib'
+    ]
+
+
+def test_not_macho(tmpdir):
+    assert not macho.is_macho(__file__)
+    assert not macho.is_macho(this_dir)
+    assert not macho.is_macho(str(tmpdir.join('missing')))
+    # java class file
+    tmpdir.join('A.class').write_binary(b'\xca\xfe\xba\xbe\x00\x00\x00\x34')
+    assert macho.install_names(str(tmpdir.join('A.class'))) == []
+    with pytest.raises(ValueError):
+        macho.read_slices(fixture('truncated.dylib'))
+
+
+def test_cache(tmpdir):
+    fn = str(tmpdir.join('libcpptraj.dylib'))
+    shutil.copy(fixture('libcpptraj.dylib'), fn)
+    assert macho.load(fn) is macho.load(fn)
+
+    # changed (as by install_name_tool): read again
+    shutil.copy(fixture('sqm.ppc'), fn)
+    os.utime(fn, (0, 0))
+    assert macho.dylib_id(fn) is None
+    macho.clear_cache()
+    assert macho.dylibs(fn) == ['/usr/lib/libSystem.B.dylib']
+
+
+def test_cache_same_second(tmpdir):
+    fn = str(tmpdir.join('libcpptraj.dylib'))
+    shutil.copy(fixture('libcpptraj.dylib'), fn)
+    st = os.stat(fn)
+    assert macho.dylib_id(fn) == '@rpath/libcpptraj.dylib'
+
+    # same size and mtime, edited in place
+    with open(fn, 'r+b') as fh:
+        data = fh.read()
+        fh.seek(data.index(b'@rpath/libcpptraj.dylib'))
+        fh.write(b'@rpath/libcpptrak.dylib')
+    os.utime(fn, (st.st_atime, st.st_mtime))
+    macho.forget(fn)
+    assert macho.dylib_id(fn) == '@rpath/libcpptrak.dylib'
+
+    # replaced by another file (other inode)
+    other = str(tmpdir.join('other'))
+    shutil.copy(fixture('libcpptraj.dylib'), other)
+    os.utime(other, (st.st_atime, st.st_mtime))
+    os.rename(other, fn)
+    assert macho.dylib_id(fn) == '@rpath/libcpptraj.dylib'
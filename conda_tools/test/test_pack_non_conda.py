@@ -2,12 +2,14 @@
 
 import os
 import sys
+import tarfile
 import subprocess
 import unittest
 from mock import patch
 
 sys.path.insert(0, '..')
 from pack_non_conda import pack_non_conda_package
+import build_manifest
 
 this_dir = os.path.dirname(__file__)
 PACK_SCRIPT = os.path.join(this_dir, '..',
@@ -33,6 +35,25 @@ def test_pack_non_conda_package():
     pack_non_conda_package(opt)
 
 
+def test_pack_non_conda_package_manifest(tmpdir):
+    class Opt():
+        pass
+
+    opt = Opt()
+    opt.tarfile = FAKE_TAR
+    opt.output_dir = str(tmpdir)
+    opt.date = False
+    opt.dry_run = False
+    opt.manifest = str(tmpdir.join('manifest.json'))
+    output_fn = pack_non_conda_package(opt)
+    manifest = build_manifest.read_manifest(opt.manifest)
+    artifact = manifest['artifacts'][0]
+    assert manifest['stage'] == 'pack-non-conda'
+    assert artifact['path'] == output_fn
+    assert artifact['filename'] == 'linux-64.fake.tar.bz2'
+    assert artifact['size'] == os.path.getsize(output_fn)
+
+
 @unittest.skipUnless(has_gfortran_local, 'Must have gfortran in /usr/local')
 def test_dry_run():
 
@@ -59,3 +80,22 @@ def test_dry_run_with_date():
     # e.g: linux-64.fake.01Apr17.H1542.tar.bz2
     assert ('new filename linux-64.fake.{}.tar.bz2'.format(
         get_date_label()) in output)
+
+
+def test_pack_non_conda_package_streaming(tmpdir):
+    class Opt():
+        pass
+
+    opt = Opt()
+    opt.tarfile = FAKE_TAR
+    opt.output_dir = str(tmpdir)
+    opt.date = False
+    opt.dry_run = False
+    opt.streaming = True
+    output_fn = pack_non_conda_package(opt)
+    assert os.path.basename(output_fn) == 'linux-64.fake.tar.bz2'
+    with tarfile.open(output_fn) as tar:
+        names = tar.getnames()
+        script = tar.extractfile('amber17/bin/fake_script.py').read()
+    assert 'amber17/info/index.json' in names
+    assert script.startswith(b'#!/usr/bin/env python\n')
@@ -0,0 +1,64 @@
+import io
+import os
+import sys
+import bz2
+import tarfile
+import subprocess
+
+sys.path.insert(0, '..')
+import parallel_bz2
+from parallel_bz2 import ParallelBZ2Writer
+
+
+def test_compress_file(tmpdir):
+    data = os.urandom(5000) * 20 + b'amber' * 10000
+    src = str(tmpdir.join('data.tar'))
+    with open(src, 'wb') as fh:
+        fh.write(data)
+    dst = parallel_bz2.compress_file(src, threads=3, chunk_size=4096)
+    assert dst == src + '.bz2'
+    with open(dst, 'rb') as fh:
+        content = fh.read()
+    # several streams, read as one
+    assert content.count(b'BZh9') > 1
+    assert bz2.decompress(content) == data
+    assert subprocess.check_output(['bzip2', '-dc', dst]) == data
+
+
+def test_writer_tar_stream(tmpdir):
+    out = io.BytesIO()
+    with ParallelBZ2Writer(out, threads=2, chunk_size=1000) as writer:
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for index in range(5):
+                content = str(index).encode() * 3000
+                member = tarfile.TarInfo('bin/file{}'.format(index))
+                member.size = len(content)
+                tar.addfile(member, io.BytesIO(content))
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r:bz2') as tar:
+        assert tar.getnames() == ['bin/file{}'.format(i) for i in range(5)]
+        assert tar.extractfile('bin/file3').read() == b'3' * 3000
+
+
+def test_writer_single_stream_and_empty():
+    out = io.BytesIO()
+    with ParallelBZ2Writer(out, chunk_size=None) as writer:
+        writer.write(b'x' * 10000)
+        writer.write(b'y')
+    assert out.getvalue().count(b'BZh9') == 1
+    assert bz2.decompress(out.getvalue()) == b'x' * 10000 + b'y'
+
+    out = io.BytesIO()
+    ParallelBZ2Writer(out).close()
+    assert bz2.decompress(out.getvalue()) == b''
+
+
+def test_benchmark(tmpdir):
+    src = str(tmpdir.join('data.tar'))
+    with open(src, 'wb') as fh:
+        fh.write(b'amber' * 100000)
+    results = parallel_bz2.benchmark(src, threads=2)
+    assert [method for method, _, _ in results] == [
+        'bzip2', 'parallel_bz2 (2 threads)'
+    ]
+    assert os.listdir(str(tmpdir)) == ['data.tar']
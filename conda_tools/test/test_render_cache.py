@@ -0,0 +1,91 @@
+import os
+import sys
+from mock import patch, MagicMock
+
+sys.path.insert(0, '..')
+import render_cache
+import utils
+
+
+def write(fn, content):
+    with open(fn, 'w') as fh:
+        fh.write(content)
+
+
+@patch('render_cache.conda_build_api', None)
+@patch('subprocess.check_output')
+def test_output_path(mock_check_output, tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    write(str(recipe.join('meta.yaml')), 'package: ambertools')
+    cache_file = str(tmpdir.join('cache', 'render.json'))
+
+    def output(cmd, env):
+        return '/conda-bld/linux-64/ambertools-py{}.tar.bz2\n'.format(
+            env['CONDA_PY']).encode()
+
+    mock_check_output.side_effect = output
+    command = ['conda', 'build', str(recipe), '--py', '3.6']
+    with patch.dict(os.environ, {'AMBER_RENDER_CACHE': cache_file,
+                                 'CONDA_PY': '27'}):
+        assert (render_cache.output_path(command) ==
+                '/conda-bld/linux-64/ambertools-py36.tar.bz2')
+        assert mock_check_output.call_args[0][0] == command + ['--output']
+        # memory cache; --no-test does not change the output
+        render_cache.output_path(command + ['--no-test'])
+        assert mock_check_output.call_count == 1
+
+        # disk cache
+        render_cache._memory_cache.clear()
+        render_cache.output_path(command)
+        assert mock_check_output.call_count == 1
+        assert os.path.exists(cache_file)
+
+        # recipe changed
+        write(str(recipe.join('meta.yaml')), 'package: ambertools2')
+        render_cache.output_path(command)
+        assert mock_check_output.call_count == 2
+
+        # env var used by the recipe changed
+        with patch.dict(os.environ, {'AMBER_BUILD_TASK': 'ambermini'}):
+            render_cache.output_path(command)
+        assert mock_check_output.call_count == 3
+
+        assert (render_cache.output_path(command[:3] + ['--py', '2.7']) ==
+                '/conda-bld/linux-64/ambertools-py27.tar.bz2')
+
+
+@patch('subprocess.check_output')
+def test_output_path_in_process(mock_check_output, tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    write(str(recipe.join('meta.yaml')), 'package: ambertools')
+    api = MagicMock()
+    api.get_output_file_paths.return_value = [
+        '/conda-bld/linux-64/ambertools-py36.tar.bz2'
+    ]
+    mock_check_output.return_value = b'/conda-bld/linux-64/from-cli.tar.bz2'
+    command = ['conda', 'build', str(recipe), '--py', '3.6', '--croot', 'bld']
+    with patch.dict(os.environ, {'AMBER_RENDER_CACHE': ''}), patch(
+            'render_cache.conda_build_api', api):
+        os.environ.pop('CONDA_PY', None)
+        render_cache._memory_cache.clear()
+        assert (render_cache.output_path(command + ['--no-test']) ==
+                '/conda-bld/linux-64/ambertools-py36.tar.bz2')
+        api.get_output_file_paths.assert_called_with(
+            str(recipe), python='3.6', croot='bld')
+        assert not mock_check_output.called
+
+        # not known in process: conda build --output
+        assert render_cache.output_path(command + ['--variants', 'x']) == (
+            '/conda-bld/linux-64/from-cli.tar.bz2')
+        api.get_output_file_paths.side_effect = RuntimeError('bad recipe')
+        assert render_cache.output_path(command[:3]) == (
+            '/conda-bld/linux-64/from-cli.tar.bz2')
+        assert mock_check_output.call_count == 2
+
+
+@patch('render_cache.output_path')
+def test_get_package_dir(mock_output_path):
+    mock_output_path.return_value = 'ambertools-py27.tar.bz2'
+    assert utils.get_package_dir('recipe', py=2.7) == 'ambertools-py27.tar.bz2'
+    mock_output_path.assert_called_with(['conda', 'build', 'recipe', '--py',
+                                         '2.7'])
@@ -0,0 +1,55 @@
+import os
+import sys
+import tarfile
+
+sys.path.insert(0, '..')
+import update_shebang
+
+
+def test_update_python_env(tmpdir):
+    bin_dir = tmpdir.mkdir('bin')
+    bin_dir.join('pdb4amber').write_binary(
+        b'#!/opt/conda/bin/python\n# /opt/conda/bin/python\nprint("hi")\n')
+    bin_dir.join('pdb4amber').chmod(0o644)
+    bin_dir.join('tleap').write_binary(b'#!/bin/sh\nteLeap $*\n')
+    bin_dir.join('python-dev').write_binary(b'/opt/conda/bin/python\n')
+    # native binaries are not read past the magic bytes
+    bin_dir.join('cpptraj').write_binary(b'\x7fELF\xff\xfe' + b'python' * 10)
+    bin_dir.join('sqm').write_binary(b'\xcf\xfa\xed\xfe#!python\n')
+    bin_dir.join('parmed').mksymlinkto(bin_dir.join('pdb4amber'))
+    bin_dir.mkdir('to_be_dispatched')
+
+    changed = update_shebang.update_python_env(str(bin_dir), jobs=2)
+    assert changed == [os.path.realpath(str(bin_dir.join('pdb4amber')))]
+    # only the first line
+    assert bin_dir.join('pdb4amber').read_binary() == (
+        b'#!/usr/bin/env python\n# /opt/conda/bin/python\nprint("hi")\n')
+    assert os.access(str(bin_dir.join('pdb4amber')), os.X_OK)
+    assert bin_dir.join('parmed').islink()
+    assert bin_dir.join('tleap').read_binary() == b'#!/bin/sh\nteLeap $*\n'
+    assert bin_dir.join('python-dev').read_binary() == (
+        b'/opt/conda/bin/python\n')
+    assert bin_dir.join('cpptraj').read_binary().endswith(b'python')
+
+    assert update_shebang.update_python_env(str(bin_dir)) == []
+
+
+def test_file_type():
+    assert update_shebang.file_type(b'#!/bin/sh') == 'script'
+    assert update_shebang.file_type(b'\x7fELF') == 'elf'
+    assert update_shebang.file_type(b'\xca\xfe\xba\xbe') == 'macho'
+    assert update_shebang.file_type(b'text') == 'other'
+
+
+def test_update_member():
+    member = tarfile.TarInfo('bin/pdb4amber')
+    member.mode = 0o644
+    member, content = update_shebang.update_member(
+        member, b'#!/opt/conda/bin/python\n#!/opt/conda/bin/python\n')
+    assert content == b'#!/usr/bin/env python\n#!/opt/conda/bin/python\n'
+    assert member.mode == 0o755
+
+    member = tarfile.TarInfo('bin/cpptraj')
+    member.mode = 0o644
+    member, content = update_shebang.update_member(member, b'\x7fELFpython')
+    assert (member.mode, content) == (0o644, b'\x7fELFpython')
@@ -0,0 +1,61 @@
+import os
+import sys
+from mock import patch
+
+sys.path.insert(0, '..')
+import utils
+
+
+def make_executable(fn, content='#!/bin/sh\n'):
+    with open(fn, 'w') as fh:
+        fh.write(content)
+    os.chmod(fn, 0o755)
+
+
+def test_setup_ccache(tmpdir):
+    bin_dir = tmpdir.mkdir('bin')
+    gfortran_dir = tmpdir.mkdir('gfortran')
+    make_executable(str(bin_dir.join('ccache')),
+                    '#!/bin/sh\necho "direct_cache_hit 3"\necho "cache_miss 1"\n')
+    make_executable(str(bin_dir.join('gcc')))
+    make_executable(str(gfortran_dir.join('gfortran')))
+    cache_dir = str(tmpdir.join('ccache'))
+    env = {
+        'PATH': str(bin_dir) + os.pathsep + '/usr/bin:/bin',
+        'AMBER_CCACHE_DIR': cache_dir,
+        'FC': str(gfortran_dir.join('gfortran')),
+    }
+    with patch.dict(os.environ, env):
+        assert utils.setup_ccache()
+        wrapper_dir = os.path.join(cache_dir, 'bin')
+        assert os.environ['PATH'].split(os.pathsep)[:3] == [
+            wrapper_dir, str(gfortran_dir), str(bin_dir)
+        ]
+        assert os.environ['CCACHE_DIR'] == cache_dir
+        assert os.environ['FC'] == 'gfortran'
+        for compiler in ['gcc', 'gfortran']:
+            assert (os.readlink(os.path.join(wrapper_dir, compiler)) ==
+                    str(bin_dir.join('ccache')))
+        assert not os.path.exists(os.path.join(wrapper_dir, 'clang'))
+        assert utils.ccache_stats() == {'direct_cache_hit': 3, 'cache_miss': 1}
+
+    # ccache moved (e.g. new conda environment): links are updated
+    new_bin_dir = tmpdir.mkdir('new_bin')
+    os.rename(str(bin_dir.join('ccache')), str(new_bin_dir.join('ccache')))
+    env['PATH'] = str(new_bin_dir) + os.pathsep + env['PATH']
+    with patch.dict(os.environ, env):
+        assert utils.setup_ccache()
+        for compiler in ['gcc', 'gfortran']:
+            assert (os.readlink(os.path.join(wrapper_dir, compiler)) ==
+                    str(new_bin_dir.join('ccache')))
+    # no temporary links left
+    assert not [fn for fn in os.listdir(wrapper_dir) if '.' in fn]
+
+
+def test_setup_ccache_disabled(tmpdir):
+    with patch.dict(os.environ, {'AMBER_CCACHE_DIR': ''}):
+        assert not utils.setup_ccache()
+    with patch.dict(os.environ, {'AMBER_CCACHE_DIR': str(tmpdir),
+                                 'PATH': str(tmpdir)}):
+        # no ccache
+        assert not utils.setup_ccache()
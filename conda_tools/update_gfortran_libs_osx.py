@@ -10,6 +10,8 @@ import glob
 import argparse
 import subprocess
 
+import macho
+
 required_libs = [
     'libstdc++.6.dylib', 'libgfortran.3.dylib', 'libgcc_s.1.dylib',
     'libquadmath.0.dylib'
@@ -17,9 +19,8 @@ required_libs = [
 
 
 def get_dylibs(fn):
-    output = subprocess.check_output(['otool', '-L', fn]).decode()
-    lines = [line.split()[0] for line in output.split('\n') if line]
-    return lines[1:]
+    # as `otool -L`: install name (dylib) then loaded dylibs
+    return macho.install_names(fn)
 
 
 # Note: we port conda-build "add_rpath" here to avoid adding conda-build
@@ -33,6 +34,7 @@ def add_rpath(path, rpath, verbose=False):
         print(' '.join(args))
     p = subprocess.Popen(args, stderr=subprocess.PIPE)
     stdout, stderr = p.communicate()
+    macho.forget(path)
     stderr = stderr.decode('utf-8')
     if "Mach-O dynamic shared library stub file" in stderr:
         print("Skipping Mach-O dynamic shared library stub file %s\n" % path)
@@ -77,15 +79,7 @@ def copy_gfortran_libs(g_dir='/usr/local/gfortran/lib/', dest='.'):
 
 
 def get_dependence(orig_lib):
-    p = subprocess.Popen(
-        ['otool', '-L', orig_lib],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    _, err = p.communicate()
-    err = err.decode()
-
-    if ('The file was not recognized as a valid object file' in err or
-            'Is a directory' in err):
+    if not macho.is_macho(orig_lib):
         return []
     else:
         return [
@@ -101,6 +95,7 @@ def change_to_rpath_dot_lib(dep, fn):
         '@rpath/amber_3rd_party/{}'.format(basename), fn
     ]
     subprocess.check_call(cmd)
+    macho.forget(fn)
     return ' '.join(cmd)
 
 
@@ -126,6 +121,7 @@ def update_rpath(prefix, g_dest='lib/amber_3rd_party/', copy_gfortran=True):
                 '@rpath/amber_3rd_party/{}'.format(basename), fn
             ]
             subprocess.check_call(cmd_id)
+            macho.forget(fn)
 
     for fn in will_be_fixed:
         print("FIXING: %s " % fn)
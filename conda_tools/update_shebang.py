@@ -1,31 +1,108 @@
 """Change hard-coded shebang to "#!/usr/bin/env python"
 
+Files are classified by their first bytes; only scripts (#!) are read
+further, and only their first line is rewritten (the rest is copied as is).
+
 Example:
     python update_shebang.py $AMBERHOME
 """
 import os
+import stat
+import shutil
 import argparse
 import glob
-import subprocess
-
-
-def update_python_env(bin_dir):
-    files = [fn for fn in glob.glob(bin_dir + '/*') if os.path.isfile(fn)]
-    for fn in files:
-        try:
-            content = ''
-            with open(fn) as fh:
-                line = fh.readline().strip()
-                if line.endswith('python'):
-                    fh.seek(0)
-                    content = fh.read().replace(line, '#!/usr/bin/env python')
-            # overwrite
-            if content:
-                with open(fn, 'w') as fh:
-                    fh.write(content)
-                subprocess.check_call(['chmod', '+x', fn])
-        except UnicodeError:
-            pass
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+NEW_SHEBANG = b'#!/usr/bin/env python'
+# longest first line we look at
+MAX_LINE = 4096
+MAGIC = [
+    (b'#!', 'script'),
+    (b'\x7fELF', 'elf'),
+    (b'\xfe\xed\xfa\xce', 'macho'),
+    (b'\xfe\xed\xfa\xcf', 'macho'),
+    (b'\xce\xfa\xed\xfe', 'macho'),
+    (b'\xcf\xfa\xed\xfe', 'macho'),
+    (b'\xca\xfe\xba\xbe', 'macho'),
+]
+
+
+def file_type(head):
+    ''' 'script', 'elf', 'macho' or 'other' from the first bytes of a file '''
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return name
+    return 'other'
+
+
+def _new_first_line(line):
+    ''' Rewritten first line (bytes, keeps the line ending), or None if it
+    is not a python shebang '''
+    shebang = line.strip()
+    if not shebang.startswith(b'#!') or not shebang.endswith(b'python'):
+        return None
+    return line.replace(shebang, NEW_SHEBANG, 1)
+
+
+def rewrite_shebang(fn):
+    ''' Rewrite the python shebang of `fn` and make it executable.
+    Return True if its content was changed. '''
+    with open(fn, 'rb') as fh:
+        line = fh.readline(MAX_LINE)
+        if file_type(line) != 'script':
+            return False
+        new_line = _new_first_line(line)
+        if new_line is None:
+            return False
+        mode = stat.S_IMODE(os.fstat(fh.fileno()).st_mode)
+        if new_line == line:
+            if mode & 0o111 != 0o111:
+                os.chmod(fn, mode | 0o111)
+            return False
+        tmp = fn + '.shebang.tmp'
+        with open(tmp, 'wb') as fh_out:
+            fh_out.write(new_line)
+            shutil.copyfileobj(fh, fh_out)
+    os.chmod(tmp, mode | 0o111)
+    os.rename(tmp, fn)
+    return True
+
+
+def update_python_env(bin_dir, jobs=None):
+    ''' Rewrite python shebangs of files in `bin_dir`, return changed files '''
+    files = []
+    seen = set()
+    for fn in sorted(glob.glob(bin_dir + '/*')):
+        if os.path.isfile(fn):
+            # edit the target of symlinks, once
+            path = os.path.realpath(fn)
+            if path not in seen:
+                seen.add(path)
+                files.append(path)
+    if not files:
+        return []
+    pool = ThreadPool(min(jobs or cpu_count(), len(files)))
+    try:
+        changed = pool.map(rewrite_shebang, files)
+    finally:
+        pool.close()
+        pool.join()
+    return [fn for fn, is_changed in zip(files, changed) if is_changed]
+
+
+def update_member(member, content):
+    ''' Transform for edit_package.streaming_conda_package: same edit as
+    update_python_env, on a tar member and its content (bytes) '''
+    if file_type(content[:4]) != 'script':
+        return member, content
+    end = content.find(b'\n')
+    end = len(content) if end < 0 else end + 1
+    new_line = _new_first_line(content[:end])
+    if new_line is not None:
+        content = new_line + content[end:]
+        member.mode |= 0o111
+    return member, content
 
 
 def main(args=None):
@@ -3,26 +3,36 @@ import sys
 import subprocess
 from contextlib import contextmanager
 
+import render_cache
+import build_trace
+import job_slots
+
+# compilers that are wrapped by ccache (see setup_ccache)
+CCACHE_COMPILERS = ['gcc', 'g++', 'cc', 'c++', 'clang', 'clang++', 'gfortran']
+CCACHE_STATS_KEYS = [
+    'direct_cache_hit', 'preprocessed_cache_hit', 'cache_miss',
+    'unsupported_source_language'
+]
+_ccache_stats_before = None
+
 
 def get_package_dir(conda_recipe, py=2.7):
-    cmd = ['conda', 'build', '--output', conda_recipe, '--py', str(py)]
-    print("CMD", cmd)
+    cmd = ['conda', 'build', conda_recipe, '--py', str(py)]
+    print("CMD", cmd + ['--output'])
     print('conda_recipe', conda_recipe)
-    output = subprocess.check_output(cmd)
-    conda_py = 'py%s' % os.getenv('CONDA_PY')
-    pyver = 'py%s' % str(py).replace('.', '')
+    # render_cache sets CONDA_PY to match --py
     # BUG: https://github.com/conda/conda-build/issues/3400
-    return (output.decode()
-            .replace('\n', '')
-            .replace(conda_py, pyver))
+    return render_cache.output_path(cmd)
 
+@build_trace.traced()
 def tar_xf(fn):
     sh('tar -xf {}'.format(fn))
 
 
 def sh(cmd):
     try:
-        subprocess.check_call(cmd, shell=True)
+        with build_trace.span(cmd[:80], cmd=cmd):
+            subprocess.check_call(cmd, shell=True)
     except subprocess.CalledProcessError as e:
         try:
             print(e.output.decode())
@@ -31,6 +41,7 @@ def sh(cmd):
             pass
 
 
+@build_trace.traced()
 def update_amber():
     sh('./update_amber --show-applied-patches')
     sh('./update_amber --update')
@@ -48,24 +59,143 @@ def set_compiler_env():
         os.environ['FC'] = '/usr/local/gfortran/bin/gfortran'
 
 
+def which(program):
+    for path in os.getenv('PATH', '').split(os.pathsep):
+        fn = os.path.join(path, program)
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            return fn
+    return None
+
+
+def ccache_stats():
+    ''' dict of ccache counters (ccache >= 4), None if not available '''
+    try:
+        output = subprocess.check_output(['ccache', '--print-stats'],
+                                         stderr=subprocess.STDOUT).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    stats = {}
+    for line in output.split('\n'):
+        words = line.split()
+        if len(words) == 2 and words[1].isdigit():
+            stats[words[0]] = int(words[1])
+    return stats
+
+
+def _symlink(target, link):
+    ''' Make `link` point to `target`, replacing a link to anything else
+    (e.g. a ccache from an older environment) '''
+    try:
+        if os.readlink(link) == target:
+            return
+    except OSError:
+        pass
+    # other builds may use the link meanwhile: swap it in with rename
+    tmp_link = '{}.{}'.format(link, os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.rename(tmp_link, link)
+
+
+def setup_ccache(cache_dir=None):
+    ''' Compile through ccache if $AMBER_CCACHE_DIR (or `cache_dir`) is given.
+
+    A folder of compiler symlinks to ccache ($AMBER_CCACHE_DIR/bin) is put in
+    front of PATH, so configure and make pick up gcc, g++ and gfortran via
+    ccache. ccache does not cache Fortran; gfortran calls are passed through
+    to the compiler and counted as unsupported_source_language.
+
+    Returns True if ccache is used.
+    '''
+    global _ccache_stats_before
+    cache_dir = cache_dir or os.getenv('AMBER_CCACHE_DIR')
+    if not cache_dir:
+        return False
+    ccache = which('ccache')
+    if ccache is None:
+        print('WARNING: AMBER_CCACHE_DIR is set but ccache is not found')
+        return False
+    cache_dir = os.path.abspath(cache_dir)
+    os.environ['CCACHE_DIR'] = cache_dir
+
+    # conda-build uses a new croot/{pkg}_{timestamp}/{work,_h_env...} for every
+    # build. Hash paths relative to that folder so that builds share the cache.
+    cwd = os.getcwd()
+    prefix = os.getenv('PREFIX', cwd)
+    basedir = os.path.dirname(
+        os.path.commonprefix([cwd + os.sep, prefix + os.sep]))
+    os.environ['CCACHE_BASEDIR'] = basedir if basedir != os.sep else cwd
+    os.environ['CCACHE_NOHASHDIR'] = '1'
+
+    wrapper_dir = os.path.join(cache_dir, 'bin')
+    if not os.path.exists(wrapper_dir):
+        os.makedirs(wrapper_dir)
+    # absolute compilers (e.g. FC=/usr/local/gfortran/bin/gfortran on MacOS)
+    # would skip the wrappers: use the compiler name and put its folder in PATH.
+    extra_paths = []
+    for env_name in ['CC', 'CXX', 'FC']:
+        compiler = os.getenv(env_name, '')
+        if os.path.isabs(compiler):
+            extra_paths.append(os.path.dirname(compiler))
+            os.environ[env_name] = os.path.basename(compiler)
+    os.environ['PATH'] = os.pathsep.join(extra_paths + [os.getenv('PATH', '')])
+
+    for compiler in CCACHE_COMPILERS:
+        wrapper = os.path.join(wrapper_dir, compiler)
+        if which(compiler) is None:
+            continue
+        _symlink(ccache, wrapper)
+    os.environ['PATH'] = wrapper_dir + os.pathsep + os.environ['PATH']
+    print('Using ccache {}, CCACHE_DIR={}, CCACHE_BASEDIR={}'.format(
+        ccache, cache_dir, os.environ['CCACHE_BASEDIR']))
+    _ccache_stats_before = ccache_stats()
+    return True
+
+
+def report_ccache_stats():
+    ''' Print ccache hits/misses since setup_ccache '''
+    if _ccache_stats_before is None:
+        if os.getenv('CCACHE_DIR') and which('ccache'):
+            sh('ccache -s')
+        return
+    after = ccache_stats() or {}
+    print('ccache stats for this build:')
+    for key in CCACHE_STATS_KEYS:
+        print('    {:<30} {}'.format(
+            key,
+            after.get(key, 0) - _ccache_stats_before.get(key, 0)))
+
+
+@build_trace.traced()
 def run_configure():
+    setup_ccache()
     if sys.platform.startswith('darwin'):
         sh('./configure --with-python python -macAccelerate clang')
     else:
         sh('./configure --with-python python gnu')
 
 
+@build_trace.traced()
 def make_install(ncpus=4):
-    sh('make install -j%s' % str(ncpus))
+    ''' make install with up to `ncpus` jobs, drawn from the build-wide job
+    slots (see job_slots.py) '''
+    with job_slots.acquire(ncpus) as n_jobs:
+        print('make install: {} of {} jobs'.format(n_jobs, ncpus))
+        sh('make install -j%s' % str(n_jobs))
 
 
+@build_trace.traced()
 def make_python_serial():
     amberhome = os.getenv('AMBERHOME') 
     os.chdir(os.path.join(amberhome, 'AmberTools/src'))
-    sh('make python_serial')
+    # serial, but takes a job slot so that concurrent builds account for it
+    with job_slots.acquire(1):
+        sh('make python_serial')
     os.chdir(amberhome)
 
 
+@build_trace.traced()
 def patch(patch_fname):
     print("Patching ...")
     # We want to reuse libcpptraj from previous build.
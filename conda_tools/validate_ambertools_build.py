@@ -5,6 +5,10 @@ from contextlib import contextmanager
 import argparse
 import glob
 
+import macho
+import package_info
+import channel_index
+
 ENV_ROOT = 'test_ambertools'
 AMBER_VERSION = 'amber17'
 
@@ -26,8 +30,19 @@ def run_test(package_dir, amberhome, TEST_SCRIPT):
 def install_ambertools(package_dir,
                        env_name,
                        tmp_dir='junk_folder',
-                       pyver='2.7'):
-    if is_conda_package(package_dir):
+                       pyver='2.7',
+                       channel=None):
+    if is_conda_package(package_dir) and channel is not None:
+        # conda, from the local channel so dependencies are solved too
+        channel = os.path.abspath(channel)
+        channel_index.index_channel(channel)
+        index = package_info.read_index_json(package_dir)
+        subprocess.check_call(
+            'conda install -c file://{} {}={}={} -n {} --yes'.format(
+                channel, index['name'], index['version'], index['build'],
+                env_name),
+            shell=True)
+    elif is_conda_package(package_dir):
         # conda
         subprocess.check_call(
             'conda install {} -n {}'.format(package_dir, env_name), shell=True)
@@ -85,13 +100,12 @@ def ensure_no_gfortran_local(amberhome):
     errors = []
 
     for fn in get_tested_files(amberhome):
-        cmd = ['otool', '-L', fn]
         try:
-            output = subprocess.check_output(
-                cmd, stderr=subprocess.PIPE).decode()
-        except subprocess.CalledProcessError:
-            output = ''
-        if '/usr/local/gfortran' in output:
+            libs = macho.install_names(fn)
+        except ValueError:
+            # truncated
+            libs = []
+        if any('/usr/local/gfortran' in lib for lib in libs):
             errors.append(fn)
 
     return errors
@@ -123,6 +137,11 @@ def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("package_dir")
     parser.add_argument("-py", dest='pyvers')
+    parser.add_argument(
+        "--channel",
+        default=None,
+        help="Local channel with package_dir (e.g. amber-conda-bld), indexed "
+        "before installing. Default: install package_dir directly")
     opt = parser.parse_args(args)
     package_dir = opt.package_dir
     tmp_dir = 'junk_folder'  # only exists if non-conda package
@@ -152,7 +171,8 @@ def main(args=None):
                 amberhome = os.path.join(
                     os.path.abspath(tmp_dir), AMBER_VERSION)
 
-            install_ambertools(package_dir, env_name, pyver=py)
+            install_ambertools(
+                package_dir, env_name, pyver=py, channel=opt.channel)
             if sys.platform.startswith('darwin'):
                 errors = ensure_no_gfortran_local(amberhome)
 